@@ -3,11 +3,24 @@ import requests
 import json
 import os
 import uuid
+import time
 import datetime
 import logging
-from threading import Timer, Lock
+import re
+import sys
+import zlib
+import hashlib
+import bisect
+import copy
+import queue
+from threading import Timer, Lock, Condition, Thread
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 import numpy as np
 from model2vec import StaticModel
+from sse import SSEParser, iter_events
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
@@ -24,6 +37,13 @@ app.secret_key = os.urandom(24)  # For session management
 # Paths
 CONFIG_FILE = '.config'
 DOCUMENTS_DIR = 'content'
+INDEX_DIR = os.path.join(DOCUMENTS_DIR, '.index')  # sidecar stores (vectors, indexes)
+
+# `python app.py` serves through Werkzeug's reloader: the process started first only
+# watches the source files and runs the server in a child process. Startup work that
+# changes files on disk (init_storage) and the shutdown flush are left to the child.
+RELOADER_PARENT = (__name__ == '__main__' and sys.argv[1:2] != ['reindex']
+                   and os.environ.get('WERKZEUG_RUN_MAIN') != 'true')
 logger.info(f"Config file path: {CONFIG_FILE}")
 
 # Default configuration
@@ -37,12 +57,22 @@ DEFAULT_CONFIG = {
     'repetition_penalty': 1.1,
     'max_tokens': 500,
     'current_document': None,
-    'documents': [],  # List of document IDs
     'dark_mode': True,  # Default to dark mode
     'provider': 'openrouter',  # 'openrouter', 'openai', 'chutes'
     'custom_api_key': '',  # Optional custom API key for specific providers
     'openai_endpoint': 'http://localhost:8080/v1',  # Only for OpenAI-compatible provider
     'embeddings_search': True,  # Use embeddings search by default
+    'embeddings_model': 'minishlab/potion-base-8M',  # model2vec model used for search embeddings
+    'document_cache_mb': 256,  # memory budget for documents kept in memory
+    'http_pool_size': 4,  # keep-alive connections per API host
+    'stream_flush_ms': 30,  # streamed text is sent to the browser at most this often...
+    'stream_flush_chars': 512,  # ...unless this much is waiting (the first token always goes at once)
+    'prefix_cache_hints': False,  # pin documents to llama.cpp slots and keep prompts cache-friendly
+    'reroll_prefetch': 0,  # alternative completions generated ahead of a reroll (0 = off)
+    'reroll_prefetch_budget': 6,  # most prefetched completions held or in flight at once
+    'reroll_prefetch_ttl': 300,  # seconds a prefetched completion stays usable
+    'branches': 3,  # completions requested at once by the branch button
+    'gc_interval': 0,  # seconds between background sweeps of empty Untitled documents (0 = off)
     'untitled_trick': False  # Use untitled.txt trick (chat format with CLI simulation)
 }
 
@@ -121,12 +151,13 @@ SEED_STOP_TOKENS = ["'}", "\n{", "')", "]", "']", "'>"]
 # Active generation requests
 active_generations = {}
 
-# In-memory document storage
-documents_cache = {}
+# In-memory document storage (documents_cache is created once the config is loaded)
 document_write_timers = {}  # per-document write timers
 document_last_write = {}  # track last write time for 30s max delay
 empty_document_timers = {}  # timers for renaming empty documents
 write_lock = Lock()
+edit_lock = Lock()  # serializes version checks with the patches they guard
+load_lock = Lock()  # one reader per cache miss, so a document has a single in-memory copy
 WRITE_DELAY_TYPING = 2.0  # seconds after typing stops
 WRITE_DELAY_MAX = 30.0  # max seconds between writes during continuous typing
 EMPTY_RENAME_DELAY = 5.0  # seconds before renaming empty document to "Untitled"
@@ -142,7 +173,7 @@ def get_embeddings_model():
     if embeddings_model is None:
         try:
             logger.info("Loading embeddings model...")
-            embeddings_model = StaticModel.from_pretrained("minishlab/potion-base-8M")
+            embeddings_model = StaticModel.from_pretrained(config.get('embeddings_model', DEFAULT_CONFIG['embeddings_model']))
             logger.info("Embeddings model loaded successfully")
         except Exception as e:
             logger.error(f"Error loading embeddings model: {e}")
@@ -150,7 +181,11 @@ def get_embeddings_model():
     return embeddings_model
 
 def calculate_text_embedding(text):
-    """Calculate embedding for a text string with performance optimizations"""
+    """Calculate embedding for a short text string (names, queries)
+
+    Document content is embedded passage by passage instead, see
+    embed_document_content().
+    """
     if not text or not text.strip():
         logger.debug("Empty text provided for embedding")
         return None
@@ -162,54 +197,582 @@ def calculate_text_embedding(text):
         
     try:
         # Clean the text - remove extra whitespace
-        clean_text = ' '.join(text.strip().split())
-        
-        # Performance optimization: use different strategies based on text length
-        if len(clean_text) > 50000:
-            # For very large documents, use a sample from beginning and end
-            beginning = clean_text[:2000]
-            end = clean_text[-2000:]
-            clean_text = beginning + " ... " + end
-            logger.debug(f"Large document detected ({len(text)} chars), using sample for embedding")
-        elif len(clean_text) > 8000:
-            # For medium documents, truncate more aggressively
-            clean_text = clean_text[:8000]
-            logger.debug(f"Medium document detected, truncating to 8000 chars for embedding")
-        elif len(clean_text) > 5000:
-            # For smaller large documents, use original limit
-            clean_text = clean_text[:5000]
-            
+        clean_text = ' '.join(text.strip().split())[:CHUNK_MAX_CHARS]
         logger.debug(f"Calculating embedding for text: {clean_text[:50]}...")
         embeddings = model.encode([clean_text])
-        result = embeddings[0].tolist()  # Convert numpy array to list for JSON storage
+        result = np.asarray(embeddings[0], dtype=np.float32)  # Stored in the vector store, not JSON
         logger.debug(f"Embedding calculated successfully, length: {len(result)}")
         return result
     except Exception as e:
         logger.error(f"Error calculating embedding: {e}")
         return None
 
-def cosine_similarity(vec1, vec2):
-    """Calculate cosine similarity between two vectors"""
-    if not vec1 or not vec2:
-        return 0.0
-        
+# Passage chunking: boundaries are picked at line/sentence ends whose
+# preceding text hashes to a fixed residue, so they depend on nearby content
+# rather than absolute offsets and an edit only changes the chunks around it.
+CHUNK_MIN_CHARS = 400
+CHUNK_MAX_CHARS = 3000
+CHUNK_BOUNDARY_DIVISOR = 6
+CHUNK_BOUNDARY_WINDOW = 16
+CHUNK_BOUNDARY_PATTERN = re.compile(r'\n|[.!?]["\')\]]*\s')
+
+def _forced_chunk_end(text, start, last_candidate):
+    """Pick a cut for a chunk that reached CHUNK_MAX_CHARS without a boundary"""
+    if last_candidate and last_candidate - start >= CHUNK_MIN_CHARS:
+        return last_candidate
+    limit = start + CHUNK_MAX_CHARS
+    space = text.rfind(' ', start + CHUNK_MIN_CHARS, limit)
+    return space + 1 if space != -1 else limit
+
+def split_into_chunks(text):
+    """Split text into content-defined chunks, returning (start, end) offsets"""
+    chunks = []
+    start = 0
+    last_candidate = None
+    for match in CHUNK_BOUNDARY_PATTERN.finditer(text):
+        end = match.end()
+        while end - start > CHUNK_MAX_CHARS:
+            cut = _forced_chunk_end(text, start, last_candidate)
+            chunks.append((start, cut))
+            start, last_candidate = cut, None
+        if end - start < CHUNK_MIN_CHARS:
+            last_candidate = end
+            continue
+        window = text[end - CHUNK_BOUNDARY_WINDOW:end].encode('utf-8')
+        if zlib.crc32(window) % CHUNK_BOUNDARY_DIVISOR == 0:
+            chunks.append((start, end))
+            start, last_candidate = end, None
+        else:
+            last_candidate = end
+    while len(text) - start > CHUNK_MAX_CHARS:
+        cut = _forced_chunk_end(text, start, last_candidate)
+        chunks.append((start, cut))
+        start, last_candidate = cut, None
+    if start < len(text):
+        chunks.append((start, len(text)))
+    return chunks
+
+def chunk_hash(chunk_text):
+    return hashlib.sha1(chunk_text.encode('utf-8')).hexdigest()
+
+def calculate_chunk_embeddings(texts):
+    """Embed a batch of passages with a single model call, returning an (n, dim) array or None"""
+    if not texts:
+        return None
+    model = get_embeddings_model()
+    if model is None:
+        logger.error("Embeddings model is None")
+        return None
     try:
-        # Convert to numpy arrays
-        a = np.array(vec1)
-        b = np.array(vec2)
-        
-        # Calculate cosine similarity
-        dot_product = np.dot(a, b)
-        norm_a = np.linalg.norm(a)
-        norm_b = np.linalg.norm(b)
-        
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
-            
-        return dot_product / (norm_a * norm_b)
+        clean_texts = [' '.join(text.split()) for text in texts]
+        return np.asarray(model.encode(clean_texts), dtype=np.float32)
     except Exception as e:
-        logger.error(f"Error calculating cosine similarity: {e}")
-        return 0.0
+        logger.error(f"Error calculating passage embeddings: {e}")
+        return None
+
+class EmbeddingIndex:
+    """In-memory vector index over document, name and passage embeddings
+
+    Vectors are kept pre-normalized in contiguous float32 matrices so a query
+    is a single matrix-vector product per matrix. Documents without an
+    embedding keep a zero row, which scores 0.0 like before. Passage rows
+    belong to a document and carry the passage's (offset, length) so search
+    can point at the best-matching part of a long document.
+    """
+
+    def __init__(self, initial_capacity=64):
+        self.lock = Lock()
+        self.dim = None
+        self.capacity = initial_capacity
+        self.content_vectors = None
+        self.name_vectors = None
+        self.row_ids = []  # row -> doc_id
+        self.id_rows = {}  # doc_id -> row
+        self.passage_capacity = initial_capacity
+        self.passage_vectors = None
+        self.passage_doc_rows = None  # passage row -> document row
+        self.passage_spans = []  # passage row -> (offset, length)
+        self.doc_passages = {}  # doc_id -> [passage rows]
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.id_rows
+
+    @staticmethod
+    def normalize(vector):
+        """Return a unit-length float32 copy of a vector (zeros stay zeros)"""
+        vec = np.array(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _allocate(self, dim):
+        self.dim = dim
+        while self.capacity < len(self.row_ids):
+            self.capacity *= 2
+        self.content_vectors = np.zeros((self.capacity, dim), dtype=np.float32)
+        self.name_vectors = np.zeros((self.capacity, dim), dtype=np.float32)
+        self.passage_vectors = np.zeros((self.passage_capacity, dim), dtype=np.float32)
+        self.passage_doc_rows = np.zeros(self.passage_capacity, dtype=np.int64)
+
+    def _grow(self):
+        self.capacity *= 2
+        for attr in ('content_vectors', 'name_vectors'):
+            old = getattr(self, attr)
+            grown = np.zeros((self.capacity, self.dim), dtype=np.float32)
+            grown[:len(old)] = old
+            setattr(self, attr, grown)
+
+    def _grow_passages(self):
+        self.passage_capacity *= 2
+        grown = np.zeros((self.passage_capacity, self.dim), dtype=np.float32)
+        grown[:len(self.passage_vectors)] = self.passage_vectors
+        self.passage_vectors = grown
+        grown_rows = np.zeros(self.passage_capacity, dtype=np.int64)
+        grown_rows[:len(self.passage_doc_rows)] = self.passage_doc_rows
+        self.passage_doc_rows = grown_rows
+
+    def _set_row(self, matrix, row, vector):
+        if vector is None:
+            matrix[row] = 0.0
+        elif len(vector) != self.dim:
+            logger.warning(f"Ignoring embedding with dimension {len(vector)} (index uses {self.dim})")
+            matrix[row] = 0.0
+        else:
+            matrix[row] = self.normalize(vector)
+
+    def upsert(self, doc_id, content_embedding=None, name_embedding=None, update_content=True, update_name=True):
+        """Add or replace a document's vectors"""
+        with self.lock:
+            if self.dim is None:
+                first = content_embedding if content_embedding is not None else name_embedding
+                if first is not None:
+                    self._allocate(len(first))
+
+            row = self.id_rows.get(doc_id)
+            if row is None:
+                row = self._append(doc_id)
+            if self.dim is None:
+                return
+            if update_content:
+                self._set_row(self.content_vectors, row, content_embedding)
+            if update_name:
+                self._set_row(self.name_vectors, row, name_embedding)
+
+    def _append(self, doc_id):
+        if self.dim is not None and len(self.row_ids) >= self.capacity:
+            self._grow()
+        row = len(self.row_ids)
+        self.row_ids.append(doc_id)
+        self.id_rows[doc_id] = row
+        if self.dim is not None:
+            self.content_vectors[row] = 0.0
+            self.name_vectors[row] = 0.0
+        return row
+
+    def set_passages(self, doc_id, passages):
+        """Replace a document's passages with a list of (vector, offset, length)"""
+        with self.lock:
+            self._remove_passages(doc_id)
+            passages = [p for p in passages if p[0] is not None]
+            if not passages:
+                return
+            if self.dim is None:
+                self._allocate(len(passages[0][0]))
+            doc_row = self.id_rows.get(doc_id)
+            if doc_row is None:
+                doc_row = self._append(doc_id)
+            rows = []
+            for vector, offset, length in passages:
+                if len(vector) != self.dim:
+                    continue
+                if len(self.passage_spans) >= self.passage_capacity:
+                    self._grow_passages()
+                row = len(self.passage_spans)
+                self.passage_vectors[row] = self.normalize(vector)
+                self.passage_doc_rows[row] = doc_row
+                self.passage_spans.append((offset, length))
+                rows.append(row)
+            self.doc_passages[doc_id] = rows
+
+    def _remove_passages(self, doc_id):
+        # Remove from the highest row down so swapped-in rows are never ones we still need to drop
+        for row in sorted(self.doc_passages.pop(doc_id, []), reverse=True):
+            last = len(self.passage_spans) - 1
+            if row != last:
+                moved_doc = self.row_ids[self.passage_doc_rows[last]]
+                self.passage_vectors[row] = self.passage_vectors[last]
+                self.passage_doc_rows[row] = self.passage_doc_rows[last]
+                self.passage_spans[row] = self.passage_spans[last]
+                moved_rows = self.doc_passages[moved_doc]
+                moved_rows[moved_rows.index(last)] = row
+            self.passage_spans.pop()
+
+    def remove(self, doc_id):
+        """Remove a document, moving the last row into its slot"""
+        with self.lock:
+            self._remove_passages(doc_id)
+            row = self.id_rows.pop(doc_id, None)
+            if row is None:
+                return
+            last = len(self.row_ids) - 1
+            if row != last:
+                moved_id = self.row_ids[last]
+                self.row_ids[row] = moved_id
+                self.id_rows[moved_id] = row
+                if self.dim is not None:
+                    self.content_vectors[row] = self.content_vectors[last]
+                    self.name_vectors[row] = self.name_vectors[last]
+                    for passage_row in self.doc_passages.get(moved_id, []):
+                        self.passage_doc_rows[passage_row] = row
+            self.row_ids.pop()
+
+    def search(self, query_embedding, limit=None):
+        """Score all documents against a query embedding
+
+        Returns a list of (doc_id, score, content_similarity, name_similarity,
+        passage) sorted by score, highest first, where passage is the
+        (offset, length) of the best-matching passage or None. With a limit,
+        only the top-k rows are selected (argpartition) and sorted.
+        """
+        with self.lock:
+            count = len(self.row_ids)
+            if count == 0 or self.dim is None:
+                return [(doc_id, 0.0, 0.0, 0.0, None) for doc_id in self.row_ids[:limit or count]]
+            query = self.normalize(query_embedding)
+            if len(query) != self.dim:
+                logger.error(f"Query embedding dimension {len(query)} does not match index ({self.dim})")
+                return []
+            content_scores = self.content_vectors[:count] @ query
+            name_scores = self.name_vectors[:count] @ query
+
+            # Best passage per document
+            best_passage = {}
+            passage_count = len(self.passage_spans)
+            if passage_count:
+                passage_scores = self.passage_vectors[:passage_count] @ query
+                doc_rows = self.passage_doc_rows[:passage_count]
+                np.maximum.at(content_scores, doc_rows, passage_scores)
+                order = np.lexsort((-passage_scores, doc_rows))
+                _, first = np.unique(doc_rows[order], return_index=True)
+                for passage_row in order[first]:
+                    best_passage[int(doc_rows[passage_row])] = self.passage_spans[passage_row]
+
+            scores = np.maximum(content_scores, name_scores)
+
+            if limit and limit < count:
+                top = np.argpartition(-scores, limit - 1)[:limit]
+                order = top[np.argsort(-scores[top])]
+            else:
+                order = np.argsort(-scores)
+
+            return [
+                (self.row_ids[row], float(scores[row]), float(content_scores[row]), float(name_scores[row]),
+                 best_passage.get(int(row)))
+                for row in order
+            ]
+
+embedding_index = EmbeddingIndex()
+embedding_index_ready = False
+embedding_index_lock = Lock()
+
+class VectorStore:
+    """Memory-mapped float32 vector file with a slot allocator
+
+    Vectors live in a raw `vectors.f32` file of shape (capacity, dim) that is
+    memory-mapped, so reads are zero-copy views. A JSON header records the
+    dimension, capacity, the free list and which key owns each slot.
+    Keys are strings such as "<doc_id>:content", "<doc_id>:name" or
+    "chunk:<sha1>"; documents only keep the slot number of their vectors.
+
+    Chunk vectors are content-addressed and shared between documents. Each
+    document's chunk layout is kept in the header too, and chunk reference
+    counts are derived from the layouts, so a chunk slot is freed once no
+    document uses it.
+
+    Changes are saved in the background shortly after they happen, as one
+    record in `vectors.log` with just the slots and layouts that changed.
+    The header is rewritten from memory only once the log outgrows a share
+    of it; records are numbered so replay skips what the header has. Freed
+    slots are only reused once the record freeing them is on disk, so a
+    crash can lose recent vectors but never attach a vector to the wrong key.
+    """
+
+    def __init__(self, directory, initial_capacity=256):
+        self.lock = Lock()
+        self.directory = directory
+        self.data_path = os.path.join(directory, 'vectors.f32')
+        self.header_path = os.path.join(directory, 'vectors.json')
+        self.log_path = os.path.join(directory, 'vectors.log')
+        self.initial_capacity = initial_capacity
+        self.dim = None
+        self.capacity = 0
+        self.next_slot = 0
+        self.free = []
+        self.pending_free = []  # freed since the last header write
+        self.owners = {}  # slot -> key
+        self.slots = {}  # key -> slot
+        self.layouts = {}  # doc_id -> [[chunk_hash, start, length, utf16_start, utf16_length], ...]
+        self.chunk_refs = {}  # chunk_hash -> number of documents using it
+        self.model = None  # embeddings model the vectors were computed with
+        self.vectors = None
+        self.changed_slots = set()  # slots whose owner changed since the last save
+        self.changed_layouts = set()  # documents whose layout changed since the last save
+        self.seq = 0  # number of the last record saved
+        self.header_bytes = 0
+        self.log_bytes = None  # valid length of the log; None until a header has been written
+        self.save_lock = Lock()  # one save at a time, so log records stay in order
+        self.header_timer = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.header_path):
+            return
+        try:
+            with open(self.header_path, 'r') as f:
+                header = json.load(f)
+            self.header_bytes = os.path.getsize(self.header_path)
+            dim, capacity = header.get('dim'), header.get('capacity', 0)
+            next_slot = header.get('next_slot', 0)
+            free = set(header.get('free', []))
+            owners = {int(slot): key for slot, key in header.get('owners', {}).items()}
+            layouts = header.get('layouts', {})
+            seq = header.get('seq', 0)
+            log_bytes = 0
+            if os.path.exists(self.log_path):
+                with open(self.log_path, 'rb') as f:
+                    records, log_bytes = parse_records(f.read())
+                for record in records:
+                    if record['seq'] <= seq:
+                        continue
+                    dim, capacity, next_slot = record['dim'], record['capacity'], record['next_slot']
+                    for slot, key in record.get('slots', {}).items():
+                        slot = int(slot)
+                        if key is None:
+                            owners.pop(slot, None)
+                            free.add(slot)
+                        else:
+                            owners[slot] = key
+                            free.discard(slot)
+                    for doc_id, layout in record.get('layouts', {}).items():
+                        if layout is None:
+                            layouts.pop(doc_id, None)
+                        else:
+                            layouts[doc_id] = layout
+                    seq = record['seq']
+            if dim and capacity:
+                expected = dim * capacity * 4
+                if not os.path.exists(self.data_path) or os.path.getsize(self.data_path) < expected:
+                    raise ValueError(f"{self.data_path} is missing or truncated")
+                self.dim = dim
+                self.capacity = capacity
+                self.vectors = np.memmap(self.data_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+            self.next_slot = next_slot
+            self.free = sorted(free)
+            self.owners = owners
+            self.slots = {key: slot for slot, key in self.owners.items()}
+            self.layouts = layouts
+            self.model = header.get('model')
+            self.seq = seq
+            self.log_bytes = log_bytes
+            for layout in self.layouts.values():
+                for chunk_hash in {chunk[0] for chunk in layout}:
+                    self.chunk_refs[chunk_hash] = self.chunk_refs.get(chunk_hash, 0) + 1
+            logger.info(f"Vector store loaded: {len(self.owners)} vectors, capacity {self.capacity}")
+        except Exception as e:
+            logger.error(f"Error loading vector store, starting empty: {e}")
+            self.dim, self.capacity, self.next_slot = None, 0, 0
+            self.free, self.owners, self.slots, self.vectors = [], {}, {}, None
+            self.layouts, self.chunk_refs = {}, {}
+            self.seq, self.log_bytes = 0, None
+
+    def _save(self):
+        """Write the changes since the last save: a log record, or the whole header once the log is large"""
+        with self.save_lock:
+            with self.lock:
+                if self.header_timer:
+                    self.header_timer.cancel()
+                    self.header_timer = None
+                if self.dim is None:
+                    return
+                vectors = self.vectors
+                freed, self.pending_free = self.pending_free, []
+                slots = {slot: self.owners.get(slot) for slot in self.changed_slots}
+                layouts = {doc_id: self.layouts.get(doc_id) for doc_id in self.changed_layouts}
+                self.changed_slots, self.changed_layouts = set(), set()
+                self.seq += 1
+                state = {'seq': self.seq, 'dim': self.dim, 'capacity': self.capacity, 'next_slot': self.next_slot}
+                compact = self.log_bytes is None or \
+                    self.log_bytes > max(JOURNAL_COMPACT_MIN_BYTES, self.header_bytes * JOURNAL_COMPACT_RATIO)
+                if compact:
+                    # Layouts are replaced, never changed in place, so shallow copies are stable
+                    header = dict(state, free=self.free + freed, owners=dict(self.owners),
+                                  layouts=dict(self.layouts), model=self.model)
+                elif not slots and not layouts and not freed:
+                    vectors.flush()
+                    return
+            try:
+                # Vectors reach the disk before any record that names their owners
+                vectors.flush()
+                if compact:
+                    tmp_path = self.header_path + '.tmp'
+                    with open(tmp_path, 'w') as f:
+                        json.dump(header, f)
+                    os.replace(tmp_path, self.header_path)
+                    if os.path.exists(self.log_path):
+                        os.remove(self.log_path)
+                    self.header_bytes = os.path.getsize(self.header_path)
+                    self.log_bytes = 0
+                else:
+                    line = pack_record(dict(state, slots=slots, layouts=layouts))
+                    with open(self.log_path, 'ab') as f:
+                        if f.tell() != self.log_bytes:
+                            # Drop anything past the last good record before appending
+                            f.truncate(self.log_bytes)
+                        f.write(line)
+                    self.log_bytes += len(line)
+            except Exception as e:
+                logger.error(f"Error saving vector store: {e}")
+                with self.lock:
+                    self.pending_free.extend(freed)
+                    self.changed_slots.update(slots)
+                    self.changed_layouts.update(layouts)
+                return
+            # Freed slots are safe to reuse once the disk no longer lists their old owners
+            with self.lock:
+                self.free.extend(freed)
+
+    def _schedule_header_write(self):
+        # Not pushed back by later changes, so steady indexing can't postpone it
+        if self.header_timer is None:
+            self.header_timer = Timer(1.0, self.flush)
+            self.header_timer.daemon = True
+            self.header_timer.start()
+
+    def _resize(self, capacity):
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.data_path, 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.capacity = capacity
+        self.vectors = np.memmap(self.data_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        if self.next_slot >= self.capacity:
+            self._resize(max(self.initial_capacity, self.capacity * 2))
+        slot = self.next_slot
+        self.next_slot += 1
+        return slot
+
+    def _release(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        del self.owners[slot]
+        self.vectors[slot] = 0.0
+        self.pending_free.append(slot)
+        self.changed_slots.add(slot)
+
+    def put(self, key, vector):
+        """Write a vector for `key`, reusing its slot if it already has one
+
+        Returns the slot number the vector was written to.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.dim = len(vector)
+                self._resize(self.initial_capacity)
+            if len(vector) != self.dim:
+                raise ValueError(f"Vector dimension {len(vector)} does not match store ({self.dim})")
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self._allocate()
+                self.owners[slot] = key
+                self.slots[key] = slot
+                self.changed_slots.add(slot)
+                self._schedule_header_write()
+            self.vectors[slot] = vector
+            return slot
+
+    def get(self, slot):
+        """Return a read-only view of the vector in `slot`, or None"""
+        if slot is None or self.vectors is None or slot not in self.owners:
+            return None
+        view = self.vectors[slot]
+        view.flags.writeable = False
+        return view
+
+    def get_key(self, key):
+        return self.get(self.slots.get(key))
+
+    def slot_of(self, key):
+        return self.slots.get(key)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def release(self, key):
+        """Return the slot owned by `key` to the free list"""
+        with self.lock:
+            if key in self.slots:
+                self._release(key)
+                self._schedule_header_write()
+
+    def get_layout(self, doc_id):
+        return self.layouts.get(doc_id, [])
+
+    def set_layout(self, doc_id, layout):
+        """Replace a document's chunk layout, freeing chunks nobody uses anymore"""
+        with self.lock:
+            old_hashes = {chunk[0] for chunk in self.layouts.get(doc_id, [])}
+            new_hashes = {chunk[0] for chunk in layout}
+            for chunk_hash in new_hashes - old_hashes:
+                self.chunk_refs[chunk_hash] = self.chunk_refs.get(chunk_hash, 0) + 1
+            for chunk_hash in old_hashes - new_hashes:
+                refs = self.chunk_refs.get(chunk_hash, 1) - 1
+                if refs > 0:
+                    self.chunk_refs[chunk_hash] = refs
+                else:
+                    self.chunk_refs.pop(chunk_hash, None)
+                    self._release(f"chunk:{chunk_hash}")
+            if layout:
+                self.layouts[doc_id] = layout
+            else:
+                self.layouts.pop(doc_id, None)
+            self.changed_layouts.add(doc_id)
+            self._schedule_header_write()
+
+    def reset(self, model=None):
+        """Drop every vector, e.g. when switching to a different embeddings model"""
+        with self.save_lock, self.lock:
+            if self.header_timer:
+                self.header_timer.cancel()
+                self.header_timer = None
+            self.vectors = None
+            for path in (self.data_path, self.header_path, self.log_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.dim, self.capacity, self.next_slot = None, 0, 0
+            self.free, self.pending_free = [], []
+            self.owners, self.slots, self.layouts, self.chunk_refs = {}, {}, {}, {}
+            self.changed_slots, self.changed_layouts = set(), set()
+            self.seq, self.log_bytes = 0, None
+            self.model = model
+
+    def items(self):
+        """Snapshot of (slot, key) pairs currently in use"""
+        with self.lock:
+            return list(self.owners.items())
+
+    def flush(self):
+        """Write pending vectors and slot changes to disk"""
+        self._save()
 
 # Ensure documents directory exists
 try:
@@ -218,6 +781,272 @@ try:
 except Exception as e:
     logger.error(f"Error creating documents directory: {e}")
 
+vector_store = VectorStore(INDEX_DIR)
+
+# ============================
+# Keyword Index
+# ============================
+
+KEYWORD_TOKEN_PATTERN = re.compile(r'\w+')
+KEYWORD_FIELDS = ('content', 'name')
+
+def tokenize_keywords(text):
+    """Count the lowercase word tokens in a text"""
+    counts = {}
+    for token in KEYWORD_TOKEN_PATTERN.findall(text.lower()):
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+class KeywordIndex:
+    """Incremental inverted index for keyword search
+
+    Each document's term counts (per field: content and name) are kept as a
+    forward index so an update only applies the difference to the postings.
+    A trigram map over the vocabulary finds terms containing a substring
+    without scanning documents. Only the forward index is persisted; postings
+    and trigrams are rebuilt from it on load. On disk it is a snapshot plus a
+    log: each save appends the entries of the documents changed since the
+    last one, and the log is folded into a new snapshot once it grows past a
+    share of it, like a document journal.
+    """
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.save_lock = Lock()  # one save at a time, so log records stay in order
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + '.log'
+        self.docs = {}  # doc_id -> {field: {term: count}}
+        self.postings = {field: {} for field in KEYWORD_FIELDS}  # field -> term -> {doc_id: count}
+        self.trigrams = {}  # trigram -> set of terms
+        self.changed = set()  # documents updated or removed since the last save
+        self.seq = 0  # number of the last record saved
+        self.snapshot_bytes = 0
+        self.log_bytes = None  # valid length of the log; None until a snapshot has been written
+        self.loaded = False
+        self.synced = False  # checked against the document list, see ensure_keyword_index
+        self.write_timer = None
+
+    def __contains__(self, doc_id):
+        return doc_id in self.docs
+
+    def doc_ids(self):
+        with self.lock:
+            return list(self.docs)
+
+    @staticmethod
+    def _trigrams(term):
+        return {term[i:i + 3] for i in range(len(term) - 2)}
+
+    def _term_in_use(self, term):
+        return any(term in self.postings[field] for field in KEYWORD_FIELDS)
+
+    def _add_term(self, field, term, doc_id, count):
+        postings = self.postings[field].get(term)
+        if postings is None:
+            if not self._term_in_use(term):
+                for trigram in self._trigrams(term):
+                    self.trigrams.setdefault(trigram, set()).add(term)
+            postings = self.postings[field][term] = {}
+        postings[doc_id] = count
+
+    def _remove_term(self, field, term, doc_id):
+        postings = self.postings[field].get(term)
+        if postings is None:
+            return
+        postings.pop(doc_id, None)
+        if not postings:
+            del self.postings[field][term]
+            if not self._term_in_use(term):
+                for trigram in self._trigrams(term):
+                    terms = self.trigrams.get(trigram)
+                    if terms:
+                        terms.discard(term)
+                        if not terms:
+                            del self.trigrams[trigram]
+
+    def _set_field(self, doc_id, field, counts):
+        entry = self.docs.setdefault(doc_id, {})
+        old = entry.get(field, {})
+        for term in old.keys() - counts.keys():
+            self._remove_term(field, term, doc_id)
+        for term, count in counts.items():
+            if old.get(term) != count:
+                self._add_term(field, term, doc_id, count)
+        entry[field] = counts
+
+    def update(self, doc_id, content=None, name=None):
+        """Re-index a document's content and/or name"""
+        updates = {}
+        if content is not None:
+            updates['content'] = tokenize_keywords(content)
+        if name is not None:
+            updates['name'] = tokenize_keywords(name)
+        with self.lock:
+            for field, counts in updates.items():
+                self._set_field(doc_id, field, counts)
+            self.changed.add(doc_id)
+        self._schedule_write()
+
+    def remove(self, doc_id):
+        with self.lock:
+            self.changed.add(doc_id)
+            entry = self.docs.pop(doc_id, None)
+            if entry is None:
+                return
+            for field, counts in entry.items():
+                for term in counts:
+                    self._remove_term(field, term, doc_id)
+        self._schedule_write()
+
+    def matching_terms(self, fragment):
+        """Terms in the vocabulary that contain `fragment` (lock must be held)"""
+        if len(fragment) >= 3:
+            candidates = None
+            for trigram in self._trigrams(fragment):
+                terms = self.trigrams.get(trigram, set())
+                candidates = terms if candidates is None else candidates & terms
+                if not candidates:
+                    return set()
+        else:
+            candidates = set()
+            for field in KEYWORD_FIELDS:
+                candidates.update(self.postings[field])
+        return {term for term in candidates if fragment in term}
+
+    def count_substring(self, query):
+        """Exact occurrence counts for a query made only of word characters
+
+        Such a query can't match across a non-word character, so every
+        occurrence lies inside one token and the counts come straight from the
+        postings. Returns {doc_id: {field: count}}.
+        """
+        results = {}
+        with self.lock:
+            for term in self.matching_terms(query):
+                per_term = term.count(query)
+                for field in KEYWORD_FIELDS:
+                    for doc_id, count in self.postings[field].get(term, {}).items():
+                        fields = results.setdefault(doc_id, {})
+                        fields[field] = fields.get(field, 0) + per_term * count
+        return results
+
+    def candidates(self, tokens):
+        """Documents that contain every token as part of some term, per field"""
+        candidates = {}
+        with self.lock:
+            for field in KEYWORD_FIELDS:
+                docs = None
+                for token in tokens:
+                    token_docs = set()
+                    for term in self.matching_terms(token):
+                        token_docs.update(self.postings[field].get(term, {}))
+                    docs = token_docs if docs is None else docs & token_docs
+                    if not docs:
+                        break
+                candidates[field] = docs or set()
+        return candidates
+
+    def load(self):
+        """Load the persisted forward index and rebuild postings
+
+        Documents changed in memory before the index was loaded keep their
+        newer entries.
+        """
+        with self.lock:
+            self.loaded = True
+            try:
+                docs, seq = {}, 0
+                if os.path.exists(self.path):
+                    with open(self.path, 'r') as f:
+                        data = json.load(f)
+                    if 'seq' in data and 'docs' in data:
+                        docs, seq = data['docs'], data['seq']
+                    else:
+                        docs = data  # older files held the forward index alone
+                    self.snapshot_bytes = os.path.getsize(self.path)
+                    self.log_bytes = 0
+                if os.path.exists(self.log_path):
+                    with open(self.log_path, 'rb') as f:
+                        records, self.log_bytes = parse_records(f.read())
+                    for record in records:
+                        if record['seq'] <= seq:
+                            continue
+                        for doc_id, entry in record['docs'].items():
+                            if entry is None:
+                                docs.pop(doc_id, None)
+                            else:
+                                docs[doc_id] = entry
+                        seq = record['seq']
+                self.seq = seq
+                for doc_id, entry in docs.items():
+                    if doc_id in self.changed:
+                        continue
+                    for field, counts in entry.items():
+                        if field in self.postings:
+                            self._set_field(doc_id, field, counts)
+                if docs:
+                    logger.info(f"Keyword index loaded: {len(self.docs)} documents, {len(self.trigrams)} trigrams")
+            except Exception as e:
+                logger.error(f"Error loading keyword index, rebuilding: {e}")
+                self.docs = {}
+                self.postings = {field: {} for field in KEYWORD_FIELDS}
+                self.trigrams = {}
+                # Start over with a snapshot of what gets indexed from here
+                self.log_bytes = None
+
+    def _schedule_write(self):
+        # Not pushed back by later changes, so steady editing can't postpone it
+        with self.lock:
+            if self.write_timer is None:
+                self.write_timer = Timer(5.0, self.save)
+                self.write_timer.daemon = True
+                self.write_timer.start()
+
+    def save(self):
+        """Write the changes since the last save, serializing outside the lock searches use"""
+        with self.save_lock:
+            if not self.loaded:
+                self.load()
+            with self.lock:
+                if self.write_timer:
+                    self.write_timer.cancel()
+                    self.write_timer = None
+                if not self.changed and self.log_bytes is not None:
+                    return
+                # Field counts are replaced, never changed in place, so shallow copies are stable
+                changed = {doc_id: dict(self.docs[doc_id]) if doc_id in self.docs else None
+                           for doc_id in self.changed}
+                self.changed = set()
+                self.seq += 1
+                compact = self.log_bytes is None or \
+                    self.log_bytes > max(JOURNAL_COMPACT_MIN_BYTES, self.snapshot_bytes * JOURNAL_COMPACT_RATIO)
+                docs = {doc_id: dict(entry) for doc_id, entry in self.docs.items()} if compact else None
+            try:
+                if compact:
+                    tmp_path = self.path + '.tmp'
+                    with open(tmp_path, 'w') as f:
+                        json.dump({'seq': self.seq, 'docs': docs}, f, separators=(',', ':'))
+                    os.replace(tmp_path, self.path)
+                    if os.path.exists(self.log_path):
+                        os.remove(self.log_path)
+                    self.snapshot_bytes = os.path.getsize(self.path)
+                    self.log_bytes = 0
+                else:
+                    line = pack_record({'seq': self.seq, 'docs': changed})
+                    with open(self.log_path, 'ab') as f:
+                        if f.tell() != self.log_bytes:
+                            # Drop anything past the last good record before appending
+                            f.truncate(self.log_bytes)
+                        f.write(line)
+                    self.log_bytes += len(line)
+            except Exception as e:
+                logger.error(f"Error saving keyword index: {e}")
+                with self.lock:
+                    self.changed.update(changed)
+
+keyword_index = KeywordIndex(os.path.join(INDEX_DIR, 'keywords.json'))
+keyword_index_lock = Lock()
+
 # ============================
 # Configuration Functions
 # ============================
@@ -283,82 +1112,1188 @@ def schedule_settings_write():
 # Load configuration at app startup
 config = load_config()
 
+# Vectors from another embeddings model can't be compared with new queries
+if vector_store.model is None:
+    vector_store.model = config['embeddings_model']
+elif vector_store.model != config['embeddings_model']:
+    logger.warning(f"Vector store was built with {vector_store.model}, discarding it for "
+                   f"{config['embeddings_model']}. Run `python app.py reindex` to rebuild embeddings.")
+    vector_store.reset(config['embeddings_model'])
+
 # ============================
 # Document Management Functions
 # ============================
 
+class DocumentCache:
+    """LRU cache of parsed documents bounded by an approximate memory budget
+
+    Documents are loaded lazily and the least recently used ones are dropped
+    once the budget is exceeded. Documents with unsaved changes are never
+    evicted; they become evictable once written to disk. Listing reads the
+    manifest instead, so it never needs the full documents.
+    """
+
+    def __init__(self, budget_bytes):
+        self.lock = Lock()
+        self.budget = budget_bytes
+        self.entries = OrderedDict()  # doc_id -> document, least recently used first
+        self.sizes = {}
+        self.total_size = 0
+        self.dirty = {}  # doc_id -> change counter, for documents not yet written
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, doc_id):
+        return doc_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _sizeof(document):
+        return 512 + sum(sys.getsizeof(value) for value in document.values() if isinstance(value, str))
+
+    def get(self, doc_id):
+        """Get a cached document and mark it as recently used"""
+        with self.lock:
+            document = self.entries.get(doc_id)
+            if document is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(doc_id)
+            self.hits += 1
+            return document
+
+    def peek(self, doc_id):
+        """Get a cached document without touching LRU order or counters"""
+        return self.entries.get(doc_id)
+
+    def put(self, doc_id, document):
+        """Add or refresh a document (call again after changing it in place)"""
+        with self.lock:
+            size = self._sizeof(document)
+            self.total_size += size - self.sizes.get(doc_id, 0)
+            self.sizes[doc_id] = size
+            self.entries[doc_id] = document
+            self.entries.move_to_end(doc_id)
+            self._evict()
+
+    def pop(self, doc_id):
+        with self.lock:
+            self.dirty.pop(doc_id, None)
+            self.total_size -= self.sizes.pop(doc_id, 0)
+            return self.entries.pop(doc_id, None)
+
+    def mark_dirty(self, doc_id):
+        with self.lock:
+            self.dirty[doc_id] = self.dirty.get(doc_id, 0) + 1
+
+    def dirty_version(self, doc_id):
+        return self.dirty.get(doc_id)
+
+    def mark_clean(self, doc_id, version):
+        """Mark a document as written, unless it changed again since `version`"""
+        with self.lock:
+            if self.dirty.get(doc_id) == version:
+                self.dirty.pop(doc_id, None)
+                self._evict()
+
+    def _evict(self):
+        # Never evict the most recently used document: it's the one being worked on
+        for doc_id in list(self.entries)[:-1]:
+            if self.total_size <= self.budget:
+                break
+            if doc_id in self.dirty:
+                continue
+            del self.entries[doc_id]
+            self.total_size -= self.sizes.pop(doc_id, 0)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'documents': len(self.entries),
+                'dirty': len(self.dirty),
+                'size_bytes': self.total_size,
+                'budget_bytes': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+documents_cache = DocumentCache(config['document_cache_mb'] * 1024 * 1024)
+
+MANIFEST_TOMBSTONES = 1000  # removals remembered for incremental listings; older clients resync
+MANIFEST_WRITE_DELAY = 5.0  # seconds a manifest change waits, so a burst of writes saves the file once
+MANIFEST_MTIME_SLACK = 2.0  # file times are coarse: files this close to a manifest save are re-read
+
+class DocumentManifest:
+    """Compact listing of every document, kept sorted by updated_at
+
+    Holds one small entry per document (name, timestamps, content size and
+    embedding status) so listing and search never open document files. The
+    in-memory entries follow every change. The file is rewritten atomically
+    at most once per MANIFEST_WRITE_DELAY, however many documents are written
+    meanwhile. It records when it was taken, so at startup anything written
+    after that (by a process that didn't get to save it) is read back in.
+
+    Every change bumps a revision counter, so clients holding a copy of the
+    listing can ask for what changed since the revision they have. Revisions
+    count from the start of the process; the epoch tells clients which run
+    they came from, so after a restart they resync instead.
+    """
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.path = path
+        self.entries = {}  # doc_id -> entry
+        self.order = []  # (updated_at, doc_id), oldest first
+        self.epoch = uuid.uuid4().hex[:12]
+        self.revision = 0
+        self.floor = 0  # changes up to this revision are no longer all remembered
+        self.changelog = OrderedDict()  # doc_id -> revision of its last change, oldest first
+        self.removed = OrderedDict()  # doc_id -> revision it was removed at, oldest first
+        self.saved_at = None  # time the file on disk was taken at
+        self.saved_revision = -1
+        self.save_lock = Lock()  # one file write at a time, newest snapshot wins
+        self.write_timer = None
+
+    def __contains__(self, doc_id):
+        return doc_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, doc_id):
+        entry = self.entries.get(doc_id)
+        return dict(entry) if entry else None
+
+    def ids(self):
+        """Document IDs, most recently updated first"""
+        with self.lock:
+            return [doc_id for _, doc_id in reversed(self.order)]
+
+    def listing(self):
+        """Entries, most recently updated first"""
+        with self.lock:
+            return [dict(self.entries[doc_id]) for _, doc_id in reversed(self.order)]
+
+    def page(self, limit, cursor=None):
+        """Up to `limit` entries, most recently updated first, starting after `cursor`
+
+        The cursor is the (updated_at, doc_id) key of the last entry of the
+        previous page. Returns (entries, next cursor or None, revision).
+        """
+        with self.lock:
+            end = bisect.bisect_left(self.order, cursor) if cursor else len(self.order)
+            start = max(0, end - limit)
+            entries = [dict(self.entries[doc_id]) for _, doc_id in reversed(self.order[start:end])]
+            return entries, (self.order[start] if start > 0 else None), self.revision
+
+    def changes_since(self, revision):
+        """Entries changed and IDs removed after `revision`, newest first
+
+        Returns (changed, removed, current revision), or None if changes that
+        far back are no longer known and the client needs the full listing.
+        """
+        with self.lock:
+            if revision < self.floor or revision > self.revision:
+                return None
+            changed = []
+            for doc_id in reversed(self.changelog):
+                if self.changelog[doc_id] <= revision:
+                    break
+                changed.append(dict(self.entries[doc_id]))
+            removed = []
+            for doc_id in reversed(self.removed):
+                if self.removed[doc_id] <= revision:
+                    break
+                removed.append(doc_id)
+            return changed, removed, self.revision
+
+    def _changed(self, doc_id):
+        self.revision += 1
+        self.changelog[doc_id] = self.revision
+        self.changelog.move_to_end(doc_id)
+        self.removed.pop(doc_id, None)
+
+    def _unlink(self, doc_id):
+        entry = self.entries.pop(doc_id, None)
+        if entry:
+            key = (entry['updated_at'] or '', doc_id)
+            index = bisect.bisect_left(self.order, key)
+            if index < len(self.order) and self.order[index] == key:
+                del self.order[index]
+
+    def upsert(self, doc_id, document):
+        """Refresh a document's entry from the document itself; returns True if it changed"""
+        entry = {
+            'id': doc_id,
+            'name': document.get('name', 'Untitled'),
+            'created_at': document.get('created_at'),
+            'updated_at': document.get('updated_at'),
+            'size': len(document.get('content', '')),
+            'embedded': 'content' in document.get('embedding_slots', {})
+        }
+        with self.lock:
+            if self.entries.get(doc_id) == entry:
+                return False
+            self._unlink(doc_id)
+            self.entries[doc_id] = entry
+            bisect.insort(self.order, (entry['updated_at'] or '', doc_id))
+            self._changed(doc_id)
+            return True
+
+    def reset_embedded(self):
+        """Mark every document as not embedded, e.g. after switching embeddings models"""
+        with self.lock:
+            for doc_id, entry in self.entries.items():
+                if entry['embedded']:
+                    entry['embedded'] = False
+                    self._changed(doc_id)
+
+    def remove(self, doc_id):
+        with self.lock:
+            if doc_id not in self.entries:
+                return
+            self._unlink(doc_id)
+            self.revision += 1
+            self.changelog.pop(doc_id, None)
+            self.removed[doc_id] = self.revision
+            while len(self.removed) > MANIFEST_TOMBSTONES:
+                _, self.floor = self.removed.popitem(last=False)
+
+    def load(self):
+        """Read the manifest file; returns False if there is none yet"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            # Older files were saved with every document write
+            entries, saved_at = data, os.path.getmtime(self.path)
+        else:
+            entries, saved_at = data['entries'], data['saved_at']
+        with self.lock:
+            self.saved_at = saved_at
+            self.entries = {entry['id']: entry for entry in entries}
+            self.order = sorted((entry['updated_at'] or '', entry['id']) for entry in entries)
+            self.changelog = OrderedDict((doc_id, 0) for doc_id in self.entries)
+        return True
+
+    def schedule_save(self):
+        """Save the file within MANIFEST_WRITE_DELAY, once for all changes made meanwhile"""
+        with self.lock:
+            if self.write_timer is None:
+                self.write_timer = Timer(MANIFEST_WRITE_DELAY, self._scheduled_save)
+                self.write_timer.daemon = True
+                self.write_timer.start()
+
+    def _scheduled_save(self):
+        # Taken under write_lock, so no document write is half recorded in it
+        with write_lock:
+            snapshot = self._snapshot()
+        self._write(snapshot)
+
+    def save(self):
+        """Atomically write the manifest file now (call under write_lock once documents are being written)"""
+        self._write(self._snapshot())
+
+    def _snapshot(self):
+        with self.lock:
+            if self.write_timer:
+                self.write_timer.cancel()
+                self.write_timer = None
+            entries = [dict(self.entries[doc_id]) for _, doc_id in reversed(self.order)]
+            return self.revision, time.time(), entries
+
+    def _write(self, snapshot):
+        revision, saved_at, entries = snapshot
+        with self.save_lock:
+            if revision < self.saved_revision:
+                return
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'saved_at': saved_at, 'entries': entries}, f, separators=(',', ':'))
+                os.replace(tmp_path, self.path)
+                self.saved_revision = revision
+                self.saved_at = saved_at
+            except Exception as e:
+                logger.error(f"Error saving document manifest: {e}")
+
 def get_document_path(doc_id):
     """Get the file path for a document"""
     return os.path.join(DOCUMENTS_DIR, f"{doc_id}.json")
 
-def write_document_to_disk(doc_id):
-    """Write a single document to disk"""
-    with write_lock:
-        if doc_id not in documents_cache:
-            return
-        document = documents_cache[doc_id]
-        doc_path = get_document_path(doc_id)
+manifest = DocumentManifest(os.path.join(INDEX_DIR, 'manifest.json'))  # loaded at startup, see load_manifest
+
+JOURNAL_COMPACT_MIN_BYTES = 64 * 1024  # journals smaller than this are never compacted
+JOURNAL_COMPACT_RATIO = 0.5  # compact once the journal reaches this fraction of the snapshot
+SHARED_CONTENT_MIN_CHARS = 4096  # shorter documents are duplicated by copying their content
+
+class ContentBlobStore:
+    """Content-addressed storage for text shared between documents
+
+    Duplicating a document doesn't copy its content: the text is stored once
+    as content/.blobs/<sha256>, and the snapshots of the original and the
+    copy both refer to it (content_blob) instead of containing it. Edits are
+    journaled on top of the shared text as usual. A document gets a private
+    copy of its text when its journal is next compacted, and lets go of the
+    blob then.
+
+    Next to each blob, <sha256>.refs lists the documents referring to it. A
+    document is added before its snapshot refers to the blob and removed
+    only after its snapshot no longer does, so after a crash the list may
+    name a document too many but never one too few. At startup every listed
+    document's snapshot is checked, and a blob is deleted once no snapshot
+    refers to it.
+    """
+
+    def __init__(self, directory):
+        self.lock = Lock()
+        self.directory = directory
+        self.refs = {}  # digest -> IDs of the documents referring to it
+        self.owners = {}  # doc_id -> digest of the blob it refers to
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    @staticmethod
+    def _refers(doc_id, digest):
+        """Whether a document's snapshot on disk refers to a blob"""
         try:
-            with open(doc_path, 'w') as f:
-                json.dump(document, f, indent=2)
-            document_last_write[doc_id] = datetime.datetime.now()
-            logger.info(f"Document {doc_id} saved to disk")
+            with open(get_document_path(doc_id), 'r') as f:
+                return json.load(f).get('content_blob') == digest
+        except FileNotFoundError:
+            return False
         except Exception as e:
-            logger.error(f"Error saving document {doc_id} to disk: {e}")
+            # Keep the blob rather than guess
+            logger.error(f"Error checking blob reference of document {doc_id}: {e}")
+            return True
 
-def schedule_document_write(doc_id, force_max_delay=False):
-    """Schedule a write for a specific document with 2s/30s logic"""
-    import time
-    
-    # Cancel existing timer for this document
-    if doc_id in document_write_timers:
-        document_write_timers[doc_id].cancel()
-    
-    # Check if we need to force write due to 30s max delay
-    last_write = document_last_write.get(doc_id)
-    now = datetime.datetime.now()
-    
-    if last_write and force_max_delay:
-        time_since_write = (now - last_write).total_seconds()
-        if time_since_write >= WRITE_DELAY_MAX:
-            # Force immediate write
-            write_document_to_disk(doc_id)
+    def _write_refs(self, digest):
+        refs_path = self.path(digest) + '.refs'
+        tmp_path = refs_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(self.refs[digest]), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, refs_path)
+
+    def _delete(self, digest):
+        for path in (self.path(digest), self.path(digest) + '.refs'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load(self):
+        """Read the reference lists, check them against the snapshots and delete unused blobs"""
+        listed = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+            elif entry.name.endswith('.refs'):
+                with open(entry.path, 'r') as f:
+                    listed[entry.name[:-len('.refs')]] = set(json.load(f))
+        
+        with self.lock:
+            self.refs, self.owners = {}, {}
+            for digest, doc_ids in listed.items():
+                live = {doc_id for doc_id in doc_ids if self._refers(doc_id, digest)}
+                if not live:
+                    self._delete(digest)
+                    continue
+                self.refs[digest] = live
+                self.owners.update((doc_id, digest) for doc_id in live)
+                if live != doc_ids:
+                    self._write_refs(digest)
+            # A blob without a reference list was stored but never referred to
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.refs') and entry.name not in self.refs:
+                    os.remove(entry.path)
+
+    def put(self, content):
+        """Store text unless it is already stored; returns its digest"""
+        data = content.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        return digest
+
+    def read(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def acquire(self, digest, doc_id):
+        """Record that a document is about to refer to a blob"""
+        with self.lock:
+            doc_ids = self.refs.setdefault(digest, set())
+            self.owners[doc_id] = digest
+            if doc_id not in doc_ids:
+                doc_ids.add(doc_id)
+                self._write_refs(digest)
+
+    def release(self, digest, doc_id):
+        """Record that a document no longer refers to a blob, deleting it with its last reference"""
+        if not digest:
             return
-    
-    # Schedule write after 2s of inactivity
-    timer = Timer(WRITE_DELAY_TYPING, write_document_to_disk, args=[doc_id])
-    document_write_timers[doc_id] = timer
-    timer.start()
+        with self.lock:
+            if self.owners.get(doc_id) == digest:
+                del self.owners[doc_id]
+            doc_ids = self.refs.get(digest)
+            if doc_ids is None:
+                return
+            doc_ids.discard(doc_id)
+            if doc_ids:
+                self._write_refs(digest)
+            else:
+                del self.refs[digest]
+                self._delete(digest)
 
-def load_document(doc_id):
-    """Load a document from cache or disk"""
-    # Check cache first
-    if doc_id in documents_cache:
-        logger.info(f"Document {doc_id} loaded from cache")
-        return documents_cache[doc_id]
-    
-    # Load from disk if not in cache
-    doc_path = get_document_path(doc_id)
-    if not os.path.exists(doc_path):
-        logger.warning(f"Document {doc_id} not found")
-        return None
-    
-    try:
+    def release_document(self, doc_id):
+        self.release(self.owners.get(doc_id), doc_id)
+
+blob_store = ContentBlobStore(os.path.join(DOCUMENTS_DIR, '.blobs'))
+
+def diff_content(old, new):
+    """Describe a content change as one splice op by trimming the common prefix and suffix"""
+    limit = min(len(old), len(new))
+    # Binary search with slice comparisons keeps the scanning in C
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[low:mid] == new[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    prefix = low
+    low, high = 0, limit - prefix
+    while low < high:
+        mid = (low + high + 1) // 2
+        if old[len(old) - mid:len(old) - low] == new[len(new) - mid:len(new) - low]:
+            low = mid
+        else:
+            high = mid - 1
+    suffix = low
+    return [prefix, len(old) - prefix - suffix, new[prefix:len(new) - suffix]]
+
+def pack_record(record):
+    """Encode a record as one line of an append-only log, prefixed with its CRC"""
+    payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+def parse_records(data):
+    """Parse log bytes into records; returns (records, valid_length)"""
+    records = []
+    position = 0
+    while position < len(data):
+        end = data.find(b'\n', position)
+        if end == -1:
+            break
+        line = data[position:end]
+        try:
+            checksum, payload = line.split(b' ', 1)
+            if int(checksum, 16) != zlib.crc32(payload):
+                break
+            records.append(json.loads(payload))
+        except ValueError:
+            break
+        position = end + 1
+    return records, position
+
+class DocumentJournal:
+    """Append-only edit log per document on top of an atomic snapshot
+
+    A document lives in its snapshot (content/<id>.json) plus a journal
+    (content/<id>.journal) of the changes made since. Each write appends a
+    single record with every edit since the previous write (content splices
+    and changed fields). Appends are group-committed: the caller writes a
+    batch of documents, then commit() fsyncs each journal written once.
+    When the journal grows past a share of the snapshot it is compacted: a
+    new snapshot is written to a temp file and renamed over the old one.
+    Records are numbered, and the snapshot remembers the last number it
+    includes (journal_seq), so replay skips anything already compacted. Each
+    line carries a CRC so a torn append is detected and dropped.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending_ops = {}  # doc_id -> content splices not yet written
+        self.persisted = {}  # doc_id -> what is on disk: fields, seq, blob, sizes
+        self.unsynced = set()  # journal paths appended to since the last commit
+
+    def path(self, doc_id):
+        return os.path.join(self.directory, f"{doc_id}.journal")
+
+    @staticmethod
+    def _fields(document):
+        return copy.deepcopy({key: value for key, value in document.items() if key != 'content'})
+
+    def record_edit(self, doc_id, ops):
+        """Remember content splices to write with the document's next record"""
+        self.pending_ops.setdefault(doc_id, []).append(ops)
+
+    def load(self, doc_id):
+        """Read a snapshot and replay its journal; returns the document or None"""
+        replayed = self._replay(doc_id)
+        if replayed is None:
+            return None
+        document, seq, blob, snapshot_bytes, journal_bytes = replayed
+        self.pending_ops.pop(doc_id, None)
+        self.persisted[doc_id] = {
+            'fields': self._fields(document),
+            'seq': seq,
+            'blob': blob,
+            'journal_bytes': journal_bytes,
+            'snapshot_bytes': snapshot_bytes
+        }
+        return document
+
+    def read(self, doc_id):
+        """Like load, for a read-only copy: the journal's write state is left alone"""
+        replayed = self._replay(doc_id)
+        return replayed[0] if replayed else None
+
+    def _replay(self, doc_id):
+        doc_path = get_document_path(doc_id)
+        if not os.path.exists(doc_path):
+            return None
         with open(doc_path, 'r') as f:
             document = json.load(f)
-            # Add to cache
-            documents_cache[doc_id] = document
-            logger.info(f"Document {doc_id} loaded from disk and cached")
-            return document
-    except Exception as e:
-        logger.error(f"Error loading document {doc_id}: {e}")
-        return None
+        snapshot_bytes = os.path.getsize(doc_path)
+        # Storage state, not part of the document
+        blob = document.pop('content_blob', None)
+        if blob:
+            document['content'] = blob_store.read(blob)
+            snapshot_bytes += blob_store.size(blob)
+        
+        seq = document.pop('journal_seq', 0)
+        journal_bytes = 0
+        journal_path = self.path(doc_id)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rb') as f:
+                data = f.read()
+            records, journal_bytes = parse_records(data)
+            for record in records:
+                if record['seq'] <= seq:
+                    continue
+                for key, value in record.get('set', {}).items():
+                    document[key] = value
+                for key in record.get('unset', []):
+                    document.pop(key, None)
+                for ops in record.get('ops', []):
+                    document['content'] = apply_content_patch(document.get('content', ''), ops)
+                seq = record['seq']
+            if records:
+                logger.info(f"Replayed {len(records)} journal records for document {doc_id}")
+        return document, seq, blob, snapshot_bytes, journal_bytes
+
+    def blob_of(self, doc_id):
+        """The blob a loaded document's snapshot refers to, if any"""
+        state = self.persisted.get(doc_id)
+        return state['blob'] if state else None
+
+    def write(self, doc_id, document):
+        """Persist a document's changes since its last write (call under write_lock)
+
+        The splices and fields are taken together under edit_lock, so an edit
+        made while the record is written stays pending for the next one.
+        """
+        with edit_lock:
+            ops = self.pending_ops.pop(doc_id, None)
+            fields = self._fields(document)
+            content = document.get('content', '')
+        state = self.persisted.get(doc_id)
+        try:
+            if state is None or state.get('stale') or \
+                    (ops is None and fields.get('version', 0) != state['fields'].get('version', 0)):
+                # Nothing on disk to build on, or a content change we have no splices for
+                return self._snapshot(doc_id, fields, content)
+            self._append(doc_id, state, fields, content, ops)
+        except Exception:
+            if state is not None:
+                # The splices taken above are lost: the next write starts a new snapshot
+                state['stale'] = True
+            raise
+
+    def _append(self, doc_id, state, fields, content, ops):
+        record = {'seq': state['seq'] + 1}
+        changed = {key: value for key, value in fields.items()
+                   if key not in state['fields'] or state['fields'][key] != value}
+        if changed:
+            record['set'] = changed
+        removed = [key for key in state['fields'] if key not in fields]
+        if removed:
+            record['unset'] = removed
+        if ops:
+            record['ops'] = ops
+        if len(record) == 1:
+            return
+        
+        line = pack_record(record)
+        threshold = max(JOURNAL_COMPACT_MIN_BYTES, state['snapshot_bytes'] * JOURNAL_COMPACT_RATIO)
+        if state['journal_bytes'] + len(line) > threshold:
+            return self._snapshot(doc_id, fields, content)
+        
+        journal_path = self.path(doc_id)
+        with open(journal_path, 'ab') as f:
+            if f.tell() != state['journal_bytes']:
+                # Drop anything past the last good record before appending
+                f.truncate(state['journal_bytes'])
+            f.write(line)
+        self.unsynced.add(journal_path)
+        state['fields'] = fields
+        state['seq'] = record['seq']
+        state['journal_bytes'] += len(line)
+
+    def compact(self, doc_id, document, blob=None):
+        """Write a full snapshot and start a new journal (call under write_lock and edit_lock)
+
+        With `blob`, the snapshot refers to that stored copy of the content
+        instead of containing it. Otherwise a document that referred to a
+        blob gets its own copy of the text here.
+        """
+        self.pending_ops.pop(doc_id, None)
+        self._snapshot(doc_id, self._fields(document), document.get('content', ''), blob)
+
+    def _snapshot(self, doc_id, fields, content, blob=None):
+        state = self.persisted.get(doc_id)
+        seq = state['seq'] if state else 0
+        previous = state['blob'] if state else None
+        snapshot = dict(fields, journal_seq=seq)
+        if blob:
+            if blob != previous:
+                blob_store.acquire(blob, doc_id)
+            snapshot['content_blob'] = blob
+            write_document_file(doc_id, snapshot)
+            snapshot_bytes = os.path.getsize(get_document_path(doc_id)) + blob_store.size(blob)
+        else:
+            snapshot['content'] = content
+            write_document_file(doc_id, snapshot)
+            snapshot_bytes = os.path.getsize(get_document_path(doc_id))
+        if previous != blob:
+            blob_store.release(previous, doc_id)
+        journal_path = self.path(doc_id)
+        self.unsynced.discard(journal_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.persisted[doc_id] = {
+            'fields': fields,
+            'seq': seq,
+            'blob': blob,
+            'journal_bytes': 0,
+            'snapshot_bytes': snapshot_bytes
+        }
+
+    def remove(self, doc_id):
+        self.pending_ops.pop(doc_id, None)
+        self.persisted.pop(doc_id, None)
+        journal_path = self.path(doc_id)
+        self.unsynced.discard(journal_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+    def commit(self):
+        """fsync the journals written since the last commit, once each (call under write_lock)"""
+        for journal_path in self.unsynced:
+            try:
+                fd = os.open(journal_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except Exception as e:
+                logger.error(f"Error syncing journal {journal_path}: {e}")
+        self.unsynced.clear()
+
+    def recover(self):
+        """Clean up after a crash: truncate torn journal tails and drop leftovers"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json.tmp'):
+                os.remove(entry.path)
+            elif entry.name.endswith('.loom'):
+                if not os.path.exists(get_document_path(entry.name[:-len('.loom')])):
+                    os.remove(entry.path)
+            elif entry.name.endswith('.journal'):
+                doc_id = entry.name[:-len('.journal')]
+                if not os.path.exists(get_document_path(doc_id)):
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, 'rb') as f:
+                    data = f.read()
+                _, valid_length = parse_records(data)
+                if valid_length < len(data):
+                    logger.warning(f"Truncating torn journal for document {doc_id}")
+                    with open(entry.path, 'r+b') as f:
+                        f.truncate(valid_length)
+
+document_journal = DocumentJournal(DOCUMENTS_DIR)
+
+LOOM_CACHE_MAX = 32  # document looms kept in memory
+LOOM_TEXT_CACHE = 8  # reconstructed node texts kept per loom
+LOOM_PREVIEW_CHARS = 80  # characters of each node's own text shown in loom listings
+
+class DocumentLoom:
+    """Tree of a document's generations, each node stored as a delta over its parent
+
+    A node stands for one full text of the document: the text a generation
+    continued, each completion of it, and edits made before switching
+    branches. Nodes are content-addressed, named by the hash of their text,
+    so the same text reached twice is one node and finding the node for a
+    text is a lookup. A node stores only the splice that turns its parent's
+    text into its own ([offset, delete_count, insert_text], as in the
+    journal), so only the root holds a full text and a reroll costs about
+    the size of its completion.
+
+    Reconstructing a node applies the splices on its path from the nearest
+    cached ancestor, O(depth). The texts of recently used nodes are cached,
+    so switching to a sibling is a single splice. Nodes are appended to
+    content/<id>.loom, one checksummed line each.
+    """
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.path = path
+        self.nodes = {}  # node_id -> {'id', 'parent', 'op', 'created_at'}
+        self.children = {}  # node_id (None for roots) -> child IDs, oldest first
+        self.texts = OrderedDict()  # node_id -> text, most recently used last
+        self._load()
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        records, valid_length = parse_records(data)
+        for node in records:
+            self._index(node)
+        if valid_length < len(data):
+            logger.warning(f"Truncating torn loom {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_length)
+
+    def _index(self, node):
+        self.nodes[node['id']] = node
+        self.children.setdefault(node['parent'], []).append(node['id'])
+
+    def _cache(self, node_id, text):
+        self.texts[node_id] = text
+        self.texts.move_to_end(node_id)
+        while len(self.texts) > LOOM_TEXT_CACHE:
+            self.texts.popitem(last=False)
+
+    def find(self, text):
+        """The node for a text, or None"""
+        node_id = self.digest(text)
+        return node_id if node_id in self.nodes else None
+
+    def text(self, node_id):
+        """Reconstruct the full text of a node"""
+        with self.lock:
+            return self._text(node_id)
+
+    def _text(self, node_id):
+        path = []
+        ancestor = node_id
+        while ancestor is not None and ancestor not in self.texts:
+            path.append(ancestor)
+            ancestor = self.nodes[ancestor]['parent']
+        text = self.texts[ancestor] if ancestor is not None else ''
+        for step in reversed(path):
+            text = apply_content_patch(text, [self.nodes[step]['op']])
+        self._cache(node_id, text)
+        return text
+
+    def add(self, text, parent=None, op=None):
+        """The node for `text`, added under `parent` if it is new
+
+        `op` is the splice from the parent's text to `text`, when the caller
+        knows it; otherwise it is worked out from the two texts.
+        """
+        node_id = self.digest(text)
+        with self.lock:
+            if node_id in self.nodes:
+                return node_id
+            if parent not in self.nodes:
+                parent = None
+            if op is None:
+                op = diff_content(self._text(parent) if parent else '', text)
+            node = {
+                'id': node_id,
+                'parent': parent,
+                'op': op,
+                'created_at': datetime.datetime.now().isoformat()
+            }
+            with open(self.path, 'ab') as f:
+                f.write(pack_record(node))
+                f.flush()
+                os.fsync(f.fileno())
+            self._index(node)
+            self._cache(node_id, text)
+        return node_id
+
+    def siblings(self, node_id):
+        """IDs of a node and its siblings, oldest first"""
+        return self.children.get(self.nodes[node_id]['parent'], [])
+
+    def completion_start(self, node_id):
+        """Where a node's own text starts, if it was added at the end of its parent's, else -1"""
+        node = self.nodes[node_id]
+        offset, delete_count, insert_text = node['op']
+        if node['parent'] is None or delete_count or not insert_text:
+            return -1
+        return offset
+
+    def listing(self):
+        """Every node, oldest first, with a preview of the text it adds"""
+        with self.lock:
+            nodes = list(self.nodes.values())
+        return [{
+            'id': node['id'],
+            'parent': node['parent'],
+            'created_at': node['created_at'],
+            'offset': node['op'][0],
+            'deleted': node['op'][1],
+            'inserted': len(node['op'][2]),
+            'preview': node['op'][2][:LOOM_PREVIEW_CHARS]
+        } for node in nodes]
+
+looms = OrderedDict()  # doc_id -> DocumentLoom, most recently used last
+looms_lock = Lock()
+
+def get_loom_path(doc_id):
+    return os.path.join(DOCUMENTS_DIR, f"{doc_id}.loom")
+
+def get_loom(doc_id):
+    """Get a document's loom, reading it from disk if it isn't in memory"""
+    with looms_lock:
+        loom = looms.get(doc_id)
+        if loom is None:
+            loom = DocumentLoom(get_loom_path(doc_id))
+            looms[doc_id] = loom
+            while len(looms) > LOOM_CACHE_MAX:
+                looms.popitem(last=False)
+        looms.move_to_end(doc_id)
+        return loom
+
+def remove_loom(doc_id):
+    with looms_lock:
+        looms.pop(doc_id, None)
+    loom_path = get_loom_path(doc_id)
+    if os.path.exists(loom_path):
+        os.remove(loom_path)
+
+def set_document_embedding(doc_id, document, kind, vector):
+    """Store a document's 'content' or 'name' vector, keeping only its slot in the document"""
+    # Replace rather than mutate the slots dict: a writer thread may be serializing it
+    slots = dict(document.get('embedding_slots', {}))
+    key = f"{doc_id}:{kind}"
+    if vector is None:
+        vector_store.release(key)
+        slots.pop(kind, None)
+    else:
+        try:
+            slots[kind] = vector_store.put(key, vector)
+        except Exception as e:
+            logger.error(f"Error storing {kind} embedding for document {doc_id}: {e}")
+            vector = None
+            slots.pop(kind, None)
+    document['embedding_slots'] = slots
+    if kind == 'content':
+        embedding_index.upsert(doc_id, content_embedding=vector, update_name=False)
+    else:
+        embedding_index.upsert(doc_id, name_embedding=vector, update_content=False)
+
+def get_document_embedding(doc_id, kind):
+    """Get a zero-copy view of a document's stored vector, or None"""
+    return vector_store.get(vector_store.slot_of(f"{doc_id}:{kind}"))
+
+def delete_document_embeddings(doc_id):
+    """Free a document's vector slots and release its passages"""
+    for kind in ('content', 'name'):
+        vector_store.release(f"{doc_id}:{kind}")
+    vector_store.set_layout(doc_id, [])
+    embedding_index.remove(doc_id)
+
+def plan_document_chunks(content):
+    """Chunk content and find which passages still need an embedding
+
+    Returns (layout, missing) where layout is the document's chunk list and
+    missing maps chunk hashes without a stored vector to their text.
+    """
+    layout = []
+    missing = {}
+    utf16_offset = 0
+    for start, end in split_into_chunks(content):
+        text = content[start:end]
+        utf16_length = len(text.encode('utf-16-le')) // 2
+        if text.strip():
+            digest = chunk_hash(text)
+            layout.append([digest, start, end - start, utf16_offset, utf16_length])
+            if f"chunk:{digest}" not in vector_store:
+                missing[digest] = text
+        utf16_offset += utf16_length
+    return layout, missing
+
+def apply_document_chunks(doc_id, document, layout):
+    """Install a chunk layout whose passage vectors are all stored
+
+    The document-level vector is the length-weighted mean of its passages.
+    """
+    vector_store.set_layout(doc_id, layout)
+    passages = []
+    weighted_sum = None
+    for digest, _, length, utf16_start, utf16_length in layout:
+        vector = vector_store.get_key(f"chunk:{digest}")
+        if vector is None:
+            continue
+        passages.append((vector, utf16_start, utf16_length))
+        unit = EmbeddingIndex.normalize(vector)
+        weighted_sum = unit * length if weighted_sum is None else weighted_sum + unit * length
+    
+    set_document_embedding(doc_id, document, 'content', weighted_sum)
+    embedding_index.set_passages(doc_id, passages)
+
+def embed_document_content(doc_id, document):
+    """Embed a document's content passage by passage
+
+    Content is split into content-defined chunks and each chunk's vector is
+    cached in the vector store under its hash, so only chunks that an edit
+    actually touched are sent to the model.
+    """
+    layout, missing = plan_document_chunks(document.get('content', ''))
+    if missing:
+        vectors = calculate_chunk_embeddings(list(missing.values()))
+        if vectors is None:
+            return False
+        for digest, vector in zip(missing.keys(), vectors):
+            vector_store.put(f"chunk:{digest}", vector)
+    logger.debug(f"Embedded {len(missing)} of {len(layout)} passages for document {doc_id}")
+    apply_document_chunks(doc_id, document, layout)
+    return True
+
+class IndexWorker:
+    """Background thread that updates search indexes off the request path
+
+    Work is coalesced per document: submitting a document that is already
+    queued only records what needs refreshing ('content' and 'name' vectors,
+    'keywords'), and the worker always indexes the latest version.
+    Until then search keeps using the document's last good entries.
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.pending = OrderedDict()  # doc_id -> set of kinds
+        self.active = None  # doc_id being embedded right now
+        self.active_kinds = set()
+        self.thread = None
+
+    def submit(self, doc_id, *kinds):
+        with self.condition:
+            self.pending.setdefault(doc_id, set()).update(kinds)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name='index-worker', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def is_pending(self, doc_id):
+        return doc_id in self.pending or doc_id == self.active
+
+    def pending_ids(self, *kinds):
+        """IDs of documents with any of these kinds of work queued or running"""
+        with self.condition:
+            ids = {doc_id for doc_id, queued in self.pending.items() if not queued.isdisjoint(kinds)}
+            if self.active and not self.active_kinds.isdisjoint(kinds):
+                ids.add(self.active)
+            return ids
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                doc_id, kinds = self.pending.popitem(last=False)
+                self.active = doc_id
+                self.active_kinds = kinds
+            try:
+                self._index(doc_id, kinds)
+            except Exception as e:
+                logger.error(f"Error indexing document {doc_id}: {e}")
+            finally:
+                with self.condition:
+                    self.active = None
+                    self.active_kinds = set()
+
+    def _index(self, doc_id, kinds):
+        document = load_document(doc_id)
+        if document is None:
+            return
+        if 'keywords' in kinds:
+            keyword_index.update(doc_id, content=document.get('content', ''), name=document.get('name', ''))
+        if 'name' in kinds:
+            set_document_embedding(doc_id, document, 'name', calculate_text_embedding(document.get('name', '')))
+        if 'content' in kinds:
+            embed_document_content(doc_id, document)
+        # The document may have been deleted while we were indexing it
+        if doc_id not in manifest:
+            delete_document_embeddings(doc_id)
+            keyword_index.remove(doc_id)
+        elif 'content' in kinds:
+            # Embedding status is saved with the document's next write
+            manifest.upsert(doc_id, document)
+        logger.debug(f"Indexed {', '.join(sorted(kinds))} for document {doc_id}")
+
+index_worker = IndexWorker()
+
+def migrate_document_embeddings(doc_id, document):
+    """Move inline JSON embeddings from older documents into the vector store
+
+    Returns True if the document was changed and should be rewritten.
+    """
+    migrated = False
+    for kind in ('content', 'name'):
+        field = f"{kind}_embedding"
+        if field in document:
+            vector = document.pop(field)
+            set_document_embedding(doc_id, document, kind, vector if vector else None)
+            migrated = True
+    return migrated
+
+def write_document_file(doc_id, document):
+    """Atomically replace a document's JSON snapshot file"""
+    doc_path = get_document_path(doc_id)
+    tmp_path = doc_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(document, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, doc_path)
+
+def persist_document(doc_id):
+    """Write a cached document's changes, leaving the manifest file to the caller
+
+    Call under write_lock. Returns True if the document was written.
+    """
+    document = documents_cache.peek(doc_id)
+    if document is None:
+        return False
+    version = documents_cache.dirty_version(doc_id)
+    try:
+        document_journal.write(doc_id, document)
+        documents_cache.mark_clean(doc_id, version)
+        manifest.upsert(doc_id, document)
+        document_last_write[doc_id] = datetime.datetime.now()
+        logger.info(f"Document {doc_id} saved to disk")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving document {doc_id} to disk: {e}")
+        return False
+
+def write_document_to_disk(doc_id):
+    """Write a single document to disk"""
+    with write_lock:
+        if persist_document(doc_id):
+            document_journal.commit()
+            manifest.schedule_save()
+
+def schedule_document_write(doc_id, force_max_delay=False):
+    """Schedule a write for a specific document with 2s/30s logic"""
+    import time
+    
+    # Keep the document in memory until it has been written
+    documents_cache.mark_dirty(doc_id)
+    
+    # Cancel existing timer for this document
+    if doc_id in document_write_timers:
+        document_write_timers[doc_id].cancel()
+    
+    # Check if we need to force write due to 30s max delay
+    last_write = document_last_write.get(doc_id)
+    now = datetime.datetime.now()
+    
+    if last_write and force_max_delay:
+        time_since_write = (now - last_write).total_seconds()
+        if time_since_write >= WRITE_DELAY_MAX:
+            # Write now, on the timer's thread: the caller may hold edit_lock
+            timer = Timer(0, write_document_to_disk, args=[doc_id])
+            document_write_timers[doc_id] = timer
+            timer.start()
+            return
+    
+    # Schedule write after 2s of inactivity
+    timer = Timer(WRITE_DELAY_TYPING, write_document_to_disk, args=[doc_id])
+    document_write_timers[doc_id] = timer
+    timer.start()
+
+def load_document(doc_id):
+    """Load a document from cache or disk"""
+    # Check cache first
+    document = documents_cache.get(doc_id)
+    if document is not None:
+        logger.info(f"Document {doc_id} loaded from cache")
+        return document
+    
+    # Load from disk if not in cache
+    try:
+        with load_lock:
+            # Another request may have loaded it meanwhile: edits must all go to that copy
+            document = documents_cache.peek(doc_id)
+            if document is not None:
+                return document
+            document = document_journal.load(doc_id)
+            if document is None:
+                logger.warning(f"Document {doc_id} not found")
+                return None
+            # Add to cache
+            documents_cache.put(doc_id, document)
+        if migrate_document_embeddings(doc_id, document):
+            if document.get('content') and not vector_store.get_layout(doc_id):
+                index_worker.submit(doc_id, 'content')
+            schedule_document_write(doc_id)
+        logger.info(f"Document {doc_id} loaded from disk and cached")
+        return document
+    except Exception as e:
+        logger.error(f"Error loading document {doc_id}: {e}")
+        return None
+
+def peek_document(doc_id):
+    """Get a document from the cache or disk without caching it, for bulk reads"""
+    document = documents_cache.peek(doc_id)
+    if document is not None or doc_id not in manifest:
+        return document
+    try:
+        return document_journal.read(doc_id)
+    except Exception as e:
+        logger.error(f"Error reading document {doc_id}: {e}")
+        return None
 
 def save_document(doc_id, document, schedule_write=True):
     """Save a document to cache and optionally schedule disk write"""
     try:
-        # Update cache
-        documents_cache[doc_id] = document
+        # Update cache and listing
+        documents_cache.put(doc_id, document)
+        manifest.upsert(doc_id, document)
         # Schedule write to disk if requested
         if schedule_write:
             schedule_document_write(doc_id, force_max_delay=True)
@@ -368,60 +2303,205 @@ def save_document(doc_id, document, schedule_write=True):
         logger.error(f"Error saving document {doc_id}: {e}")
         return False
 
+def _delete_document_files(doc_id):
+    """Drop a document from memory, indexes and disk (call under write_lock)"""
+    # Remove from cache
+    documents_cache.pop(doc_id)
+    reroll_prefetcher.discard(doc_id)
+    delete_document_embeddings(doc_id)
+    keyword_index.remove(doc_id)
+    
+    # Remove from disk
+    doc_path = get_document_path(doc_id)
+    if os.path.exists(doc_path):
+        try:
+            os.remove(doc_path)
+            document_journal.remove(doc_id)
+            remove_loom(doc_id)
+            blob_store.release_document(doc_id)
+            manifest.remove(doc_id)
+            logger.info(f"Document {doc_id} deleted successfully")
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting document {doc_id}: {e}")
+    return False
+
+def _rename_document(doc_id, name, now):
+    """Rename a document and write it straight away (call under write_lock)"""
+    document = load_document(doc_id)
+    if not document:
+        return False
+    document['name'] = name
+    document['updated_at'] = now
+    documents_cache.put(doc_id, document)
+    documents_cache.mark_dirty(doc_id)
+    # Recalculate name embedding and keywords in the background
+    index_worker.submit(doc_id, 'name', 'keywords')
+    return persist_document(doc_id)
+
+def apply_document_batch(delete_ids=(), renames=None):
+    """Delete and rename several documents as one change
+
+    Everything happens under one hold of write_lock, followed by a single
+    manifest write and at most one config write, however many documents are
+    involved. Returns (deleted IDs, renamed IDs).
+    """
+    delete_ids = list(dict.fromkeys(delete_ids))
+    now = datetime.datetime.now().isoformat()
+    with write_lock:
+        renamed = [doc_id for doc_id, name in (renames or {}).items()
+                   if name and doc_id not in delete_ids and doc_id in manifest and _rename_document(doc_id, name, now)]
+        deleted = [doc_id for doc_id in delete_ids if doc_id in manifest and _delete_document_files(doc_id)]
+        if renamed or deleted:
+            document_journal.commit()
+            manifest.schedule_save()
+        if config['current_document'] in deleted:
+            remaining = manifest.ids()
+            config['current_document'] = remaining[0] if remaining else None
+            save_config(config)
+    return deleted, renamed
+
 def delete_document(doc_id):
     """Delete a document from cache and disk"""
-    with write_lock:
-        # Remove from cache
-        if doc_id in documents_cache:
-            del documents_cache[doc_id]
-        
-        # Remove from disk
-        doc_path = get_document_path(doc_id)
-        if os.path.exists(doc_path):
-            try:
-                os.remove(doc_path)
-                # Update config
-                if doc_id in config['documents']:
-                    config['documents'].remove(doc_id)
-                if config['current_document'] == doc_id:
-                    config['current_document'] = None if not config['documents'] else config['documents'][0]
-                save_config(config)
-                logger.info(f"Document {doc_id} deleted successfully")
-                return True
-            except Exception as e:
-                logger.error(f"Error deleting document {doc_id}: {e}")
-        return False
+    deleted, _ = apply_document_batch([doc_id])
+    return bool(deleted)
+
+EMPTY_UNTITLED_SCAN_MAX = 4096  # longer Untitled documents aren't read to check for whitespace-only content
+GC_MIN_AGE = 600  # seconds an empty Untitled document is left alone by the background sweep
+
+def find_empty_untitled_documents(min_age=0, exclude=()):
+    """IDs of documents named "Untitled" whose content is empty or whitespace"""
+    cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=min_age)).isoformat() if min_age else None
+    found = []
+    for entry in manifest.listing():
+        if entry['name'] != 'Untitled' or entry['id'] in exclude:
+            continue
+        if cutoff and (entry['updated_at'] or '') > cutoff:
+            continue
+        if entry['size'] > EMPTY_UNTITLED_SCAN_MAX:
+            continue
+        if entry['size'] > 0:
+            document = peek_document(entry['id'])
+            if document is None or document.get('content', '').strip():
+                continue
+        found.append(entry['id'])
+    return found
+
+gc_timer = None
+gc_started = False
+
+def schedule_document_gc():
+    """(Re)start the background sweep of empty Untitled documents, every `gc_interval` seconds"""
+    global gc_timer
+    if gc_timer:
+        gc_timer.cancel()
+        gc_timer = None
+    interval = config.get('gc_interval', DEFAULT_CONFIG['gc_interval'])
+    if not interval:
+        return
+
+    def sweep():
+        try:
+            # Leave alone what is open or being generated into, and anything just created
+            exclude = {config.get('current_document')}
+            exclude.update(data.get('document_id') for data in list(active_generations.values()))
+            doc_ids = find_empty_untitled_documents(min_age=GC_MIN_AGE, exclude=exclude)
+            if doc_ids:
+                deleted, _ = apply_document_batch(doc_ids)
+                logger.info(f"Background sweep deleted {len(deleted)} empty Untitled documents")
+        except Exception as e:
+            logger.error(f"Error in background document sweep: {e}")
+        finally:
+            schedule_document_gc()
+
+    gc_timer = Timer(interval, sweep)
+    gc_timer.daemon = True
+    gc_timer.start()
 
 def create_new_document(name="Untitled", content=""):
     """Create a new document with basic structure"""
     doc_id = str(uuid.uuid4())
     now = datetime.datetime.now().isoformat()
     
-    # Calculate embeddings for the document name
-    name_embedding = calculate_text_embedding(name)
-    content_embedding = calculate_text_embedding(content) if content else None
-    
     document = {
         'id': doc_id,
         'name': name,
         'created_at': now,
         'updated_at': now,
         'content': content,
-        'content_embedding': content_embedding,
-        'name_embedding': name_embedding
+        'version': 0,
+        'embedding_slots': {}
     }
     
     # Write immediately since it's a new document
     if save_document(doc_id, document, schedule_write=False):
         write_document_to_disk(doc_id)
-        # Update config and save (new document added to list)
-        if doc_id not in config['documents']:
-            config['documents'].append(doc_id)
+        # Embeddings are computed in the background
+        embedding_index.upsert(doc_id)
+        index_worker.submit(doc_id, 'name', 'content', 'keywords')
         config['current_document'] = doc_id
         save_config(config)
         return doc_id, document
     return None, None
 
+def duplicate_document(doc_id, name=None):
+    """Copy a document without copying its content or its passage vectors
+
+    Longer content moves into a shared blob that the original and the copy
+    both refer to, so the copy costs one small snapshot until either side is
+    compacted after an edit (see ContentBlobStore). Passage vectors are
+    content-addressed already, so the copy's chunks find the original's
+    vectors and only its name is embedded afresh.
+    """
+    source = load_document(doc_id)
+    if not source:
+        return None, None
+    new_id = str(uuid.uuid4())
+    now = datetime.datetime.now().isoformat()
+    
+    # write_lock first, as in document writes: the content can't move under the blob
+    with write_lock, edit_lock:
+        content = source.get('content', '')
+        document = {
+            'id': new_id,
+            'name': name or f"{source.get('name', 'Untitled')} (copy)",
+            'created_at': now,
+            'updated_at': now,
+            'content': content,
+            'version': 0,
+            'embedding_slots': {}
+        }
+        try:
+            if len(content) >= SHARED_CONTENT_MIN_CHARS:
+                digest = blob_store.put(content)
+                if document_journal.blob_of(doc_id) != digest:
+                    # Hand the original's text over to the blob, pending edits included
+                    version = documents_cache.dirty_version(doc_id)
+                    document_journal.compact(doc_id, source, blob=digest)
+                    documents_cache.mark_clean(doc_id, version)
+                    manifest.upsert(doc_id, source)
+                document_journal.compact(new_id, document, blob=digest)
+            else:
+                document_journal.compact(new_id, document)
+        except Exception as e:
+            logger.error(f"Error duplicating document {doc_id}: {e}")
+            return None, None
+        documents_cache.put(new_id, document)
+        manifest.upsert(new_id, document)
+        manifest.schedule_save()
+    
+    embedding_index.upsert(new_id)
+    layout, missing = plan_document_chunks(content)
+    if layout and not missing:
+        apply_document_chunks(new_id, document, layout)
+        schedule_document_write(new_id)
+        index_worker.submit(new_id, 'name', 'keywords')
+    else:
+        # The original's passages aren't all embedded yet
+        index_worker.submit(new_id, 'name', 'content', 'keywords')
+    logger.info(f"Document {doc_id} duplicated as {new_id}")
+    return new_id, document
+
 def update_document_metadata(doc_id, name=None):
     """Update a document's metadata without changing content"""
     document = load_document(doc_id)
@@ -430,8 +2510,8 @@ def update_document_metadata(doc_id, name=None):
     
     if name:
         document['name'] = name
-        # Recalculate name embedding
-        document['name_embedding'] = calculate_text_embedding(name)
+        # Recalculate name embedding and keywords in the background
+        index_worker.submit(doc_id, 'name', 'keywords')
     document['updated_at'] = datetime.datetime.now().isoformat()
     
     if save_document(doc_id, document):
@@ -465,7 +2545,7 @@ def cancel_empty_document_rename(doc_id):
         logger.debug(f"Cancelled empty document rename timer for {doc_id}")
 
 def update_document_content(doc_id, content):
-    """Update a document's content with embedding caching"""
+    """Update a document's content, re-embedding changed passages"""
     document = load_document(doc_id)
     if not document:
         return False, None
@@ -476,8 +2556,66 @@ def update_document_content(doc_id, content):
         logger.debug(f"Content unchanged for document {doc_id}, skipping embedding recalculation")
         return True, document
     
+    with edit_lock:
+        return set_document_content(doc_id, document, content)
+
+class VersionConflict(Exception):
+    """Raised when a patch was made against an outdated document version"""
+
+def apply_content_patch(content, ops):
+    """Apply splice operations to a string in a single pass
+
+    Each op is [offset, delete_count, insert_text] with offsets in code
+    points of the original content; ops must be sorted and not overlap.
+    Unchanged stretches are copied once, straight into the result.
+    """
+    parts = []
+    position = 0
+    for op in ops:
+        if not isinstance(op, (list, tuple)) or len(op) != 3:
+            raise ValueError("Each op must be [offset, delete_count, insert_text]")
+        offset, delete_count, insert_text = op
+        # type() rather than isinstance(): JSON true/false would pass as 1/0
+        if type(offset) is not int or type(delete_count) is not int or not isinstance(insert_text, str):
+            raise ValueError("Invalid op types")
+        if offset < position or delete_count < 0 or offset + delete_count > len(content):
+            raise ValueError("Ops are out of range or overlap")
+        parts.append(content[position:offset])
+        parts.append(insert_text)
+        position = offset + delete_count
+    parts.append(content[position:])
+    return ''.join(parts)
+
+def patch_document_content(doc_id, base_version, ops):
+    """Apply a delta to a document's content
+
+    Raises VersionConflict if the document changed since `base_version` and
+    ValueError if the ops don't fit the content.
+    """
+    document = load_document(doc_id)
+    if not document:
+        return False, None
+    with edit_lock:
+        if document.get('version', 0) != base_version:
+            raise VersionConflict(document.get('version', 0))
+        if not ops:
+            return True, document
+        content = apply_content_patch(document.get('content', ''), ops)
+        return set_document_content(doc_id, document, content, ops)
+
+def set_document_content(doc_id, document, content, ops=None):
+    """Store new content, bump the version and queue re-indexing
+
+    `ops` are the splices that produced the content, if known; they are what
+    gets journaled.
+    """
+    if ops is None:
+        ops = [diff_content(document.get('content', ''), content)]
+    document_journal.record_edit(doc_id, ops)
+    reroll_prefetcher.document_changed(doc_id, content)
     document['content'] = content
     document['updated_at'] = datetime.datetime.now().isoformat()
+    document['version'] = document.get('version', 0) + 1
     
     # Handle empty document rename timer
     if not content.strip():
@@ -485,15 +2623,8 @@ def update_document_content(doc_id, content):
     else:
         cancel_empty_document_rename(doc_id)
     
-    # Only recalculate embedding if content changed significantly
-    # For performance on large docs, skip embedding if only minor changes
-    content_diff = abs(len(content) - len(old_content))
-    if content_diff > 100 or not document.get('content_embedding'):
-        # Recalculate content embedding only if significant change or no existing embedding
-        document['content_embedding'] = calculate_text_embedding(content)
-        logger.debug(f"Recalculated embedding for document {doc_id} (diff: {content_diff} chars)")
-    else:
-        logger.debug(f"Skipped embedding recalculation for document {doc_id} (minor change: {content_diff} chars)")
+    # Re-embed the passages this edit touched and re-index keywords in the background
+    index_worker.submit(doc_id, 'content', 'keywords')
     
     if save_document(doc_id, document):
         return True, document
@@ -501,73 +2632,497 @@ def update_document_content(doc_id, content):
 
 def get_document_metadata(doc_id, include_content=True):
     """Get document metadata with optional content inclusion for performance"""
-    # Check cache first
-    if doc_id in documents_cache:
-        doc = documents_cache[doc_id]
-        metadata = {
-            'id': doc_id,
-            'name': doc.get('name', 'Untitled'),
-            'updated_at': doc.get('updated_at'),
-            'created_at': doc.get('created_at'),
-            'content_embedding': doc.get('content_embedding'),
-            'name_embedding': doc.get('name_embedding')
-        }
-        # Only include content if requested and needed
-        if include_content:
-            content = doc.get('content', '')
-            # For search performance, truncate very large content for keyword search
-            if len(content) > 100000:  # 100KB limit for search
-                metadata['content'] = content[:100000] + "..."
-                metadata['content_truncated'] = True
-            else:
-                metadata['content'] = content
-                metadata['content_truncated'] = False
-        return metadata
-    
-    # Load from disk if not in cache
-    doc_path = get_document_path(doc_id)
-    if not os.path.exists(doc_path):
-        return None
-    
-    try:
-        with open(doc_path, 'r') as f:
-            document = json.load(f)
-            # Add to cache
-            documents_cache[doc_id] = document
-            metadata = {
+    if not include_content:
+        entry = manifest.get(doc_id)
+        if entry:
+            return {
                 'id': doc_id,
-                'name': document.get('name', 'Untitled'),
-                'updated_at': document.get('updated_at'),
-                'created_at': document.get('created_at'),
-                'content_embedding': document.get('content_embedding'),
-                'name_embedding': document.get('name_embedding')
+                'name': entry['name'],
+                'updated_at': entry['updated_at'],
+                'created_at': entry['created_at']
             }
-            if include_content:
-                content = document.get('content', '')
-                if len(content) > 100000:
-                    metadata['content'] = content[:100000] + "..."
-                    metadata['content_truncated'] = True
-                else:
-                    metadata['content'] = content
-                    metadata['content_truncated'] = False
-            return metadata
-    except Exception as e:
-        logger.error(f"Error loading document metadata {doc_id}: {e}")
+    doc = load_document(doc_id)
+    if not doc:
         return None
+    
+    metadata = {
+        'id': doc_id,
+        'name': doc.get('name', 'Untitled'),
+        'updated_at': doc.get('updated_at'),
+        'created_at': doc.get('created_at')
+    }
+    # Only include content if requested and needed
+    if include_content:
+        content = doc.get('content', '')
+        # For search performance, truncate very large content for keyword search
+        if len(content) > 100000:  # 100KB limit for search
+            metadata['content'] = content[:100000] + "..."
+            metadata['content_truncated'] = True
+        else:
+            metadata['content'] = content
+            metadata['content_truncated'] = False
+    return metadata
+
+def listing_fields(entry):
+    """The part of a manifest entry the document list shows"""
+    return {
+        'id': entry['id'],
+        'name': entry['name'],
+        'updated_at': entry['updated_at'],
+        'created_at': entry['created_at']
+    }
 
 def get_all_documents():
-    """Get list of all documents with metadata"""
-    documents = []
-    for doc_id in config['documents']:
-        doc_meta = get_document_metadata(doc_id, include_content=False)  # Don't load content for list view
-        if doc_meta:
-            documents.append({
-                'id': doc_id,
-                'name': doc_meta['name'],
-                'updated_at': doc_meta['updated_at'],
-                'created_at': doc_meta['created_at']
-            })
-    return sorted(documents, key=lambda x: x['updated_at'], reverse=True)
+    """Get list of all documents with metadata, most recently updated first"""
+    return [listing_fields(entry) for entry in manifest.listing()]
+
+def listing_etag():
+    """ETag covering everything the document list shows"""
+    tag = f"{manifest.epoch}:{manifest.revision}:{config.get('current_document') or ''}"
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest()[:20]
+
+def conditional_listing(build_response):
+    """Answer a listing request with 304 if the client's copy is current"""
+    etag = listing_etag()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_response())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def ensure_embedding_index():
+    """Build the embedding index from the vector store on first use"""
+    global embedding_index_ready
+    if embedding_index_ready:
+        return
+    with embedding_index_lock:
+        if embedding_index_ready:
+            return
+        stored = {}
+        for slot, key in vector_store.items():
+            doc_id, kind = key.rsplit(':', 1)
+            if doc_id != 'chunk':
+                stored.setdefault(doc_id, {})[kind] = vector_store.get(slot)
+        
+        known_ids = set(manifest.ids())
+        for doc_id in known_ids:
+            vectors = stored.get(doc_id)
+            if vectors is None:
+                # Not in the store yet: loading migrates any inline embeddings
+                load_document(doc_id)
+                if doc_id not in embedding_index:
+                    embedding_index.upsert(doc_id)
+                continue
+            embedding_index.upsert(doc_id, vectors.get('content'), vectors.get('name'))
+            embedding_index.set_passages(doc_id, [
+                (vector_store.get_key(f"chunk:{digest}"), utf16_start, utf16_length)
+                for digest, _, _, utf16_start, utf16_length in vector_store.get_layout(doc_id)
+            ])
+        
+        # Free vectors left behind by documents that no longer exist
+        for doc_id in (stored.keys() | vector_store.layouts.keys()) - known_ids:
+            delete_document_embeddings(doc_id)
+        for slot, key in vector_store.items():
+            if key.startswith('chunk:') and key[6:] not in vector_store.chunk_refs:
+                vector_store.release(key)
+        
+        embedding_index_ready = True
+        logger.info(f"Embedding index built with {len(embedding_index)} documents")
+
+def ensure_keyword_index():
+    """Load the keyword index on first use and bring it in line with the document list
+
+    From then on document changes keep it current, so this is done once.
+    """
+    if keyword_index.synced:
+        return
+    with keyword_index_lock:
+        if keyword_index.synced:
+            return
+        if not keyword_index.loaded:
+            keyword_index.load()
+        known_ids = set(manifest.ids())
+        indexed_ids = set(keyword_index.doc_ids())
+        for doc_id in known_ids - indexed_ids:
+            document = peek_document(doc_id)
+            if document:
+                keyword_index.update(doc_id, content=document.get('content', ''), name=document.get('name', ''))
+        for doc_id in indexed_ids - known_ids:
+            keyword_index.remove(doc_id)
+        keyword_index.synced = True
+
+def count_keyword_occurrences(query):
+    """Case-insensitive occurrence counts of a query, per document
+
+    Single-word queries are answered from the postings alone. Phrases (wrap
+    the query in double quotes to search for it literally) and queries with
+    punctuation use the postings to find candidate documents and only count
+    occurrences in those. Returns {doc_id: count}.
+    """
+    if len(query) > 2 and query.startswith('"') and query.endswith('"'):
+        query = query[1:-1]
+    query_lower = query.lower()
+    ensure_keyword_index()
+    
+    if KEYWORD_TOKEN_PATTERN.fullmatch(query_lower):
+        matches = keyword_index.count_substring(query_lower)
+        return {doc_id: sum(fields.values()) for doc_id, fields in matches.items()}
+    
+    tokens = KEYWORD_TOKEN_PATTERN.findall(query_lower)
+    if tokens:
+        candidates = keyword_index.candidates(tokens)
+    else:
+        # Nothing to look up in the index: check every document
+        candidates = {field: set(manifest.ids()) for field in KEYWORD_FIELDS}
+    
+    counts = {}
+    for doc_id in candidates['content'] | candidates['name']:
+        document = load_document(doc_id)
+        if document:
+            count = 0
+            if doc_id in candidates['content']:
+                count += document.get('content', '').lower().count(query_lower)
+            if doc_id in candidates['name']:
+                count += document.get('name', '').lower().count(query_lower)
+            if count:
+                counts[doc_id] = count
+    return counts
+
+# ============================
+# Bulk Re-indexing
+# ============================
+
+REINDEX_BATCH_TEXTS = 1024  # passages and names per model.encode call
+REINDEX_READ_WORKERS = 4  # threads reading and chunking documents ahead of the encoder
+REINDEX_STATE_FILE = os.path.join(INDEX_DIR, 'reindex.json')
+
+reindex_progress = {'running': False}
+reindex_lock = Lock()
+
+def load_reindex_state(model):
+    """Get the IDs finished by an interrupted reindex with the same model"""
+    try:
+        with open(REINDEX_STATE_FILE, 'r') as f:
+            state = json.load(f)
+        if state.get('model') == model:
+            return set(state.get('done', []))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error reading reindex state, starting over: {e}")
+    return set()
+
+def save_reindex_state(model, done_ids):
+    tmp_path = REINDEX_STATE_FILE + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'model': model, 'done': sorted(done_ids)}, f)
+    os.replace(tmp_path, REINDEX_STATE_FILE)
+
+def prepare_reindex_item(doc_id, force=False):
+    """Read and chunk one document for re-indexing (runs on the reader pool)
+
+    Uses the cached copy when there is one, otherwise reads it from disk
+    without adding it to the cache. Nothing is changed here: results are
+    applied to the live document by reindex_batch.
+    """
+    document = documents_cache.peek(doc_id)
+    if document is None:
+        document = document_journal.read(doc_id)
+        if document is None:
+            return None
+    
+    content = document.get('content', '')
+    layout, missing = plan_document_chunks(content)
+    if force:
+        missing = {chunk[0]: content[chunk[1]:chunk[1] + chunk[2]] for chunk in layout}
+    name = document.get('name', '')
+    needs_name = bool(name.strip()) and (force or f"{doc_id}:name" not in vector_store)
+    return {
+        'id': doc_id,
+        'version': document.get('version', 0),
+        'layout': layout,
+        'missing': missing,
+        'name': name if needs_name else None
+    }
+
+def reindex_batch(items):
+    """Embed a batch of prepared documents with one model.encode call"""
+    chunk_texts = {}  # key -> text, each passage once however many documents share it
+    for item in items:
+        for digest, text in item['missing'].items():
+            chunk_texts.setdefault(f"chunk:{digest}", text)
+    chunk_keys = list(chunk_texts)
+    texts = list(chunk_texts.values())
+    named = [item for item in items if item['name']]
+    texts.extend(item['name'] for item in named)
+    
+    name_vectors = {}
+    if texts:
+        vectors = calculate_chunk_embeddings(texts)
+        if vectors is None:
+            raise RuntimeError("Embeddings model failed, stopping re-index")
+        for key, vector in zip(chunk_keys, vectors):
+            vector_store.put(key, vector)
+        name_vectors = {item['id']: vector for item, vector in zip(named, vectors[len(chunk_keys):])}
+    
+    # Apply the results: cached documents through the cache like any other
+    # change, the others straight to disk so the working set stays cached
+    changed = []
+    uncached_changed = False
+    for item in items:
+        doc_id = item['id']
+        name_vector = name_vectors.get(doc_id)
+        document = documents_cache.peek(doc_id)
+        if document is None:
+            updated = apply_reindex_uncached(item, name_vector)
+            if updated is not None:
+                uncached_changed = uncached_changed or updated
+                continue
+            document = documents_cache.peek(doc_id)
+            if document is None:
+                continue
+        with edit_lock:
+            if apply_reindex_item(document, item, name_vector):
+                documents_cache.mark_dirty(doc_id)
+                changed.append(doc_id)
+        if name_vector is None and f"{doc_id}:name" in vector_store:
+            embedding_index.upsert(doc_id, name_embedding=vector_store.get_key(f"{doc_id}:name"), update_content=False)
+    
+    # Keep slot references in the JSON files current, with one manifest write per batch
+    if changed or uncached_changed:
+        with write_lock:
+            for doc_id in changed:
+                persist_document(doc_id)
+            document_journal.commit()
+            manifest.schedule_save()
+    return len(texts)
+
+def apply_reindex_item(document, item, name_vector):
+    """Install a document's re-index results (call under edit_lock)
+
+    Returns True if its vector slots changed. A document edited since it was
+    read is left alone: the edit queued its own re-embedding.
+    """
+    doc_id = item['id']
+    if document.get('version', 0) != item['version']:
+        return False
+    old_slots = dict(document.get('embedding_slots', {}))
+    if name_vector is not None:
+        set_document_embedding(doc_id, document, 'name', name_vector)
+    elif f"{doc_id}:name" not in vector_store:
+        set_document_embedding(doc_id, document, 'name', None)
+    apply_document_chunks(doc_id, document, item['layout'])
+    return document.get('embedding_slots') != old_slots
+
+def apply_reindex_uncached(item, name_vector):
+    """Apply re-index results to a document that isn't cached, without caching it
+
+    Holding load_lock keeps the document from being loaded meanwhile. Returns
+    whether it or its manifest entry changed, or None if it turned out to be
+    cached after all.
+    """
+    doc_id = item['id']
+    with write_lock, load_lock:
+        if documents_cache.peek(doc_id) is not None:
+            return None
+        document = document_journal.load(doc_id)
+        if document is None:
+            return False
+        with edit_lock:
+            changed = apply_reindex_item(document, item, name_vector)
+        if name_vector is None and f"{doc_id}:name" in vector_store:
+            embedding_index.upsert(doc_id, name_embedding=vector_store.get_key(f"{doc_id}:name"), update_content=False)
+        if changed:
+            try:
+                document_journal.write(doc_id, document)
+            except Exception as e:
+                logger.error(f"Error saving document {doc_id} to disk: {e}")
+                return False
+        # Slots handed out again unchanged still need the entry marked embedded
+        return manifest.upsert(doc_id, document) or changed
+
+def reindex_documents(force=False, restart=False, batch_texts=REINDEX_BATCH_TEXTS):
+    """Rebuild embeddings for the whole corpus in large batches
+
+    Documents are read and chunked by a small thread pool while the main
+    loop encodes. Only passages without a stored vector are encoded unless
+    `force` is set. Progress is checkpointed after every batch so an
+    interrupted run resumes where it stopped unless `restart` is set.
+    """
+    with reindex_lock:
+        if reindex_progress.get('running'):
+            return False
+        reindex_progress.clear()
+        reindex_progress.update({'running': True, 'started_at': datetime.datetime.now().isoformat()})
+    
+    model_name = config['embeddings_model']
+    doc_ids = manifest.ids()
+    done_ids = set() if restart else load_reindex_state(model_name) & set(doc_ids)
+    todo = [doc_id for doc_id in doc_ids if doc_id not in done_ids]
+    reindex_progress.update({'total': len(doc_ids), 'done': len(done_ids), 'encoded': 0, 'model': model_name})
+    logger.info(f"Re-indexing {len(todo)} documents ({len(done_ids)} already done) with {model_name}")
+    
+    started = datetime.datetime.now()
+    try:
+        with ThreadPoolExecutor(max_workers=REINDEX_READ_WORKERS) as pool:
+            # Bounded read-ahead so a large archive is never held in memory at once
+            ahead = deque()
+            remaining = iter(todo)
+            for doc_id in remaining:
+                ahead.append(pool.submit(prepare_reindex_item, doc_id, force))
+                if len(ahead) >= REINDEX_READ_WORKERS * 8:
+                    break
+            
+            batch, batch_size = [], 0
+            while ahead:
+                item = ahead.popleft().result()
+                next_id = next(remaining, None)
+                if next_id is not None:
+                    ahead.append(pool.submit(prepare_reindex_item, next_id, force))
+                if item is not None:
+                    batch.append(item)
+                    batch_size += len(item['missing']) + (1 if item['name'] else 0)
+                if batch and (batch_size >= batch_texts or not ahead):
+                    reindex_progress['encoded'] += reindex_batch(batch)
+                    done_ids.update(item['id'] for item in batch)
+                    save_reindex_state(model_name, done_ids)
+                    
+                    elapsed = max((datetime.datetime.now() - started).total_seconds(), 1e-6)
+                    processed = len(done_ids) - reindex_progress['done']
+                    reindex_progress['done'] = len(done_ids)
+                    reindex_progress['rate'] = round(processed / elapsed, 1)
+                    logger.info(f"Re-indexed {len(done_ids)}/{len(doc_ids)} documents "
+                                f"({reindex_progress['encoded']} texts encoded, {reindex_progress['rate']} docs/s)")
+                    batch, batch_size = [], 0
+        
+        vector_store.flush()
+        if os.path.exists(REINDEX_STATE_FILE):
+            os.remove(REINDEX_STATE_FILE)
+        logger.info(f"Re-index finished: {len(done_ids)} documents")
+        return True
+    except Exception as e:
+        logger.error(f"Re-index stopped: {e}")
+        reindex_progress['error'] = str(e)
+        vector_store.flush()
+        return False
+    finally:
+        reindex_progress['running'] = False
+        reindex_progress['finished_at'] = datetime.datetime.now().isoformat()
+
+def switch_embeddings_model(model_name):
+    """Start over with a different embeddings model (requires a re-index)"""
+    global embeddings_model, embedding_index, embedding_index_ready
+    if model_name == config['embeddings_model']:
+        return
+    config['embeddings_model'] = model_name
+    save_config(config)
+    embeddings_model = None
+    vector_store.reset(model_name)
+    embedding_index = EmbeddingIndex()
+    embedding_index_ready = False
+    
+    # Every stored vector is gone: forget the slots documents still point to.
+    # Documents on disk are rewritten as the re-index embeds them again.
+    for doc_id in manifest.ids():
+        document = documents_cache.peek(doc_id)
+        if document is not None and document.get('embedding_slots'):
+            with edit_lock:
+                document['embedding_slots'] = {}
+            schedule_document_write(doc_id)
+    manifest.reset_embedded()
+    manifest.schedule_save()
+    if os.path.exists(REINDEX_STATE_FILE):
+        os.remove(REINDEX_STATE_FILE)
+
+def rebuild_manifest():
+    """Rebuild the manifest from every snapshot and journal in the documents directory"""
+    for entry in os.scandir(DOCUMENTS_DIR):
+        if not entry.name.endswith('.json'):
+            continue
+        doc_id = entry.name[:-len('.json')]
+        try:
+            document = document_journal.read(doc_id)
+        except Exception as e:
+            logger.error(f"Leaving unreadable document {doc_id} out of the manifest: {e}")
+            continue
+        if document is not None:
+            manifest.upsert(doc_id, document)
+    manifest.save()
+    logger.warning(f"Document manifest rebuilt with {len(manifest)} documents")
+
+def reconcile_manifest():
+    """Catch the manifest up with document files written or deleted after it was saved
+
+    Only files modified since the save are read, so after a clean shutdown
+    this costs a directory listing.
+    """
+    since = manifest.saved_at - MANIFEST_MTIME_SLACK
+    existing = set()
+    modified = set()
+    for entry in os.scandir(DOCUMENTS_DIR):
+        if entry.name.endswith('.json'):
+            doc_id = entry.name[:-len('.json')]
+            existing.add(doc_id)
+        elif entry.name.endswith('.journal'):
+            doc_id = entry.name[:-len('.journal')]
+        else:
+            continue
+        if entry.stat().st_mtime >= since:
+            modified.add(doc_id)
+    
+    changed = 0
+    for doc_id in manifest.ids():
+        if doc_id not in existing:
+            manifest.remove(doc_id)
+            changed += 1
+    for doc_id in modified & existing:
+        try:
+            document = document_journal.read(doc_id)
+        except Exception as e:
+            logger.error(f"Leaving unreadable document {doc_id} out of the manifest: {e}")
+            manifest.remove(doc_id)
+            changed += 1
+            continue
+        if document is not None and manifest.upsert(doc_id, document):
+            changed += 1
+    if changed:
+        manifest.save()
+        logger.warning(f"Document manifest caught up with {changed} documents changed since it was saved")
+
+def load_manifest():
+    """Load the manifest, rebuilding it from the document files if it is missing or unreadable"""
+    try:
+        if manifest.load():
+            logger.info(f"Document manifest loaded with {len(manifest)} documents")
+            reconcile_manifest()
+        else:
+            logger.warning(f"No document manifest at {manifest.path}, rebuilding it from {DOCUMENTS_DIR}")
+            rebuild_manifest()
+    except Exception as e:
+        logger.error(f"Document manifest {manifest.path} is unreadable ({e}), rebuilding it from {DOCUMENTS_DIR}")
+        rebuild_manifest()
+    # Older versions listed document IDs in the config file
+    if 'documents' in config:
+        del config['documents']
+        save_config(config)
+
+def init_storage():
+    """Recover and load document storage; the serving process does this once at startup"""
+    try:
+        document_journal.recover()
+    except Exception as e:
+        logger.error(f"Error recovering document journals: {e}")
+    load_manifest()
+    try:
+        blob_store.load()
+    except Exception as e:
+        logger.error(f"Error loading content blob references: {e}")
+
+# Storage is loaded once everything needed to replay journals is defined
+if not RELOADER_PARENT:
+    init_storage()
 
 # ============================
 # API Functions
@@ -585,6 +3140,151 @@ HTTP_ERROR_MESSAGES = {
     503: "No available provider - Try a different model"
 }
 
+# Keep-alive HTTP sessions, one per API host, so generations skip the TCP/TLS handshake
+http_sessions = {}
+http_sessions_lock = Lock()
+
+def get_http_session(url):
+    """Get the pooled session for a URL's host"""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    with http_sessions_lock:
+        session = http_sessions.get(origin)
+        if session is None:
+            session = requests.Session()
+            pool_size = config.get('http_pool_size', DEFAULT_CONFIG['http_pool_size'])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_sessions[origin] = session
+        return session
+
+def provider_endpoint_url():
+    """The completions URL generations go to with the current settings"""
+    return select_request_builder()({'prompt': ''})[0]
+
+def warm_http_session(url):
+    """Open a pooled connection to a host in the background, ahead of the next generation"""
+    def warm():
+        parts = urlsplit(url)
+        try:
+            get_http_session(url).head(f"{parts.scheme}://{parts.netloc}/", timeout=5).close()
+            logger.debug(f"Warmed up connection to {parts.netloc}")
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Connection warm-up to {parts.netloc} failed: {e}")
+    Thread(target=warm, name='http-warmup', daemon=True).start()
+
+PREFIX_CACHE_PROBE_TIMEOUT = 3  # seconds per request when probing a server's capabilities
+
+class PrefixCacheHints:
+    """Request shaping that lets local servers reuse their cached prompt prefix
+
+    Servers are probed once per endpoint, in the background: /v1/models
+    names the backend and llama.cpp's /props reports its slot count. vLLM
+    and TabbyAPI reuse matching prefixes on their own. llama.cpp needs
+    `cache_prompt`, and keeps a document's prefix only while its requests
+    go to the same slot, so each document is pinned to a slot (least
+    recently generated documents give theirs up first).
+    """
+
+    def __init__(self):
+        self.capabilities = {}  # base URL -> {'backend', 'slots'}; {} while probing or unknown
+        self.slots = {}  # base URL -> OrderedDict of doc_id -> slot, least recently used first
+        self.lock = Lock()
+
+    @staticmethod
+    def base_url(endpoint_url):
+        return endpoint_url[:-len('/completions')] if endpoint_url.endswith('/completions') else endpoint_url.rstrip('/')
+
+    def probe(self, base_url):
+        """Ask a server what it is; returns {'backend', 'slots'}"""
+        found = {'backend': None, 'slots': None}
+        session = get_http_session(base_url)
+        try:
+            response = session.get(f"{base_url}/models", timeout=PREFIX_CACHE_PROBE_TIMEOUT)
+            models = (response.json().get('data') or []) if response.status_code == 200 else []
+            owner = str(models[0].get('owned_by', '')).lower() if models else ''
+            if 'llama' in owner:
+                found['backend'] = 'llama.cpp'
+            elif 'vllm' in owner:
+                found['backend'] = 'vllm'
+            elif 'tabby' in owner:
+                found['backend'] = 'tabbyapi'
+            
+            # llama.cpp also answers /props, even when models are listed under another owner
+            if found['backend'] in (None, 'llama.cpp'):
+                parts = urlsplit(base_url)
+                response = session.get(f"{parts.scheme}://{parts.netloc}/props", timeout=PREFIX_CACHE_PROBE_TIMEOUT)
+                if response.status_code == 200:
+                    props = response.json()
+                    if 'total_slots' in props or 'default_generation_settings' in props:
+                        found['backend'] = 'llama.cpp'
+                        found['slots'] = props.get('total_slots')
+        except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+            logger.debug(f"Capability probe of {base_url} stopped: {e}")
+        
+        logger.info(f"Prefix caching for {base_url}: backend {found['backend'] or 'unknown'}, slots {found['slots'] or 'unknown'}")
+        with self.lock:
+            self.capabilities[base_url] = found
+        return found
+
+    def refresh(self, base_url):
+        """Forget what is known about a server and probe it again in the background"""
+        with self.lock:
+            self.capabilities[base_url] = {}
+            self.slots.pop(base_url, None)
+        Thread(target=self.probe, args=(base_url,), name='capability-probe', daemon=True).start()
+
+    def get(self, base_url):
+        """Known capabilities of a server, starting a probe the first time it's seen"""
+        with self.lock:
+            known = self.capabilities.get(base_url)
+        if known is None:
+            self.refresh(base_url)
+            return {}
+        return known
+
+    def slot_for(self, base_url, doc_id, total_slots):
+        """The slot a document's requests go to on a server"""
+        with self.lock:
+            assigned = self.slots.setdefault(base_url, OrderedDict())
+            if doc_id in assigned:
+                assigned.move_to_end(doc_id)
+                return assigned[doc_id]
+            if len(assigned) < total_slots:
+                slot = len(assigned)
+            else:
+                _, slot = assigned.popitem(last=False)
+            assigned[doc_id] = slot
+            return slot
+
+    def apply(self, payload, endpoint_url, doc_id):
+        """Add the hints a server understands to a completions payload"""
+        base_url = self.base_url(endpoint_url)
+        found = self.get(base_url)
+        if found.get('backend') != 'llama.cpp':
+            return
+        payload['cache_prompt'] = True
+        if doc_id and found.get('slots'):
+            payload['id_slot'] = self.slot_for(base_url, doc_id, found['slots'])
+
+prefix_cache_hints = PrefixCacheHints()
+
+def prefix_cache_enabled():
+    """Whether generations go to a local OpenAI-compatible server with prefix-cache hints turned on"""
+    return bool(config.get('prefix_cache_hints')) and select_request_builder() is build_openai_compat_request
+
+def generation_prompt(content):
+    """The prompt that continues a document's content
+
+    Normally trailing whitespace is stripped from every line, like the editor
+    does. With prefix caching only the end is stripped, so the document's text
+    stays byte-identical to what the server saw and generated last time.
+    """
+    if prefix_cache_enabled():
+        return content.rstrip()
+    return trim_prompt(content)
+
 def sse_event(data):
     """Helper to format SSE events"""
     return "data: " + json.dumps(data) + "\n\n"
@@ -594,20 +3294,153 @@ def cleanup_generation(generation_id):
     if generation_id in active_generations:
         del active_generations[generation_id]
 
+MAX_SAMPLES = 8  # most completions one generation may request at once
+STREAM_FLUSH_MAX_MS = 250  # longest flush window a slow-rendering client can ask for
+STREAM_IDLE_POLL = 1.0  # seconds between cancellation checks while the API sends nothing
+GENERATION_CHECKPOINT_INTERVAL = 2.0  # seconds between commits of streamed text into the document
+
+def trim_prompt(content):
+    """Strip trailing whitespace from each line and the end, as the editor does before submitting"""
+    return '\n'.join(line.rstrip() for line in content.split('\n')).rstrip()
+
+def begin_generation_document(generation_data, document):
+    """Start accumulating a generation's output at the end of its document"""
+    generation_data['completion_start'] = len(document.get('content', ''))
+    generation_data['insert_at'] = generation_data['completion_start']
+    generation_data['doc_version'] = document.get('version', 0)
+    generation_data['pending_text'] = []
+    generation_data['last_checkpoint'] = datetime.datetime.now()
+
+def checkpoint_generation(generation_data):
+    """Commit streamed text into the cached document and write it to disk
+
+    The text is journaled as a single splice at the end of the completion so
+    far. If the document was edited from elsewhere meanwhile, accumulation
+    stops and the editor's own save wins. Returns the document version, or
+    None if the document isn't tracking this generation.
+    """
+    doc_id = generation_data.get('document_id')
+    if not doc_id or 'insert_at' not in generation_data or generation_data.get('detached'):
+        return None
+    generation_data['last_checkpoint'] = datetime.datetime.now()
+    document = load_document(doc_id)
+    if not document:
+        return None
+    
+    with edit_lock:
+        if document.get('version', 0) != generation_data['doc_version']:
+            logger.info(f"Document {doc_id} changed during generation, no longer accumulating output")
+            generation_data['detached'] = True
+            return None
+        text = ''.join(generation_data['pending_text'])
+        generation_data['pending_text'] = []
+        if text:
+            ops = [[generation_data['insert_at'], 0, text]]
+            content = apply_content_patch(document.get('content', ''), ops)
+            generation_data['insert_at'] += len(text)
+            # Remember where the prompt ends and the completion begins
+            document['last_completion'] = [generation_data['completion_start'], generation_data['insert_at']]
+            set_document_content(doc_id, document, content, ops)
+            generation_data['doc_version'] = document['version']
+    
+    if text:
+        write_document_to_disk(doc_id)
+    return generation_data['doc_version']
+
+def accumulate_generation_text(generation_data, text):
+    """Queue streamed text for the document's next checkpoint"""
+    if 'pending_text' in generation_data:
+        generation_data['pending_text'].append(text)
+
+def generation_checkpoint_due(generation_data):
+    """Whether queued text has waited long enough to be committed"""
+    if not generation_data.get('pending_text'):
+        return False
+    elapsed = (datetime.datetime.now() - generation_data['last_checkpoint']).total_seconds()
+    return elapsed >= GENERATION_CHECKPOINT_INTERVAL
+
+def record_generation_branches(generation_data, samples=None):
+    """Add a finished generation to its document's loom
+
+    A completion becomes a child of the text it continued, and the
+    document's current node. Samples (several branches generated at once)
+    all become children of the text they were sampled from.
+    """
+    doc_id = generation_data.get('document_id')
+    if not doc_id or generation_data.get('is_seed'):
+        return
+    document = load_document(doc_id)
+    if not document:
+        return
+    
+    try:
+        with edit_lock:
+            loom = get_loom(doc_id)
+            if samples is None:
+                if generation_data.get('detached') or 'completion_start' not in generation_data \
+                        or document.get('version', 0) != generation_data['doc_version']:
+                    return
+                start, end = generation_data['completion_start'], generation_data['insert_at']
+                if end == start:
+                    return
+                content = document.get('content', '')
+                base = loom.add(content[:start] + content[end:], parent=document.get('loom_node'))
+                document['loom_node'] = loom.add(content, parent=base, op=[start, 0, content[start:end]])
+            else:
+                text = generation_data.get('branch_base', '')
+                base = loom.add(text, parent=document.get('loom_node'))
+                for sample in samples:
+                    if sample:
+                        loom.add(text + sample, parent=base, op=[len(text), 0, sample])
+                document['loom_node'] = base
+            save_document(doc_id, document)
+    except Exception as e:
+        logger.error(f"Error recording generation in loom of document {doc_id}: {e}")
+
+def checkout_loom_node(doc_id, node_id=None, step=0):
+    """Switch a document to a node of its loom, or `step` siblings away from its current node
+
+    Edits made since the document was last on a node are added to the loom
+    first, so switching never loses text. Returns (document, node_id), or
+    (None, None) if there is nothing to switch to.
+    """
+    document = load_document(doc_id)
+    if not document:
+        return None, None
+    
+    with edit_lock:
+        loom = get_loom(doc_id)
+        if not len(loom) or (node_id is not None and node_id not in loom):
+            return None, None
+        content = document.get('content', '')
+        current = loom.find(content)
+        if current is None:
+            current = document.get('loom_node')
+            edited = loom.add(content, parent=current)
+            if current not in loom:
+                current = edited
+        if node_id is None:
+            siblings = loom.siblings(current)
+            node_id = siblings[(siblings.index(current) + step) % len(siblings)]
+        
+        text = loom.text(node_id)
+        document['loom_node'] = node_id
+        if text != content:
+            set_document_content(doc_id, document, text)
+        else:
+            save_document(doc_id, document)
+    return document, node_id
+
 def get_http_error_message(status_code, prefix="API"):
     """Get user-friendly error message for HTTP status code"""
     base_msg = HTTP_ERROR_MESSAGES.get(status_code, f"Unknown error (status {status_code})")
     return f"Error {status_code}: {base_msg}"
 
-def parse_sse_stream(buffer_chunk, response_format='openai'):
-    """Parse SSE stream chunks and extract content
+def parse_sse_stream(data_str, response_format='openai'):
+    """Parse the data of an SSE event and extract content
     Returns: (content_text, is_done)
     response_format: 'openai' for completions, 'chat' for chat completions
     """
-    if not buffer_chunk.startswith('data: '):
-        return None, False
-    
-    data_str = buffer_chunk[6:]
     if data_str == '[DONE]':
         return None, True
     
@@ -615,7 +3448,7 @@ def parse_sse_stream(buffer_chunk, response_format='openai'):
         data_obj = json.loads(data_str)
         if response_format == 'chat':
             # Chat completions: choices[0].delta.content
-            delta = data_obj.get("choices", [{}])[0].get("delta", {})
+            delta = (data_obj.get("choices") or [{}])[0].get("delta", {})
             return delta.get("content", ""), False
         else:
             # Standard completions: choices[0].text or direct content field
@@ -625,6 +3458,25 @@ def parse_sse_stream(buffer_chunk, response_format='openai'):
     except json.JSONDecodeError:
         return None, False
 
+def parse_sse_choices(data_str, response_format='openai'):
+    """Parse the data of an SSE event that may carry several choices (requests with n > 1)
+    Returns: (list of (choice_index, content_text), is_done)
+    """
+    if data_str == '[DONE]':
+        return [], True
+    
+    try:
+        data_obj = json.loads(data_str)
+    except json.JSONDecodeError:
+        return [], False
+    
+    choices = data_obj.get("choices") or []
+    if not choices:
+        return [(0, data_obj.get("content", ""))], False
+    if response_format == 'chat':
+        return [(choice.get("index", 0), choice.get("delta", {}).get("content", "")) for choice in choices], False
+    return [(choice.get("index", 0), choice.get("text", "")) for choice in choices], False
+
 def handle_auto_rename_and_save(generation_id):
     """Handle auto-rename and document save after generation completes"""
     generation_data = active_generations.get(generation_id)
@@ -638,23 +3490,266 @@ def handle_auto_rename_and_save(generation_id):
     new_name = None
     if document and document.get('name') == 'Untitled' and document.get('content'):
         try:
-            new_name = generate_document_name(document['content'])
-            if new_name and new_name != 'Untitled':
-                success, updated_doc = update_document_metadata(doc_id, new_name)
-                if not success:
-                    new_name = None
+            new_name = generate_document_name(document['content'])
+            if new_name and new_name != 'Untitled':
+                success, updated_doc = update_document_metadata(doc_id, new_name)
+                if not success:
+                    new_name = None
+        except Exception as e:
+            logger.error(f"Error during auto-rename: {e}")
+            new_name = None
+    
+    # Write document immediately after API response completes
+    write_document_to_disk(doc_id)
+    
+    return new_name
+
+def stream_flush_window(render_ms=None):
+    """Seconds between text events for a client that takes `render_ms` to render one"""
+    window_ms = config.get('stream_flush_ms', DEFAULT_CONFIG['stream_flush_ms'])
+    if render_ms:
+        # Don't send events faster than the client can draw them
+        window_ms = max(window_ms, min(render_ms * 2, STREAM_FLUSH_MAX_MS))
+    return window_ms / 1000
+
+class GenerationStream:
+    """Provider-independent state of one streamed generation
+
+    Both the WSGI generator (stream_api_request) and the async backend in
+    asgi.py drive this: they feed it raw response bytes and send on the SSE
+    events it returns. Parsing, accumulating output into the document, seed
+    cleanup, auto-rename and cleanup all live here. feed() and flush() only
+    do CPU work; checkpoint(), complete(), cancel(), error() and close() may
+    touch disk or the network, so the async backend runs them in a worker
+    thread.
+
+    Text is recorded as it arrives but sent in coalesced events: the first
+    at once, then at most one per flush window unless enough text is
+    waiting. Drivers call flush() when flush_timeout() passes without new
+    input, so held text is never later than the window.
+    """
+
+    def __init__(self, generation_id, response_format='openai', api_name='API'):
+        self.generation_id = generation_id
+        self.data = active_generations[generation_id]
+        self.response_format = response_format
+        self.api_name = api_name
+        self.parser = SSEParser()
+        self.done = False
+        self.is_seed = self.data.get('is_seed', False)
+        self.accumulated_seed = "" if self.is_seed else None
+        self.samples = self.data.get('n', 1)
+        self.branches = {}  # choice index -> text so far, when sampling several
+        self.outgoing = {}  # choice index -> text not yet sent to the client
+        self.outgoing_chars = 0
+        self.last_flush = None  # time of the last text event, None before the first
+        self.flush_window = stream_flush_window(self.data.get('render_ms'))
+        self.flush_chars = config.get('stream_flush_chars', DEFAULT_CONFIG['stream_flush_chars'])
+        self.closed = False
+
+    @property
+    def active(self):
+        return self.data['active']
+
+    def http_error(self, status_code, error_detail=None):
+        """Error event for a non-200 upstream response (with its parsed JSON body, if any)"""
+        error_msg = get_http_error_message(status_code, self.api_name)
+        try:
+            if 'error' in error_detail:
+                if isinstance(error_detail['error'], dict) and 'message' in error_detail['error']:
+                    error_msg += f": {error_detail['error']['message']}"
+                else:
+                    error_msg += f": {error_detail['error']}"
+        except:
+            pass
+        
+        logger.error(error_msg)
+        return self._error_event(error_msg)
+
+    def feed(self, chunk):
+        """Parse a chunk of the upstream SSE response; returns events that are due for the client"""
+        for event in self.parser.feed(chunk):
+            choices, is_done = parse_sse_choices(event.data, self.response_format)
+            if is_done:
+                self.done = True
+                break
+            for index, content in choices:
+                if content:
+                    self.add_text(content, index)
+        return self.flush()
+
+    def add_text(self, content, index=0):
+        """Record generated text (of choice `index` when sampling several) for the next flush"""
+        self.outgoing.setdefault(index, []).append(content)
+        self.outgoing_chars += len(content)
+        
+        # Samples are branches for the client to choose from, not part of the document yet
+        if self.samples > 1:
+            self.branches.setdefault(index, []).append(content)
+            return
+        
+        # Accumulate seed text for cleanup
+        if self.is_seed:
+            self.accumulated_seed += content
+        
+        accumulate_generation_text(self.data, content)
+
+    def flush(self, force=False):
+        """Events for the text waiting to be sent, if it's due"""
+        if not self.outgoing:
+            return []
+        now = time.monotonic()
+        if not force and self.last_flush is not None and self.outgoing_chars < self.flush_chars \
+                and now - self.last_flush < self.flush_window:
+            return []
+        
+        events = []
+        for index, pieces in self.outgoing.items():
+            text = ''.join(pieces)
+            events.append(sse_event({"text": text, "index": index} if self.samples > 1 else {"text": text}))
+        self.outgoing = {}
+        self.outgoing_chars = 0
+        self.last_flush = now
+        return events
+
+    def flush_timeout(self):
+        """Seconds the driver may wait for more input before calling flush()"""
+        if not self.outgoing:
+            return STREAM_IDLE_POLL
+        return max(0.0, self.flush_window - (time.monotonic() - self.last_flush))
+
+    def checkpoint_due(self):
+        return generation_checkpoint_due(self.data)
+
+    def checkpoint(self):
+        return checkpoint_generation(self.data)
+
+    def complete(self):
+        """Finish a generation that ran to the end; returns the final events"""
+        # Commit the rest of the output before reporting the outcome
+        version = checkpoint_generation(self.data)
+        
+        # Clean up seed text if needed
+        if self.is_seed and self.accumulated_seed:
+            # Find earliest stop token and trim
+            min_idx = min((self.accumulated_seed.find(t) for t in SEED_STOP_TOKENS if t in self.accumulated_seed), default=len(self.accumulated_seed))
+            cleaned_text = self.accumulated_seed[:min_idx].rstrip(".'\u2018\u2019\u2026")
+            
+            # Update document with cleaned text
+            doc_id = self.data.get('document_id')
+            if doc_id:
+                update_document_content(doc_id, cleaned_text)
+            # The editor still shows the raw seed, so it has to save
+            version = None
+        
+        # Keep the completion (or every branch) in the document's loom
+        if self.samples > 1:
+            record_generation_branches(self.data, [''.join(pieces) for pieces in self.branches.values()])
+        elif version is not None:
+            record_generation_branches(self.data)
+        
+        # Handle auto-rename BEFORE cleanup (needs generation_data)
+        new_name = handle_auto_rename_and_save(self.generation_id)
+        
+        # Start on alternatives in case this completion gets rerolled
+        if not self.is_seed and version is not None and self.data.get('request'):
+            reroll_prefetcher.fill(self.data['document_id'], self.data['prompt'], self.data['request'])
+        
+        cleanup_generation(self.generation_id)
+        
+        events = self.flush(force=True)
+        if new_name:
+            events.append(sse_event({"auto_renamed": True, "new_name": new_name}))
+        events.append(sse_event({"done": True, "version": version} if version is not None else {"done": True}))
+        return events
+
+    def cancel(self):
+        """Finish a cancelled generation; returns the final events"""
+        version = checkpoint_generation(self.data)
+        # Just save and cleanup on cancel
+        if self.data.get('document_id'):
+            write_document_to_disk(self.data['document_id'])
+        cleanup_generation(self.generation_id)
+        events = self.flush(force=True)
+        events.append(sse_event({"cancelled": True, "version": version} if version is not None else {"cancelled": True}))
+        return events
+
+    def error(self, message):
+        """Finish a failed generation; returns the error event, after any text still held"""
+        event = self._error_event(message)
+        cleanup_generation(self.generation_id)
+        return ''.join(self.flush(force=True)) + event
+
+    def close(self):
+        """Always called last: the client may have disconnected mid-stream, keep what was generated"""
+        self.closed = True
+        checkpoint_generation(self.data)
+        # A disconnect skips complete()/cancel()/error(), which would otherwise drop the entry
+        cleanup_generation(self.generation_id)
+
+    def _error_event(self, message):
+        event = {"error": message}
+        version = checkpoint_generation(self.data)
+        if version is not None:
+            event["version"] = version
+        return sse_event(event)
+
+class ChunkReader:
+    """Reads a streamed response on its own thread
+
+    This lets a driver wake up to flush held text while the API is quiet,
+    and hands over everything that arrived during a slow write to the
+    client at once, so event rate drops when the client can't keep up.
+    """
+
+    def __init__(self, chunks, stream):
+        self.queue = queue.Queue()
+        self.error = None
+        Thread(target=self._run, args=(chunks, stream), name='chunk-reader', daemon=True).start()
+
+    def _run(self, chunks, stream):
+        try:
+            for chunk in chunks:
+                if stream.closed:
+                    return
+                if chunk:
+                    self.queue.put(chunk)
         except Exception as e:
-            logger.error(f"Error during auto-rename: {e}")
-            new_name = None
-    
-    # Write document immediately after API response completes
-    write_document_to_disk(doc_id)
-    
-    return new_name
+            self.error = e
+        finally:
+            self.queue.put(None)
+
+    def get(self, timeout):
+        """All chunks received so far, waiting up to `timeout` for the first
+
+        Returns None once the response has ended, re-raises what stopped the
+        reader, and raises queue.Empty on timeout.
+        """
+        first = self.queue.get(timeout=timeout)
+        if first is None:
+            if self.error:
+                raise self.error
+            return None
+        parts = [first]
+        while True:
+            try:
+                chunk = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                # Leave the end for the next call
+                self.queue.put(None)
+                break
+            parts.append(chunk)
+        return b''.join(parts)
 
 def stream_api_request(endpoint_url, headers, payload, generation_id, response_format='openai', api_name='API'):
     """Unified streaming handler for all API providers
     
+    Output is also accumulated into the generation's document on the server,
+    so it survives the client going away. Final events carry the document
+    version, which tells the client its editor already matches the server.
+    
     Args:
         endpoint_url: API endpoint URL
         headers: Request headers dict
@@ -663,109 +3758,232 @@ def stream_api_request(endpoint_url, headers, payload, generation_id, response_f
         response_format: 'openai' or 'chat' for parsing
         api_name: Name for error messages
     """
-    generation_data = active_generations[generation_id]
+    stream = GenerationStream(generation_id, response_format, api_name)
     
     try:
         logger.info(f"Making {api_name} request to: {endpoint_url}")
         
-        with requests.post(endpoint_url, headers=headers, json=payload, stream=True, timeout=(5, 30)) as response:
+        with get_http_session(endpoint_url).post(endpoint_url, headers=headers, json=payload, stream=True, timeout=(5, 30)) as response:
             # Handle HTTP errors
             if response.status_code != 200:
-                error_msg = get_http_error_message(response.status_code, api_name)
-                
-                # Try to get more detail from response
                 try:
                     error_detail = response.json()
-                    if 'error' in error_detail:
-                        if isinstance(error_detail['error'], dict) and 'message' in error_detail['error']:
-                            error_msg += f": {error_detail['error']['message']}"
-                        else:
-                            error_msg += f": {error_detail['error']}"
                 except:
-                    pass
-                
-                logger.error(error_msg)
-                yield sse_event({"error": error_msg})
+                    error_detail = None
+                yield stream.http_error(response.status_code, error_detail)
                 return
             
             # Stream response
-            buffer = ""
-            was_cancelled = False
-            is_seed = generation_data.get('is_seed', False)
-            accumulated_seed = "" if is_seed else None
-            
-            for chunk in response.iter_content(chunk_size=1024, decode_unicode=False):
-                if not generation_data['active']:
-                    yield sse_event({"cancelled": True})
-                    was_cancelled = True
+            reader = ChunkReader(response.iter_content(chunk_size=1024, decode_unicode=False), stream)
+            while not stream.done:
+                try:
+                    chunk = reader.get(timeout=stream.flush_timeout())
+                except queue.Empty:
+                    chunk = b''
+                
+                if not stream.active:
+                    yield from stream.cancel()
+                    return
+                if chunk is None:
                     break
                 
-                if chunk:
-                    buffer += chunk.decode('utf-8', errors='replace')
-                    while True:
-                        line_end = buffer.find('\n')
-                        if line_end == -1:
-                            break
-                        
-                        line = buffer[:line_end].strip()
-                        buffer = buffer[line_end + 1:]
-                        
-                        if not line.startswith('data: '):
-                            continue
-                        
-                        content, is_done = parse_sse_stream(line, response_format)
-                        if is_done:
-                            break
-                        if not content:
-                            continue
-                        
-                        # Accumulate seed text for cleanup
-                        if is_seed:
-                            accumulated_seed += content
-                        
-                        yield sse_event({"text": content})
+                # Events due now go out in one write
+                events = stream.feed(chunk) if chunk else stream.flush()
+                if events:
+                    yield ''.join(events)
+                if stream.checkpoint_due():
+                    stream.checkpoint()
             
-            # Only handle completion if not cancelled
-            if not was_cancelled:
-                # Clean up seed text if needed
-                if is_seed and accumulated_seed:
-                    # Find earliest stop token and trim
-                    min_idx = min((accumulated_seed.find(t) for t in SEED_STOP_TOKENS if t in accumulated_seed), default=len(accumulated_seed))
-                    cleaned_text = accumulated_seed[:min_idx].rstrip(".'\u2018\u2019\u2026")
-                    
-                    # Update document with cleaned text
-                    doc_id = generation_data.get('document_id')
-                    if doc_id:
-                        update_document_content(doc_id, cleaned_text)
-                
-                # Handle auto-rename BEFORE cleanup (needs generation_data)
-                new_name = handle_auto_rename_and_save(generation_id)
-                
-                cleanup_generation(generation_id)
-                
-                if new_name:
-                    yield sse_event({"auto_renamed": True, "new_name": new_name})
-                
-                yield sse_event({"done": True})
-            else:
-                # Just save and cleanup on cancel
-                generation_data = active_generations.get(generation_id)
-                if generation_data and generation_data.get('document_id'):
-                    write_document_to_disk(generation_data['document_id'])
-                cleanup_generation(generation_id)
+            yield ''.join(stream.complete())
             
     except requests.exceptions.Timeout:
         logger.error(f"{api_name} timeout")
-        yield sse_event({"error": f"{api_name} timeout - server took too long to respond"})
-        cleanup_generation(generation_id)
+        yield stream.error(f"{api_name} timeout - server took too long to respond")
     except requests.exceptions.ConnectionError as e:
         logger.error(f"{api_name} connection error: {str(e)}")
-        yield sse_event({"error": f"{api_name} connection error - unable to connect to server"})
-        cleanup_generation(generation_id)
+        yield stream.error(f"{api_name} connection error - unable to connect to server")
     except Exception as e:
         logger.error(f"{api_name} error: {str(e)}")
-        yield sse_event({"error": f"{api_name} error: {str(e)}"})
-        cleanup_generation(generation_id)
+        yield stream.error(f"{api_name} error: {str(e)}")
+    finally:
+        stream.close()
+
+class PrefetchedCompletion:
+    """One alternative completion, generated in the background ahead of a reroll"""
+
+    def __init__(self, request):
+        self.request = request  # (endpoint_url, headers, payload, response_format, api_name)
+        self.pieces = []
+        self.finished = False
+        self.error = None
+        self.cancelled = False
+        self.started_at = datetime.datetime.now()
+        self.condition = Condition()
+
+    def start(self):
+        Thread(target=self._run, name='reroll-prefetch', daemon=True).start()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self):
+        """Sort key: finished alternatives first, then the ones furthest along"""
+        return (self.finished, len(self.pieces))
+
+    def wait(self, sent, timeout=1.0):
+        """Wait for text after the first `sent` pieces; returns (new pieces, finished)"""
+        with self.condition:
+            if len(self.pieces) <= sent and not self.finished:
+                self.condition.wait(timeout)
+            return self.pieces[sent:], self.finished
+
+    def _append(self, content):
+        with self.condition:
+            self.pieces.append(content)
+            self.condition.notify_all()
+
+    def _run(self):
+        endpoint_url, headers, payload, response_format, api_name = self.request
+        try:
+            with get_http_session(endpoint_url).post(endpoint_url, headers=headers, json=payload, stream=True, timeout=(5, 30)) as response:
+                if response.status_code != 200:
+                    self.error = get_http_error_message(response.status_code, api_name)
+                    return
+                
+                for event in iter_events(response.iter_content(chunk_size=1024, decode_unicode=False)):
+                    if self.cancelled:
+                        return
+                    content, is_done = parse_sse_stream(event.data, response_format)
+                    if is_done:
+                        return
+                    if content:
+                        self._append(content)
+        except Exception as e:
+            logger.error(f"Reroll prefetch error: {e}")
+            self.error = f"{api_name} error: {str(e)}"
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+class RerollPrefetcher:
+    """Alternative completions kept ready for rerolls, per document
+
+    After a generation completes, up to config['reroll_prefetch'] more
+    completions of the same prompt are started. A reroll resubmits that
+    prompt, and is served from the most advanced alternative instead of
+    waiting for the API again; taking one starts its replacement. Holding
+    one entry per document bounds this to the last prompt, the budget caps
+    alternatives across documents, and any edit that doesn't leave the
+    prompt intact (a reroll reverting to it does) discards the entry.
+    """
+
+    def __init__(self):
+        self.entries = {}  # doc_id -> {'prompt', 'request', 'alternatives'}
+        self.lock = Lock()
+
+    def fill(self, doc_id, prompt, request):
+        """Top up alternatives for a document's prompt, within the budget"""
+        wanted = config.get('reroll_prefetch', 0)
+        if wanted <= 0:
+            return
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(doc_id)
+            if entry is None or entry['prompt'] != prompt or entry['request'] != request:
+                self._discard(doc_id)
+                entry = {'prompt': prompt, 'request': request, 'alternatives': []}
+                self.entries[doc_id] = entry
+            
+            budget = config.get('reroll_prefetch_budget', DEFAULT_CONFIG['reroll_prefetch_budget'])
+            held = sum(len(e['alternatives']) for e in self.entries.values())
+            while len(entry['alternatives']) < wanted and held < budget:
+                alternative = PrefetchedCompletion(request)
+                entry['alternatives'].append(alternative)
+                alternative.start()
+                held += 1
+            
+            if not entry['alternatives']:
+                del self.entries[doc_id]
+
+    def take(self, doc_id, prompt, request):
+        """Claim the best alternative for a prompt, if one is ready or underway"""
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(doc_id)
+            if entry is None or entry['prompt'] != prompt or entry['request'] != request:
+                return None
+            usable = [a for a in entry['alternatives'] if a.error is None]
+            if not usable:
+                return None
+            alternative = max(usable, key=PrefetchedCompletion.progress)
+            entry['alternatives'].remove(alternative)
+        
+        logger.info(f"Serving reroll of document {doc_id} from a prefetched completion")
+        self.fill(doc_id, prompt, request)
+        return alternative
+
+    def document_changed(self, doc_id, content):
+        """Discard a document's alternatives once its prompt is no longer intact"""
+        entry = self.entries.get(doc_id)
+        if entry is not None and not content.startswith(entry['prompt']):
+            self.discard(doc_id)
+
+    def discard(self, doc_id):
+        with self.lock:
+            self._discard(doc_id)
+
+    def _discard(self, doc_id):
+        entry = self.entries.pop(doc_id, None)
+        if entry:
+            for alternative in entry['alternatives']:
+                alternative.cancel()
+
+    def _expire(self):
+        ttl = config.get('reroll_prefetch_ttl', DEFAULT_CONFIG['reroll_prefetch_ttl'])
+        now = datetime.datetime.now()
+        for doc_id, entry in list(self.entries.items()):
+            for alternative in list(entry['alternatives']):
+                if alternative.error is not None or (now - alternative.started_at).total_seconds() > ttl:
+                    alternative.cancel()
+                    entry['alternatives'].remove(alternative)
+            if not entry['alternatives']:
+                del self.entries[doc_id]
+
+reroll_prefetcher = RerollPrefetcher()
+
+def stream_prefetched_completion(generation_id, alternative):
+    """Stream a generation from a prefetched completion, following it live if it's still running"""
+    response_format, api_name = alternative.request[3:]
+    stream = GenerationStream(generation_id, response_format, api_name)
+    
+    try:
+        sent = 0
+        while True:
+            pieces, finished = alternative.wait(sent, stream.flush_timeout())
+            if not stream.active:
+                alternative.cancel()
+                yield from stream.cancel()
+                return
+            
+            # Whatever is already buffered is taken at once
+            if pieces:
+                sent += len(pieces)
+                stream.add_text(''.join(pieces))
+                if stream.checkpoint_due():
+                    stream.checkpoint()
+            events = stream.flush()
+            if events:
+                yield ''.join(events)
+            if finished:
+                break
+        
+        if alternative.error:
+            yield stream.error(alternative.error)
+        else:
+            yield ''.join(stream.complete())
+    finally:
+        stream.close()
 
 def is_openrouter_format(endpoint_or_model):
     """
@@ -787,9 +4005,8 @@ def is_openrouter_format(endpoint_or_model):
     # Default to OpenRouter format for anything else
     return True
 
-def openai_compat_stream_generator(generation_id):
-    """Generator function for OpenAI-compatible API streaming responses"""
-    generation_data = active_generations[generation_id]
+def build_openai_compat_request(generation_data):
+    """Build (endpoint_url, headers, payload, response_format, api_name) for an OpenAI-compatible API"""
     prompt = generation_data['prompt']
     
     # Normalize endpoint URL
@@ -814,12 +4031,23 @@ def openai_compat_stream_generator(generation_id):
         'stream': True
     }
     
+    # Sample several completions in one request (vLLM, TabbyAPI and others share the prompt's prefill)
+    if generation_data.get('n', 1) > 1:
+        payload['n'] = generation_data['n']
+    
+    if config.get('prefix_cache_hints'):
+        prefix_cache_hints.apply(payload, endpoint_url, generation_data.get('document_id'))
+    
+    return endpoint_url, headers, payload, 'openai', 'OpenAI-compatible API'
+
+def openai_compat_stream_generator(generation_id):
+    """Generator function for OpenAI-compatible API streaming responses"""
+    endpoint_url, headers, payload, response_format, api_name = build_openai_compat_request(active_generations[generation_id])
     # Use unified streaming handler
-    yield from stream_api_request(endpoint_url, headers, payload, generation_id, 'openai', 'OpenAI-compatible API')
+    yield from stream_api_request(endpoint_url, headers, payload, generation_id, response_format, api_name)
 
-def chutes_stream_generator(generation_id):
-    """Generator function for Chutes API streaming responses"""
-    generation_data = active_generations[generation_id]
+def build_chutes_request(generation_data):
+    """Build (endpoint_url, headers, payload, response_format, api_name) for the Chutes API"""
     prompt = generation_data['prompt']
     
     endpoint_url = 'https://llm.chutes.ai/v1/completions'
@@ -842,8 +4070,13 @@ def chutes_stream_generator(generation_id):
         'stream': True
     }
     
+    return endpoint_url, headers, payload, 'openai', 'Chutes API'
+
+def chutes_stream_generator(generation_id):
+    """Generator function for Chutes API streaming responses"""
+    endpoint_url, headers, payload, response_format, api_name = build_chutes_request(active_generations[generation_id])
     # Use unified streaming handler
-    yield from stream_api_request(endpoint_url, headers, payload, generation_id, 'openai', 'Chutes API')
+    yield from stream_api_request(endpoint_url, headers, payload, generation_id, response_format, api_name)
 
 def generate_document_name(content):
     """Generate a 2-4 word document name based on content"""
@@ -879,7 +4112,8 @@ Document name:"""
             'stream': False
         }
         
-        response = requests.post('https://openrouter.ai/api/v1/completions', headers=headers, json=payload, timeout=30)
+        endpoint_url = 'https://openrouter.ai/api/v1/completions'
+        response = get_http_session(endpoint_url).post(endpoint_url, headers=headers, json=payload, timeout=30)
         if response.status_code == 200:
             data = response.json()
             name = data.get("choices", [{}])[0].get("text", "").strip()
@@ -898,9 +4132,8 @@ Document name:"""
         logger.error(f"Error generating document name: {e}")
         return "Untitled"
 
-def stream_generator(generation_id):
-    """Generator function for OpenRouter streaming API responses"""
-    generation_data = active_generations[generation_id]
+def build_openrouter_request(generation_data):
+    """Build (endpoint_url, headers, payload, response_format, api_name) for OpenRouter"""
     prompt = generation_data['prompt']
     
     headers = {
@@ -953,13 +4186,138 @@ def stream_generator(generation_id):
     if target_provider:
         payload['provider'] = {'order': [target_provider], 'allow_fallbacks': False}
     
+    return endpoint_url, headers, payload, response_format, 'OpenRouter API'
+
+def stream_generator(generation_id):
+    """Generator function for OpenRouter streaming API responses"""
+    endpoint_url, headers, payload, response_format, api_name = build_openrouter_request(active_generations[generation_id])
     # Use unified streaming handler
-    yield from stream_api_request(endpoint_url, headers, payload, generation_id, response_format, 'OpenRouter API')
+    yield from stream_api_request(endpoint_url, headers, payload, generation_id, response_format, api_name)
+
+def select_request_builder():
+    """Pick the request builder for the provider in the settings"""
+    provider = config.get('provider', 'openrouter')
+    
+    if provider == 'chutes':
+        return build_chutes_request
+    elif provider == 'openai':
+        return build_openai_compat_request
+    elif provider == 'openrouter':
+        return build_openrouter_request
+    else:
+        # Fallback to old logic for backwards compatibility
+        if is_openrouter_format(config['model']):
+            return build_openrouter_request
+        else:
+            return build_openai_compat_request
+
+def build_generation_request(generation_id):
+    """Build the upstream request for a generation with the provider from the settings"""
+    generation_data = active_generations[generation_id]
+    generation_data['request'] = select_request_builder()(generation_data)
+    return generation_data['request']
+
+def needs_fanout(generation_data, payload):
+    """Whether a multi-sample generation has to be sent as one request per sample"""
+    return generation_data.get('n', 1) > 1 and 'n' not in payload
+
+def stream_fanout_request(endpoint_url, headers, payload, generation_id, response_format='openai', api_name='API'):
+    """Stream several samples for a provider without the n parameter
+    
+    The same request is sent once per sample in parallel, and their output
+    is multiplexed into one event stream tagged with each sample's index,
+    the same way a native n > 1 response is passed on.
+    """
+    stream = GenerationStream(generation_id, response_format, api_name)
+    samples = stream.samples
+    received = queue.Queue()
+    
+    def read_sample(index):
+        try:
+            with get_http_session(endpoint_url).post(endpoint_url, headers=headers, json=payload, stream=True, timeout=(5, 30)) as response:
+                if response.status_code != 200:
+                    received.put((index, 'error', get_http_error_message(response.status_code, api_name)))
+                    return
+                for event in iter_events(response.iter_content(chunk_size=1024, decode_unicode=False)):
+                    if stream.closed or not stream.active:
+                        return
+                    content, is_done = parse_sse_stream(event.data, response_format)
+                    if is_done:
+                        break
+                    if content:
+                        received.put((index, 'text', content))
+        except requests.exceptions.Timeout:
+            received.put((index, 'error', f"{api_name} timeout - server took too long to respond"))
+        except requests.exceptions.ConnectionError:
+            received.put((index, 'error', f"{api_name} connection error - unable to connect to server"))
+        except Exception as e:
+            received.put((index, 'error', f"{api_name} error: {str(e)}"))
+        finally:
+            received.put((index, 'done', None))
+    
+    logger.info(f"Making {samples} parallel {api_name} requests to: {endpoint_url}")
+    for index in range(samples):
+        Thread(target=read_sample, args=(index,), name='sample-reader', daemon=True).start()
+    
+    try:
+        errors = []
+        remaining = samples
+        while remaining:
+            try:
+                index, kind, value = received.get(timeout=stream.flush_timeout())
+            except queue.Empty:
+                index, kind = None, None
+            
+            if not stream.active:
+                yield from stream.cancel()
+                return
+            
+            if kind == 'text':
+                stream.add_text(value, index)
+            elif kind == 'error':
+                logger.error(value)
+                errors.append(value)
+                # The other samples carry on; the client marks this one as failed
+                yield sse_event({"index": index, "failed": value})
+            elif kind == 'done':
+                remaining -= 1
+            
+            events = stream.flush()
+            if events:
+                yield ''.join(events)
+        
+        if len(errors) == samples:
+            yield stream.error(errors[0])
+        else:
+            yield ''.join(stream.complete())
+    finally:
+        stream.close()
+
+def stream_generation(generation_id):
+    """Event generator for a generation: a prefetched reroll, parallel samples or a single request"""
+    generation_data = active_generations[generation_id]
+    alternative = generation_data.get('alternative')
+    if alternative:
+        return stream_prefetched_completion(generation_id, alternative)
+    
+    # Determine which backend to use based on provider setting
+    endpoint_url, headers, payload, response_format, api_name = build_generation_request(generation_id)
+    if needs_fanout(generation_data, payload):
+        return stream_fanout_request(endpoint_url, headers, payload, generation_id, response_format, api_name)
+    return stream_api_request(endpoint_url, headers, payload, generation_id, response_format, api_name)
 
 # ============================
 # Routes
 # ============================
 
+@app.before_request
+def start_document_gc():
+    """Start the background sweep with the first request, so only the serving process runs it"""
+    global gc_started
+    if not gc_started:
+        gc_started = True
+        schedule_document_gc()
+
 @app.route('/')
 def index():
     """Render the main application page"""
@@ -969,7 +4327,7 @@ def index():
 def view_document(doc_id):
     """Render a single document view (for middle-click/new tab)"""
     # Set this document as current
-    if doc_id in config['documents']:
+    if doc_id in manifest:
         config['current_document'] = doc_id
     return render_template('index.html', config=config)
 
@@ -994,6 +4352,7 @@ def set_token():
 def settings():
     """Get or update application settings"""
     if request.method == 'POST':
+        previous_target = (provider_endpoint_url(), config['model'])
         # Update settings
         config['model'] = request.form.get('model', config['model'])
         config['temperature'] = float(request.form.get('temperature', config['temperature']))
@@ -1001,12 +4360,19 @@ def settings():
         config['presence_penalty'] = float(request.form.get('presence_penalty', config['presence_penalty']))
         config['repetition_penalty'] = float(request.form.get('repetition_penalty', config['repetition_penalty']))
         config['max_tokens'] = int(request.form.get('max_tokens', config['max_tokens']))
+        config['branches'] = int(request.form.get('branches', config.get('branches', DEFAULT_CONFIG['branches'])))
         config['dark_mode'] = request.form.get('dark_mode') == 'on'  # Convert checkbox value to boolean
         config['provider'] = request.form.get('provider', config.get('provider', 'openrouter'))
         config['custom_api_key'] = request.form.get('custom_api_key', config.get('custom_api_key', ''))
         config['openai_endpoint'] = request.form.get('openai_endpoint', config.get('openai_endpoint', 'http://localhost:8080/v1'))
         config['embeddings_search'] = request.form.get('embeddings_search') == 'on'
         config['untitled_trick'] = request.form.get('untitled_trick') == 'on'
+        # Connect to a newly selected endpoint or model before the first generation needs it
+        endpoint_url = provider_endpoint_url()
+        if (endpoint_url, config['model']) != previous_target:
+            warm_http_session(endpoint_url)
+            if prefix_cache_enabled():
+                prefix_cache_hints.refresh(PrefixCacheHints.base_url(endpoint_url))
         # Debounce config write (1s delay)
         schedule_settings_write()
         return jsonify({'success': True})
@@ -1015,13 +4381,55 @@ def settings():
 
 @app.route('/documents', methods=['GET'])
 def get_documents():
-    """Get list of all documents"""
-    documents = get_all_documents()
-    return jsonify({
-        'success': True,
-        'documents': documents,
-        'current_document': config['current_document']
-    })
+    """Get list of all documents, or one page of it with ?limit=N&cursor=..."""
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+
+    def build_response():
+        if not limit:
+            return {
+                'success': True,
+                'documents': get_all_documents(),
+                'current_document': config['current_document'],
+                'epoch': manifest.epoch,
+                'revision': manifest.revision
+            }
+        key = tuple(cursor.split('|', 1)) if cursor and '|' in cursor else None
+        entries, next_key, revision = manifest.page(max(1, limit), key)
+        return {
+            'success': True,
+            'documents': [listing_fields(entry) for entry in entries],
+            'current_document': config['current_document'],
+            'epoch': manifest.epoch,
+            'revision': revision,
+            'next_cursor': '|'.join(next_key) if next_key else None
+        }
+
+    return conditional_listing(build_response)
+
+@app.route('/documents/changes', methods=['GET'])
+def document_changes():
+    """Listing changes since a revision, for clients that keep a copy of the list"""
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch')
+
+    def build_response():
+        changes = manifest.changes_since(since) if since is not None and epoch == manifest.epoch else None
+        if changes is None:
+            # Unknown run or too far behind: the client needs the full listing
+            return {'success': True, 'reset': True, 'epoch': manifest.epoch, 'revision': manifest.revision}
+        changed, removed, revision = changes
+        return {
+            'success': True,
+            'reset': False,
+            'documents': [listing_fields(entry) for entry in changed],
+            'removed': removed,
+            'current_document': config['current_document'],
+            'epoch': manifest.epoch,
+            'revision': revision
+        }
+
+    return conditional_listing(build_response)
 
 @app.route('/documents/search', methods=['GET'])
 def search_documents():
@@ -1040,70 +4448,61 @@ def search_documents():
         })
     
     matching_documents = []
+    stale_results = 0
     
     if use_embeddings:
-        # Embeddings search only
+        # Embeddings search: one matrix-vector product over the index
         query_embedding = calculate_text_embedding(query)
         logger.info(f"Query embedding calculated: {query_embedding is not None}")
+        ensure_embedding_index()
+        limit = request.args.get('limit', type=int)
         
-        for doc_id in config['documents']:
-            doc_meta = get_document_metadata(doc_id)
+        if query_embedding is not None:
+            ranked = embedding_index.search(query_embedding, limit=limit)
+        else:
+            ranked = [(doc_id, 0.0, 0.0, 0.0, None) for doc_id in manifest.ids()[:limit]]
+        
+        pending_ids = index_worker.pending_ids('name', 'content')
+        for doc_id, similarity_score, content_similarity, name_similarity, passage in ranked:
+            doc_meta = get_document_metadata(doc_id, include_content=False)
             if doc_meta:
-                similarity_score = 0.0
-                if query_embedding:
-                    content_embedding = doc_meta.get('content_embedding')
-                    name_embedding = doc_meta.get('name_embedding')
-                    
-                    # Check similarity with content
-                    content_similarity = 0.0
-                    if content_embedding:
-                        content_similarity = cosine_similarity(query_embedding, content_embedding)
-                    
-                    # Check similarity with name
-                    name_similarity = 0.0
-                    if name_embedding:
-                        name_similarity = cosine_similarity(query_embedding, name_embedding)
-                    
-                    # Use the higher of the two similarities
-                    similarity_score = max(content_similarity, name_similarity)
-                    
-                    logger.info(f"Doc {doc_meta.get('name', 'Untitled')[:20]}: content_sim={content_similarity:.3f}, name_sim={name_similarity:.3f}, max={similarity_score:.3f}")
-                
-                # Include all documents with their similarity scores
-                matching_documents.append({
+                result = {
                     'id': doc_id,
                     'name': doc_meta.get('name', 'Untitled'),
                     'updated_at': doc_meta.get('updated_at'),
                     'created_at': doc_meta.get('created_at'),
                     'similarity_score': similarity_score
-                })
-        
-        # Sort by similarity score (highest first)
-        matching_documents.sort(key=lambda x: x['similarity_score'], reverse=True)
+                }
+                # Point at the matching passage when the content matched better than the name
+                if passage and content_similarity >= name_similarity:
+                    result['passage_offset'], result['passage_length'] = passage
+                # Scored with the last good vectors while a new embedding is queued
+                if doc_id in pending_ids:
+                    result['embedding_pending'] = True
+                    stale_results += 1
+                matching_documents.append(result)
         search_type = 'embeddings'
         
     else:
-        # Keyword search only
-        query_lower = query.lower()
-        for doc_id in config['documents']:
-            doc_meta = get_document_metadata(doc_id)
+        # Keyword search via the inverted index
+        occurrences = count_keyword_occurrences(query)
+        # Counted from the document's last indexed text while its keywords are queued
+        pending_ids = index_worker.pending_ids('keywords')
+        for doc_id in manifest.ids():
+            doc_meta = get_document_metadata(doc_id, include_content=False)
             if doc_meta:
-                # Count occurrences in content and name (case-insensitive)
-                content = doc_meta.get('content', '').lower()
-                name = doc_meta.get('name', '').lower()
-                
-                content_count = content.count(query_lower)
-                name_count = name.count(query_lower)
-                total_occurrences = content_count + name_count
-                
                 # Include all documents with their occurrence counts
-                matching_documents.append({
+                result = {
                     'id': doc_id,
                     'name': doc_meta.get('name', 'Untitled'),
                     'updated_at': doc_meta.get('updated_at'),
                     'created_at': doc_meta.get('created_at'),
-                    'occurrence_count': total_occurrences
-                })
+                    'occurrence_count': occurrences.get(doc_id, 0)
+                }
+                if doc_id in pending_ids:
+                    result['keywords_pending'] = True
+                    stale_results += 1
+                matching_documents.append(result)
         
         # Sort by occurrence count (highest first), then by updated_at
         matching_documents.sort(key=lambda x: (x['occurrence_count'], x['updated_at']), reverse=True)
@@ -1114,9 +4513,29 @@ def search_documents():
         'documents': matching_documents,
         'query': query,
         'search_type': search_type,
-        'total_matches': len(matching_documents)
+        'total_matches': len(matching_documents),
+        'stale_results': stale_results
     })
 
+@app.route('/documents/reindex', methods=['GET', 'POST'])
+def reindex():
+    """Start a background re-index of all embeddings, or report its progress"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if reindex_progress.get('running'):
+            return jsonify({'success': False, 'error': 'Re-index already running', 'progress': reindex_progress})
+        thread = Thread(target=reindex_documents, kwargs={
+            'force': bool(data.get('force')),
+            'restart': bool(data.get('restart'))
+        }, name='reindex', daemon=True)
+        thread.start()
+    return jsonify({'success': True, 'progress': reindex_progress})
+
+@app.route('/documents/cache', methods=['GET'])
+def document_cache_stats():
+    """Report document cache usage and hit/miss/eviction counters"""
+    return jsonify({'success': True, 'cache': documents_cache.stats()})
+
 
 @app.route('/documents/new', methods=['POST'])
 def new_document():
@@ -1136,6 +4555,92 @@ def new_document():
             'error': 'Failed to create document'
         })
 
+@app.route('/documents/<doc_id>/duplicate', methods=['POST'])
+def copy_document(doc_id):
+    """Duplicate a document on the server, sharing its content and vectors with the original"""
+    if doc_id not in manifest:
+        return jsonify({'success': False, 'error': 'Document not found'})
+    data = request.get_json(silent=True) or {}
+    new_id, document = duplicate_document(doc_id, data.get('name'))
+    if new_id:
+        # The client already has the content
+        return jsonify({
+            'success': True,
+            'document': {key: value for key, value in document.items() if key != 'content'}
+        })
+    return jsonify({
+        'success': False,
+        'error': 'Failed to duplicate document'
+    })
+
+@app.route('/documents/<doc_id>/loom', methods=['GET'])
+def get_document_loom(doc_id):
+    """List the nodes of a document's loom"""
+    document = load_document(doc_id)
+    if not document:
+        return jsonify({'success': False, 'error': 'Document not found'})
+    loom = get_loom(doc_id)
+    return jsonify({
+        'success': True,
+        'current': loom.find(document.get('content', '')),
+        'nodes': loom.listing()
+    })
+
+@app.route('/documents/<doc_id>/loom/<node_id>', methods=['GET'])
+def get_loom_node(doc_id, node_id):
+    """Reconstruct the text of one loom node"""
+    if doc_id not in manifest:
+        return jsonify({'success': False, 'error': 'Document not found'})
+    loom = get_loom(doc_id)
+    if node_id not in loom:
+        return jsonify({'success': False, 'error': 'Node not found'})
+    return jsonify({'success': True, 'node': node_id, 'content': loom.text(node_id)})
+
+@app.route('/documents/<doc_id>/loom/switch', methods=['POST'])
+@app.route('/documents/<doc_id>/loom/<node_id>/checkout', methods=['POST'])
+def checkout_loom(doc_id, node_id=None):
+    """Switch a document to a loom node, or to a sibling of its current node ({"step": 1 or -1})"""
+    step = 0
+    if node_id is None:
+        data = request.get_json(silent=True) or {}
+        step = data.get('step', 1)
+        if not isinstance(step, int):
+            return jsonify({'success': False, 'error': 'step must be an integer'}), 400
+    document, node_id = checkout_loom_node(doc_id, node_id, step)
+    if not document:
+        return jsonify({'success': False, 'error': 'Nothing to switch to'})
+    content = document['content']
+    # Where the node's own text starts, in UTF-16 units as the editor counts them
+    start = get_loom(doc_id).completion_start(node_id)
+    if start > 0:
+        start = len(content[:start].encode('utf-16-le')) // 2
+    return jsonify({
+        'success': True,
+        'node': node_id,
+        'content': content,
+        'version': document.get('version', 0),
+        'completion_start': start
+    })
+
+@app.route('/documents/<doc_id>/loom/<node_id>/export', methods=['POST'])
+def export_loom_node(doc_id, node_id):
+    """Copy the text of a loom node into a new, ordinary document"""
+    document = load_document(doc_id)
+    if not document:
+        return jsonify({'success': False, 'error': 'Document not found'})
+    loom = get_loom(doc_id)
+    if node_id not in loom:
+        return jsonify({'success': False, 'error': 'Node not found'})
+    data = request.get_json(silent=True) or {}
+    name = data.get('name') or f"{document.get('name', 'Untitled')} (branch)"
+    new_id, new_document = create_new_document(name, loom.text(node_id))
+    if new_id:
+        return jsonify({'success': True, 'document': new_document})
+    return jsonify({
+        'success': False,
+        'error': 'Failed to export branch'
+    })
+
 @app.route('/documents/<doc_id>', methods=['GET'])
 def get_document(doc_id):
     """Get a specific document by ID"""
@@ -1151,10 +4656,74 @@ def get_document(doc_id):
         'error': 'Document not found'
     })
 
+BULK_FIELDS = ('name', 'content', 'version', 'created_at', 'updated_at')  # fields /documents/bulk can return
+
+@app.route('/documents/bulk', methods=['POST'])
+def bulk_documents():
+    """Stream several documents as NDJSON, one line per requested ID
+
+    Body: {"ids": [...], "fields": [...]}, fields defaulting to all of
+    BULK_FIELDS. Each line is written as soon as its document is read, from
+    the cache if it's there and from disk otherwise, without filling the cache.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    fields = data.get('fields', list(BULK_FIELDS))
+    if not isinstance(ids, list) or not isinstance(fields, list):
+        return jsonify({
+            'success': False,
+            'error': 'Expected a list of ids and optionally a list of fields'
+        })
+    fields = [field for field in fields if field in BULK_FIELDS]
+
+    def generate():
+        for doc_id in ids:
+            document = peek_document(doc_id) if isinstance(doc_id, str) else None
+            if document is None:
+                line = {'id': doc_id, 'error': 'Document not found'}
+            else:
+                line = {'id': doc_id}
+                for field in fields:
+                    line[field] = document.get(field)
+            yield json.dumps(line) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/documents/batch', methods=['POST'])
+def batch_documents():
+    """Delete, rename and clean up several documents in one request
+
+    Body: {"delete": [ids], "rename": {id: name}, "gc_empty_untitled": true}.
+    With gc_empty_untitled, every empty document named "Untitled" is deleted
+    too. All of it is applied together, with one manifest and config write.
+    """
+    data = request.get_json(silent=True) or {}
+    delete_ids = data.get('delete', [])
+    renames = data.get('rename', {})
+    if not isinstance(delete_ids, list) or not isinstance(renames, dict):
+        return jsonify({
+            'success': False,
+            'error': 'Expected a list of IDs to delete and a map of IDs to new names'
+        })
+    if not all(isinstance(name, str) for name in renames.values()):
+        return jsonify({'success': False, 'error': 'New names must be strings'}), 400
+
+    collected = find_empty_untitled_documents() if data.get('gc_empty_untitled') else []
+    deleted, renamed = apply_document_batch(
+        [doc_id for doc_id in delete_ids + collected if isinstance(doc_id, str)],
+        {doc_id: name.strip() for doc_id, name in renames.items() if name}
+    )
+    return jsonify({
+        'success': True,
+        'deleted': deleted,
+        'renamed': renamed,
+        'current_document': config['current_document']
+    })
+
 @app.route('/documents/<doc_id>/set-current', methods=['POST'])
 def set_current_document(doc_id):
     """Set the currently active document"""
-    if doc_id in config['documents']:
+    if doc_id in manifest:
         config['current_document'] = doc_id
         # Don't save config just for switching documents
         return jsonify({'success': True})
@@ -1167,7 +4736,7 @@ def set_current_document(doc_id):
 @app.route('/documents/<doc_id>', methods=['PUT'])
 def update_document(doc_id):
     """Update an existing document"""
-    if doc_id not in config['documents']:
+    if doc_id not in manifest:
         return jsonify({
             'success': False,
             'error': 'Document not found'
@@ -1204,10 +4773,58 @@ def update_document(doc_id):
         'error': 'Failed to update document'
     })
 
+@app.route('/documents/<doc_id>', methods=['PATCH'])
+def patch_document(doc_id):
+    """Apply an edit delta to a document's content
+
+    Expects {"base_version": n, "ops": [[offset, delete_count, insert_text], ...]}.
+    Answers 409 with the current version if the document has moved on, so
+    the client can resync with a full PUT.
+    """
+    if doc_id not in manifest:
+        return jsonify({
+            'success': False,
+            'error': 'Document not found'
+        })
+    
+    data = request.json
+    if not data or type(data.get('base_version')) is not int or not isinstance(data.get('ops'), list):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid patch data'
+        })
+    
+    try:
+        success, document = patch_document_content(doc_id, data['base_version'], data['ops'])
+    except VersionConflict as e:
+        return jsonify({
+            'success': False,
+            'error': 'Version conflict',
+            'version': e.args[0]
+        }), 409
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+    
+    if success:
+        # Only the new version goes back: the client already has the content
+        return jsonify({
+            'success': True,
+            'version': document.get('version', 0),
+            'updated_at': document.get('updated_at')
+        })
+    
+    return jsonify({
+        'success': False,
+        'error': 'Failed to update document'
+    })
+
 @app.route('/documents/<doc_id>', methods=['DELETE'])
 def remove_document(doc_id):
     """Delete a document"""
-    if doc_id not in config['documents']:
+    if doc_id not in manifest:
         return jsonify({
             'success': False,
             'error': 'Document not found'
@@ -1225,17 +4842,37 @@ def remove_document(doc_id):
 @app.route('/submit', methods=['POST'])
 def submit():
     """Submit a prompt for text generation"""
-    prompt = request.form.get('prompt', '')
+    prompt = request.form.get('prompt')
     doc_id = request.form.get('document_id')
+    base_version = request.form.get('version', type=int)
+    samples = min(max(request.form.get('n', 1, type=int), 1), MAX_SAMPLES)
     
     # Only require token for OpenRouter, not for OpenAI-compatible endpoints
     if config.get('provider') == 'openrouter' and not config['token']:
         return jsonify({'success': False, 'error': 'No token provided'})
     
+    # A client whose edits are all saved sends the version instead of the prompt
+    document = load_document(doc_id) if doc_id else None
+    if prompt is None and doc_id:
+        if not document or document.get('version', 0) != base_version:
+            return jsonify({
+                'success': False,
+                'error': 'Version conflict',
+                'version': document.get('version', 0) if document else None
+            }), 409
+        prompt = generation_prompt(document.get('content', ''))
+    elif prompt is None:
+        prompt = ''
+    elif document and generation_prompt(document.get('content', '')) != prompt:
+        # The editor has edits the server hasn't got: the output goes back with
+        # the client's own save, against the version it holds
+        document = None
+    
     # If prompt is empty, use seed prompt
     if not prompt or not prompt.strip():
         prompt = SEED_PROMPT
         is_seed = True
+        samples = 1
     else:
         is_seed = False
     
@@ -1247,9 +4884,23 @@ def submit():
         'prompt': prompt,
         'document_id': doc_id,
         'active': True,
-        'is_seed': is_seed
+        'is_seed': is_seed,
+        'n': samples
     }
     
+    # A reroll can be served from a completion prefetched for the same prompt and settings
+    if document and not is_seed and samples == 1:
+        request_data = select_request_builder()(active_generations[generation_id])
+        alternative = reroll_prefetcher.take(doc_id, prompt, request_data)
+        if alternative:
+            active_generations[generation_id]['alternative'] = alternative
+            active_generations[generation_id]['request'] = request_data
+    # Several samples are branches to pick from, so only a single completion goes into the document
+    if document and samples == 1:
+        begin_generation_document(active_generations[generation_id], document)
+    elif document:
+        active_generations[generation_id]['branch_base'] = document.get('content', '')
+    
     return jsonify({'success': True, 'generation_id': generation_id})
 
 @app.route('/cancel/<generation_id>', methods=['POST'])
@@ -1324,28 +4975,19 @@ def get_seed():
         logger.info(f"Making seed request to: {endpoint_url}")
         
         accumulated = ''
-        with requests.post(endpoint_url, headers=headers, json=payload, stream=True, timeout=30) as response:
+        with get_http_session(endpoint_url).post(endpoint_url, headers=headers, json=payload, stream=True, timeout=30) as response:
             if response.status_code != 200:
                 return jsonify({'success': False, 'error': f'API error: {response.status_code}'})
             
-            buffer = ""
-            for chunk in response.iter_content(chunk_size=1024, decode_unicode=False):
-                if chunk:
-                    buffer += chunk.decode('utf-8', errors='replace')
-                    while '\n' in buffer:
-                        line_end = buffer.find('\n')
-                        line = buffer[:line_end].strip()
-                        buffer = buffer[line_end + 1:]
-                        
-                        if line.startswith('data: '):
-                            response_format = 'chat' if use_anthropic_trick else 'openai'
-                            content, is_done = parse_sse_stream(line, response_format)
-                            if is_done:
-                                break
-                            if content:
-                                accumulated += content
-                                if any(token in accumulated for token in SEED_STOP_TOKENS):
-                                    break
+            response_format = 'chat' if use_anthropic_trick else 'openai'
+            for event in iter_events(response.iter_content(chunk_size=1024, decode_unicode=False)):
+                content, is_done = parse_sse_stream(event.data, response_format)
+                if is_done:
+                    break
+                if content:
+                    accumulated += content
+                    if any(token in accumulated for token in SEED_STOP_TOKENS):
+                        break
         
         # Clean up result
         min_idx = min((accumulated.find(t) for t in SEED_STOP_TOKENS if t in accumulated), default=len(accumulated))
@@ -1365,23 +5007,9 @@ def stream(generation_id):
         return Response("data: " + json.dumps({"error": "Generation not found"}) + "\n\n", 
                        mimetype="text/event-stream")
     
-    # Determine which backend to use based on provider setting
-    provider = config.get('provider', 'openrouter')
-    
-    if provider == 'chutes':
-        generator = chutes_stream_generator(generation_id)
-    elif provider == 'openai':
-        generator = openai_compat_stream_generator(generation_id)
-    elif provider == 'openrouter':
-        generator = stream_generator(generation_id)
-    else:
-        # Fallback to old logic for backwards compatibility
-        if is_openrouter_format(config['model']):
-            generator = stream_generator(generation_id)
-        else:
-            generator = openai_compat_stream_generator(generation_id)
-    
-    response = Response(generator, mimetype="text/event-stream")
+    # Clients report how long they take to render an event, which sets how often they get one
+    active_generations[generation_id]['render_ms'] = request.args.get('render_ms', type=float)
+    response = Response(stream_generation(generation_id), mimetype="text/event-stream")
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'
     return response
@@ -1391,41 +5019,50 @@ def stream(generation_id):
 # ============================
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Text completion sandbox')
+    subparsers = parser.add_subparsers(dest='command')
+    reindex_parser = subparsers.add_parser('reindex', help='Rebuild search embeddings for all documents')
+    reindex_parser.add_argument('--model', help='Switch to a different model2vec embeddings model first')
+    reindex_parser.add_argument('--force', action='store_true', help='Re-embed passages that already have vectors')
+    reindex_parser.add_argument('--restart', action='store_true', help='Ignore progress from an interrupted run')
+    reindex_parser.add_argument('--batch-size', type=int, default=REINDEX_BATCH_TEXTS,
+                                help='Texts per model.encode call')
+    args = parser.parse_args()
+    
+    if args.command == 'reindex':
+        if args.model and args.model != config['embeddings_model']:
+            # Nothing is embedded with the new model yet, so every document is re-indexed
+            switch_embeddings_model(args.model)
+            args.restart = True
+        ok = reindex_documents(force=args.force, restart=args.restart, batch_texts=args.batch_size)
+        raise SystemExit(0 if ok else 1)
+    
     app.run(debug=True)
 
-# Load all documents into cache at startup
-def init_documents_cache():
-    """Initialize the documents cache with all documents from disk"""
-    for doc_id in config['documents']:
-        doc_path = get_document_path(doc_id)
-        if os.path.exists(doc_path):
-            try:
-                with open(doc_path, 'r') as f:
-                    document = json.load(f)
-                    documents_cache[doc_id] = document
-                    logger.info(f"Document {doc_id} loaded into cache")
-            except Exception as e:
-                logger.error(f"Error loading document {doc_id} into cache: {e}")
-
-# Initialize cache at startup
-init_documents_cache()
-
 # Ensure writes are flushed on shutdown
 import atexit
 
 @atexit.register
 def cleanup():
-    """Save currently open document on shutdown"""
+    """Write unsaved documents and indexes on shutdown"""
     global settings_write_timer
+    if RELOADER_PARENT:
+        return
     # Cancel pending timers
     for timer in document_write_timers.values():
         if timer:
             timer.cancel()
     if settings_write_timer:
         settings_write_timer.cancel()
+    vector_store.flush()
+    if keyword_index.write_timer:
+        keyword_index.save()
     
-    # Only save the currently open document
-    current_doc = config.get('current_document')
-    if current_doc and current_doc in documents_cache:
-        write_document_to_disk(current_doc)
-        logger.info(f"Saved current document {current_doc} on shutdown")
\ No newline at end of file
+    # Write every document with unsaved changes, then commit and save the manifest once
+    with write_lock:
+        saved = [doc_id for doc_id in list(documents_cache.dirty) if persist_document(doc_id)]
+        document_journal.commit()
+        manifest.save()
+    if saved:
+        logger.info(f"Saved {len(saved)} documents on shutdown")
@@ -0,0 +1,222 @@
+"""Async serving mode for many concurrent generations
+
+`python app.py` serves everything through Flask, so each streaming
+generation holds a thread while it waits on the upstream API. This module
+serves /stream/<generation_id> with async upstream requests and async SSE
+instead, so hundreds of streams can share one process and one event loop.
+Every other route is passed through to the Flask app unchanged.
+
+Requires: pip install httpx uvicorn asgiref (and h2 for HTTP/2)
+Run with: python asgi.py  (or: uvicorn asgi:app)
+"""
+import asyncio
+import json
+import re
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (app as flask_app, active_generations, build_generation_request, config,
+                 DEFAULT_CONFIG, GenerationStream, logger, needs_fanout, stream_generation)
+
+try:
+    import h2  # noqa: F401 - httpx negotiates HTTP/2 when this is installed
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+ASYNC_MAX_CONNECTIONS = 512  # upstream connections across all streams to one host
+STREAM_ROUTE = re.compile(r'^/stream/([^/]+)$')
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+# One pooled client per API host, like the sync sessions in app.py
+http_clients = {}
+
+def get_async_client(url):
+    """Get the pooled async client for a URL's host"""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    client = http_clients.get(origin)
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=config.get('http_pool_size', DEFAULT_CONFIG['http_pool_size'])
+        )
+        client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits)
+        http_clients[origin] = client
+    return client
+
+async def stream_events(generation_id, render_ms=None):
+    """Async counterpart of stream_api_request: yields SSE events for a generation"""
+    if generation_id not in active_generations:
+        yield "data: " + json.dumps({"error": "Generation not found"}) + "\n\n"
+        return
+
+    generation_data = active_generations[generation_id]
+    generation_data['render_ms'] = render_ms
+    if generation_data.get('alternative') or needs_fanout(generation_data, build_generation_request(generation_id)[2]):
+        # Prefetched rerolls come from memory and parallel samples already read on their own
+        # threads, so their sync generators are cheap to drive from a worker thread
+        events = stream_generation(generation_id)
+        try:
+            while True:
+                event = await asyncio.to_thread(next, events, None)
+                if event is None:
+                    return
+                yield event
+        finally:
+            await asyncio.to_thread(events.close)
+
+    endpoint_url, headers, payload, response_format, api_name = generation_data['request']
+    stream = GenerationStream(generation_id, response_format, api_name)
+
+    try:
+        logger.info(f"Making async {api_name} request to: {endpoint_url}")
+
+        client = get_async_client(endpoint_url)
+        timeout = httpx.Timeout(30, connect=5)
+        async with client.stream('POST', endpoint_url, headers=headers, json=payload, timeout=timeout) as response:
+            # Handle HTTP errors
+            if response.status_code != 200:
+                await response.aread()
+                try:
+                    error_detail = response.json()
+                except:
+                    error_detail = None
+                yield await asyncio.to_thread(stream.http_error, response.status_code, error_detail)
+                return
+
+            # Stream response, reading on a separate task so held text is flushed on time
+            chunks = asyncio.Queue()
+            read_error = None
+
+            async def read():
+                nonlocal read_error
+                try:
+                    async for chunk in response.aiter_bytes(chunk_size=1024):
+                        if chunk:
+                            chunks.put_nowait(chunk)
+                except Exception as e:
+                    read_error = e
+                finally:
+                    chunks.put_nowait(None)
+
+            reader = asyncio.create_task(read())
+            try:
+                while not stream.done:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.get(), stream.flush_timeout())
+                    except asyncio.TimeoutError:
+                        chunk = b''
+
+                    if not stream.active:
+                        yield ''.join(await asyncio.to_thread(stream.cancel))
+                        return
+                    if chunk is None:
+                        if read_error:
+                            raise read_error
+                        break
+
+                    # Take everything that arrived while the client was being written to
+                    parts = [chunk]
+                    while not chunks.empty():
+                        more = chunks.get_nowait()
+                        if more is None:
+                            chunks.put_nowait(None)
+                            break
+                        parts.append(more)
+                    chunk = b''.join(parts)
+
+                    events = stream.feed(chunk) if chunk else stream.flush()
+                    if events:
+                        yield ''.join(events)
+                    if stream.checkpoint_due():
+                        await asyncio.to_thread(stream.checkpoint)
+            finally:
+                reader.cancel()
+
+        yield ''.join(await asyncio.to_thread(stream.complete))
+
+    except httpx.TimeoutException:
+        logger.error(f"{api_name} timeout")
+        yield await asyncio.to_thread(stream.error, f"{api_name} timeout - server took too long to respond")
+    except httpx.TransportError as e:
+        logger.error(f"{api_name} connection error: {str(e)}")
+        yield await asyncio.to_thread(stream.error, f"{api_name} connection error - unable to connect to server")
+    except Exception as e:
+        logger.error(f"{api_name} error: {str(e)}")
+        yield await asyncio.to_thread(stream.error, f"{api_name} error: {str(e)}")
+    finally:
+        # The client may have disconnected mid-stream: keep what was generated
+        await asyncio.to_thread(stream.close)
+
+async def stream_response(generation_id, render_ms, receive, send):
+    """Send a generation's events as an SSE response until it ends or the client leaves"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+    events = stream_events(generation_id, render_ms)
+    try:
+        async for event in events:
+            if disconnected.is_set():
+                break
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'), 'more_body': True})
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    except OSError:
+        # The client went away while we were sending
+        pass
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for client in http_clients.values():
+                await client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """ASGI entry point: async streaming, everything else through Flask"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        match = STREAM_ROUTE.match(scope['path'])
+        if match:
+            query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            try:
+                render_ms = float(query['render_ms'][0])
+            except (KeyError, ValueError):
+                render_ms = None
+            await stream_response(match.group(1), render_ms, receive, send)
+            return
+    await wsgi_app(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='127.0.0.1', port=5000)
@@ -0,0 +1,83 @@
+"""Micro-benchmark for the SSE parser in sse.py
+
+Replays streamed API responses through sse.SSEParser and through the
+line-splitting loop it replaced, and reports throughput and how many
+events each got wrong.
+
+    python bench_sse.py                    # synthetic completion streams
+    python bench_sse.py stream.txt ...     # recorded response bodies
+
+Record a body with e.g. `curl -N <endpoint> -d '{..., "stream": true}' > stream.txt`.
+"""
+import json
+import random
+import sys
+import time
+
+from sse import SSEParser
+
+def legacy_parse(chunks):
+    """The previous parser: decode each chunk, then slice lines off a str buffer"""
+    data = []
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.decode('utf-8', errors='replace')
+        while '\n' in buffer:
+            line_end = buffer.find('\n')
+            line = buffer[:line_end].strip()
+            buffer = buffer[line_end + 1:]
+            if line.startswith('data: '):
+                data.append(line[6:])
+    return data
+
+def sse_parse(chunks):
+    parser = SSEParser()
+    data = []
+    for chunk in chunks:
+        data.extend(event.data for event in parser.feed(chunk))
+    data.extend(event.data for event in parser.close())
+    return data
+
+def synthetic_stream(events, seed=0):
+    """A completions stream of short tokens, some of them multi-byte"""
+    rng = random.Random(seed)
+    tokens = [' the', ' a', ' river', ',', '.', '\n', ' café', ' 東京', ' 🙂', ' naïve', ' —']
+    body = bytearray()
+    for _ in range(events):
+        event = {'id': 'cmpl-1', 'object': 'text_completion', 'choices': [{'index': 0, 'text': rng.choice(tokens)}]}
+        body += b'data: ' + json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n\n'
+    body += b'data: [DONE]\n\n'
+    return bytes(body)
+
+def chunked(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+def expected_data(body):
+    """Reference result: the data of every event, decoded from the whole body at once"""
+    return legacy_parse([body])
+
+def bench(name, body, chunk_size, repeats=5):
+    chunks = chunked(body, chunk_size)
+    expected = expected_data(body)
+    print(f"{name}: {len(body) / 1024:.0f} KiB, {len(expected)} events, {chunk_size} byte chunks")
+    for label, parse in (('legacy', legacy_parse), ('sse.py', sse_parse)):
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = parse(chunks)
+            best = min(best, time.perf_counter() - start)
+        wrong = sum(1 for got, want in zip(result, expected) if got != want) + abs(len(result) - len(expected))
+        print(f"  {label:7} {best * 1000:8.2f} ms  {len(body) / best / 1e6:7.1f} MB/s  {wrong} events wrong")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                body = f.read()
+            for chunk_size in (1024, 65536):
+                bench(path, body, chunk_size)
+    else:
+        for events in (500, 20000):
+            body = synthetic_stream(events)
+            for chunk_size in (1024, 65536):
+                bench(f"synthetic x{events}", body, chunk_size)
@@ -0,0 +1,136 @@
+"""Incremental parser for server-sent event streams
+
+Used for every streamed API response. Chunks are appended to one bytearray
+and split into lines at the byte level, so each chunk is scanned once and
+the buffer is compacted once per chunk instead of once per line. Only
+complete lines are decoded: a UTF-8 line break byte never occurs inside a
+multi-byte character, so characters split across chunks arrive intact.
+
+Follows the EventSource format: lines end in LF, CRLF or CR, a blank line
+dispatches the event, `data:` lines accumulate (joined with newlines),
+`event:` and `id:` are kept, lines starting with `:` are comments.
+"""
+from collections import namedtuple
+
+SSEEvent = namedtuple('SSEEvent', ['data', 'event', 'id'])
+
+LF = 0x0A
+COLON = 0x3A
+SPACE = 0x20
+
+class SSEParser:
+    """Turns response body chunks into SSEEvents"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.data_lines = []
+        self.event_type = ''
+        self.last_event_id = ''
+        self.retry = None
+        self.skip_lf = False  # the last chunk ended in CR, which may be half of a CRLF
+
+    def feed(self, chunk):
+        """Parse a chunk of the body; returns the events it completed"""
+        events = []
+        buffer = self.buffer
+        buffer += chunk
+        position = 0
+        if self.skip_lf and buffer[:1] == b'\n':
+            position = 1
+        self.skip_lf = False
+
+        if buffer.find(b'\r', position) == -1:
+            # Fast path: LF line endings only, as every API we talk to sends
+            data_lines = self.data_lines
+            while True:
+                lf = buffer.find(b'\n', position)
+                if lf == -1:
+                    break
+                if buffer.startswith(b'data: ', position, lf):
+                    data_lines.append(buffer[position + 6:lf].decode('utf-8', 'replace'))
+                elif lf == position and data_lines and not self.event_type:
+                    events.append(SSEEvent(data_lines[0] if len(data_lines) == 1 else '\n'.join(data_lines),
+                                           'message', self.last_event_id))
+                    data_lines.clear()
+                else:
+                    self._line(buffer, position, lf, events)
+                    data_lines = self.data_lines
+                position = lf + 1
+        else:
+            length = len(buffer)
+            lf = buffer.find(b'\n', position)
+            while True:
+                if lf != -1 and lf < position:
+                    lf = buffer.find(b'\n', position)
+                cr = buffer.find(b'\r', position, length if lf == -1 else lf)
+                if cr != -1:
+                    line_end = cr
+                    if cr + 1 == length:
+                        next_position = length
+                        self.skip_lf = True
+                    else:
+                        next_position = cr + 2 if buffer[cr + 1] == LF else cr + 1
+                elif lf != -1:
+                    line_end = lf
+                    next_position = lf + 1
+                else:
+                    break
+                self._line(buffer, position, line_end, events)
+                position = next_position
+
+        del buffer[:position]
+        return events
+
+    def close(self):
+        """End of the body; returns an event left without its closing blank line, if any"""
+        events = []
+        if self.buffer:
+            self._line(self.buffer, 0, len(self.buffer), events)
+            self.buffer.clear()
+        self._dispatch(events)
+        return events
+
+    def _line(self, buffer, start, end, events):
+        if start == end:
+            self._dispatch(events)
+            return
+        
+        if buffer.startswith(b'data:', start, end):
+            field, value_start = b'data', start + 5
+        elif buffer[start] == COLON:
+            return
+        else:
+            colon = buffer.find(b':', start, end)
+            if colon == -1:
+                field, value_start = bytes(buffer[start:end]), end
+            else:
+                field, value_start = bytes(buffer[start:colon]), colon + 1
+        if value_start < end and buffer[value_start] == SPACE:
+            value_start += 1
+        value = buffer[value_start:end]
+
+        if field == b'data':
+            self.data_lines.append(value.decode('utf-8', 'replace'))
+        elif field == b'event':
+            self.event_type = value.decode('utf-8', 'replace')
+        elif field == b'id':
+            if b'\0' not in value:
+                self.last_event_id = value.decode('utf-8', 'replace')
+        elif field == b'retry':
+            if value.isdigit():
+                self.retry = int(value)
+
+    def _dispatch(self, events):
+        if self.data_lines:
+            data = self.data_lines[0] if len(self.data_lines) == 1 else '\n'.join(self.data_lines)
+            events.append(SSEEvent(data, self.event_type or 'message', self.last_event_id))
+        self.data_lines = []
+        self.event_type = ''
+
+def iter_events(chunks):
+    """Parse an iterable of body chunks into SSEEvents"""
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.close()
@@ -16,6 +16,17 @@ let suppressInputHandler = false;  // Prevent input handler during programmatic
 let pendingDocumentLoad = null;  // Track which document is being loaded (prevent race conditions)
 let documentContentCache = new Map();  // Cache document contents for instant switching
 let promptBoundary = -1;  // Track where prompt ends and generated text begins (-1 = no styling)
+let pendingPassageReveal = null;  // Search passage to scroll to once its document is shown
+let saveChain = Promise.resolve();  // Saves run one at a time so each patch builds on the last version
+let streamRenderMs = 0;  // Recent cost of rendering one streamed event; the server paces events to it
+let virtualEditor = null;  // Windowed view of a large document, or null when the editor holds all of it
+let documentListing = null;  // Sidebar list {epoch, revision, documents}, kept current through /documents/changes
+
+// Documents longer than this many characters only keep the visible part in the editor
+const VIRTUAL_EDITOR_THRESHOLD = 300000;
+const VIRTUAL_BLOCK_SIZE = 4096;  // Target block length, in characters
+const VIRTUAL_MARGIN = 1.5;  // Viewport heights kept rendered above and below the visible text
+const DOCUMENT_PAGE_SIZE = 500;  // Documents per request when fetching the whole list
 
 // Cache DOM elements
 const domElements = {
@@ -31,6 +42,10 @@ const domElements = {
     submitBtn: document.getElementById('submit-btn'),
     cancelBtn: document.getElementById('cancel-btn'),
     rerollBtn: document.getElementById('reroll-btn'),
+    branchBtn: document.getElementById('branch-btn'),
+    branchPanel: document.getElementById('branch-panel'),
+    branchList: document.getElementById('branch-list'),
+    closeBranchesBtn: document.getElementById('close-branches-btn'),
     copyAllBtn: document.getElementById('copy-all-btn'),
     duplicateBtn: document.getElementById('duplicate-btn'),
     seedBtn: document.getElementById('seed-btn'),
@@ -85,10 +100,31 @@ function initEditor() {
     editorWrapper.appendChild(editorDiv);
     editor = editorDiv;
 
+    // Cancel previous save timer and schedule new one (2s delay)
+    const scheduleSave = () => {
+        if (window.saveTimer) {
+            clearTimeout(window.saveTimer);
+        }
+        window.saveTimer = setTimeout(() => {
+            saveCurrentDocument();
+            window.saveTimer = null;
+        }, 2000);  // 2s delay, backend handles 30s max during continuous typing
+    };
+
     // Track content changes and auto-save after 2s of no typing (backend handles 30s max)
     editor.addEventListener('input', function() {
         if (!currentDocument || suppressInputHandler) return;
 
+        if (virtualEditor) {
+            // Read back only the rendered text; the whole document is joined when it is saved
+            if (!virtualEditor.reconcile()) return;
+            lastCheckpoint = null;
+            promptBoundary = -1;
+            virtualEditor.clearStyling();
+            scheduleSave();
+            return;
+        }
+
         const currentContent = getEditorText();
         if (currentContent === lastContent) return;
 
@@ -114,14 +150,7 @@ function initEditor() {
         // Update lastContent immediately to prevent duplicate saves
         lastContent = currentContent;
 
-        // Cancel previous save timer and schedule new one (2s delay)
-        if (window.saveTimer) {
-            clearTimeout(window.saveTimer);
-        }
-        window.saveTimer = setTimeout(() => {
-            saveCurrentDocument();
-            window.saveTimer = null;
-        }, 2000);  // 2s delay, backend handles 30s max during continuous typing
+        scheduleSave();
     });
 
     // Add keyboard shortcuts
@@ -139,6 +168,19 @@ function initEditor() {
             e.preventDefault();
             document.execCommand('insertText', false, '    ');
         }
+
+        // Alt + PageUp/PageDown to switch between rerolls of the same text
+        // (Alt + arrows already move the cursor by word on macOS)
+        if (e.altKey && (e.key === 'PageUp' || e.key === 'PageDown')) {
+            e.preventDefault();
+            switchLoomBranch(e.key === 'PageUp' ? -1 : 1);
+        }
+
+        // Keep line breaks inside the text of the windowed editor's blocks
+        if (e.key === 'Enter' && virtualEditor && !e.defaultPrevented) {
+            e.preventDefault();
+            document.execCommand('insertText', false, '\n');
+        }
     });
 
     // Handle paste to strip formatting
@@ -176,6 +218,7 @@ function escapeHtml(text) {
  */
 function getEditorText() {
     if (!editor) return '';
+    if (virtualEditor) return virtualEditor.text();
     return editor.tagName === 'TEXTAREA' ? editor.value : (editor.textContent || '');
 }
 
@@ -187,6 +230,18 @@ function getEditorText() {
 function setEditorContent(text, promptEnd = -1) {
     if (!editor) return;
 
+    if (text.length >= VIRTUAL_EDITOR_THRESHOLD && editor.tagName !== 'TEXTAREA') {
+        if (!virtualEditor) {
+            virtualEditor = createVirtualEditor(editor);
+        }
+        virtualEditor.load(text, promptEnd);
+        return;
+    }
+    if (virtualEditor) {
+        virtualEditor.destroy();
+        virtualEditor = null;
+    }
+
     if (editor.tagName === 'TEXTAREA') {
         editor.value = text;
         return;
@@ -202,6 +257,524 @@ function setEditorContent(text, promptEnd = -1) {
     }
 }
 
+/**
+ * Render streamed text by appending to the generated-text node in place
+ * Deltas are queued and applied once per animation frame, so each frame costs
+ * the size of the new text rather than the size of the document.
+ * @param {String} originalText - Editor text when the stream started
+ * @param {Object} doc - Document the stream belongs to
+ */
+function createStreamRenderer(originalText, doc) {
+    let generated = '';
+    let pending = '';
+    let frame = null;
+    let textNode = null;
+
+    // Build the styled editor once; later deltas go into the empty generated span
+    const attach = () => {
+        if (virtualEditor) {
+            virtualEditor.beginGenerated();
+            return;
+        }
+        if (editor.tagName === 'TEXTAREA') {
+            editor.value = originalText + generated;
+            return;
+        }
+        const promptSpan = document.createElement('span');
+        promptSpan.className = 'prompt-text';
+        promptSpan.textContent = originalText;
+        const generatedSpan = document.createElement('span');
+        generatedSpan.className = 'generated-text';
+        textNode = document.createTextNode(generated);
+        generatedSpan.appendChild(textNode);
+        editor.replaceChildren(promptSpan, generatedSpan);
+    };
+
+    const render = () => {
+        frame = null;
+        if (!pending) return;
+
+        const renderStart = performance.now();
+        const scrollAtBottom = editor.scrollTop >= (editor.scrollHeight - editor.clientHeight - 10);
+
+        generated += pending;
+        if (currentDocument !== doc) {
+            // The editor shows another document now
+        } else if (virtualEditor) {
+            virtualEditor.append(pending);
+        } else if (textNode && textNode.isConnected) {
+            // Ranges before the end of the node keep their offsets, so selection is untouched
+            textNode.appendData(pending);
+        } else if (editor.tagName === 'TEXTAREA') {
+            editor.setRangeText(pending, editor.value.length, editor.value.length);
+        } else {
+            // The editor was replaced mid-stream: render it whole once, then append again
+            attach();
+        }
+        pending = '';
+
+        if (scrollAtBottom) {
+            editor.scrollTop = editor.scrollHeight;
+        }
+
+        // Update lastContent to prevent input handler from triggering
+        // Backend will save immediately after generation completes
+        lastContent = originalText + generated;
+
+        // Moving average, so one slow frame doesn't slow down the next stream
+        streamRenderMs = streamRenderMs * 0.8 + (performance.now() - renderStart) * 0.2;
+    };
+
+    attach();
+
+    return {
+        append(text) {
+            pending += text;
+            if (frame === null) {
+                frame = requestAnimationFrame(render);
+            }
+        },
+        // Apply queued text now, before the editor is read or saved
+        flush() {
+            if (frame !== null) {
+                cancelAnimationFrame(frame);
+            }
+            render();
+        }
+    };
+}
+
+/**
+ * Windowed editor for very large documents
+ * The text is held as a list of blocks (a flat rope). Only the blocks in and near
+ * the viewport are in the DOM, between two spacers sized like the rest, so the
+ * browser lays out and serializes a few screens of text instead of the document.
+ * Edits are read back from the rendered blocks alone; the full text is joined
+ * only when something asks for it, and kept until the next change.
+ * @param {HTMLElement} view - The contenteditable editor element
+ */
+function createVirtualEditor(view) {
+    let blocks = [];
+    let first = 0;  // Rendered blocks are blocks[first..last]
+    let last = -1;
+    let joined = null;
+    let pxPerChar = 0;
+    let promptStyled = false;
+    let frame = null;
+
+    const topSpacer = document.createElement('div');
+    const bottomSpacer = document.createElement('div');
+    for (const spacer of [topSpacer, bottomSpacer]) {
+        spacer.className = 'virtual-spacer';
+        spacer.contentEditable = 'false';
+    }
+
+    const makeBlock = (text, generated = false) => ({ text, generated, height: null, el: null });
+
+    // Cut text into blocks of about VIRTUAL_BLOCK_SIZE, at a line break when one is near
+    const split = (text, generated = false) => {
+        const result = [];
+        let start = 0;
+        while (start < text.length) {
+            let end = start + VIRTUAL_BLOCK_SIZE;
+            if (end >= text.length) {
+                end = text.length;
+            } else {
+                const lineEnd = text.indexOf('\n', end);
+                if (lineEnd !== -1 && lineEnd < end + VIRTUAL_BLOCK_SIZE) {
+                    end = lineEnd + 1;
+                } else if (text.charCodeAt(end - 1) >= 0xD800 && text.charCodeAt(end - 1) <= 0xDBFF) {
+                    end++;  // Don't split a surrogate pair
+                }
+            }
+            result.push(makeBlock(text.substring(start, end), generated));
+            start = end;
+        }
+        return result;
+    };
+
+    const blockClass = block => {
+        if (block.generated) return 'virtual-block generated-text';
+        return promptStyled ? 'virtual-block prompt-text' : 'virtual-block';
+    };
+
+    const renderBlock = block => {
+        const span = document.createElement('span');
+        span.className = blockClass(block);
+        span.textContent = block.text;
+        span.virtualBlock = block;
+        block.el = span;
+        return span;
+    };
+
+    // Blocks may also be text nodes the browser created, so measure through a range
+    const rectOf = node => {
+        const range = document.createRange();
+        range.selectNode(node);
+        return range.getBoundingClientRect();
+    };
+
+    const heightOf = block => block.height !== null ? block.height : block.text.length * pxPerChar;
+
+    const estimatePxPerChar = () => {
+        const style = getComputedStyle(view);
+        const fontSize = parseFloat(style.fontSize) || 16;
+        const lineHeight = parseFloat(style.lineHeight) || fontSize * 1.6;
+        const charsPerLine = Math.max(20, view.clientWidth / (fontSize * 0.5));
+        return lineHeight / charsPerLine;
+    };
+
+    // Unrendered blocks are sized from what the rendered ones measured
+    const updatePxPerChar = () => {
+        let height = 0;
+        let chars = 0;
+        for (const block of blocks) {
+            if (block.height !== null) {
+                height += block.height;
+                chars += block.text.length;
+            }
+        }
+        if (chars > 0) {
+            pxPerChar = height / chars;
+        }
+    };
+
+    const layoutSpacers = () => {
+        let above = 0;
+        let below = 0;
+        for (let i = 0; i < first; i++) above += heightOf(blocks[i]);
+        for (let i = last + 1; i < blocks.length; i++) below += heightOf(blocks[i]);
+        topSpacer.style.height = `${above}px`;
+        bottomSpacer.style.height = `${below}px`;
+    };
+
+    // Render the blocks in and near the viewport and release the rest
+    const updateWindow = () => {
+        frame = null;
+        const margin = view.clientHeight * VIRTUAL_MARGIN;
+        const top = view.scrollTop - margin;
+        const bottom = view.scrollTop + view.clientHeight + margin;
+
+        let newFirst = blocks.length - 1;
+        let newLast = blocks.length - 1;
+        let found = false;
+        let y = 0;
+        for (let i = 0; i < blocks.length; i++) {
+            const height = heightOf(blocks[i]);
+            if (!found && y + height >= top) {
+                newFirst = i;
+                found = true;
+            }
+            if (y > bottom) {
+                newLast = Math.max(newFirst, i - 1);
+                break;
+            }
+            y += height;
+        }
+
+        // A block that stays rendered keeps its place on screen while heights above it are corrected
+        let anchor = null;
+        for (let i = Math.max(first, newFirst); i <= Math.min(last, newLast); i++) {
+            if (blocks[i].el) {
+                anchor = blocks[i].el;
+                break;
+            }
+        }
+        const anchorTop = anchor ? rectOf(anchor).top : 0;
+
+        for (let i = first; i <= last; i++) {
+            if ((i < newFirst || i > newLast) && blocks[i].el) {
+                blocks[i].el.remove();
+                blocks[i].el = null;
+            }
+        }
+        // Drop empty nodes the browser left between blocks
+        for (const node of Array.from(view.childNodes)) {
+            const owned = node === topSpacer || node === bottomSpacer || (node.virtualBlock && node.virtualBlock.el === node);
+            if (!owned && !node.textContent) {
+                node.remove();
+            }
+        }
+
+        const added = [];
+        let previous = topSpacer;
+        for (let i = newFirst; i <= newLast; i++) {
+            const block = blocks[i];
+            if (!block.el) {
+                previous.after(renderBlock(block));
+                added.push(block);
+            }
+            previous = block.el;
+        }
+        first = newFirst;
+        last = newLast;
+
+        for (const block of added) {
+            block.height = rectOf(block.el).height;
+        }
+        updatePxPerChar();
+        layoutSpacers();
+
+        if (anchor) {
+            view.scrollTop += rectOf(anchor).top - anchorTop;
+        }
+    };
+
+    const scheduleWindow = () => {
+        if (frame === null) {
+            frame = requestAnimationFrame(updateWindow);
+        }
+    };
+
+    const onResize = () => {
+        for (const block of blocks) block.height = null;
+        pxPerChar = estimatePxPerChar();
+        scheduleWindow();
+    };
+
+    // Offset of the caret within a rendered block, or -1 if it is elsewhere
+    const caretOffset = block => {
+        const selection = window.getSelection();
+        if (!selection.rangeCount || !block.el.contains(selection.focusNode)) return -1;
+        const range = document.createRange();
+        range.setStart(block.el, 0);
+        range.setEnd(selection.focusNode, selection.focusOffset);
+        return range.toString().length;
+    };
+
+    // (node, offset) of a text offset within a rendered block
+    const positionIn = (block, offset) => {
+        if (block.el.nodeType === Node.TEXT_NODE) return [block.el, offset];
+        const walker = document.createTreeWalker(block.el, NodeFilter.SHOW_TEXT);
+        let node;
+        let lastNode = null;
+        while ((node = walker.nextNode())) {
+            if (offset <= node.length) return [node, offset];
+            offset -= node.length;
+            lastNode = node;
+        }
+        return lastNode ? [lastNode, lastNode.length] : [block.el, 0];
+    };
+
+    view.addEventListener('scroll', scheduleWindow);
+    window.addEventListener('resize', onResize);
+
+    return {
+        /**
+         * Show a new text
+         * @param {String} text - The full text content
+         * @param {Number} promptEnd - Position where prompt ends (-1 for no styling)
+         */
+        load(text, promptEnd = -1) {
+            promptStyled = promptEnd > 0 && promptEnd < text.length;
+            blocks = promptStyled
+                ? [...split(text.substring(0, promptEnd)), ...split(text.substring(promptEnd), true)]
+                : split(text);
+            if (!blocks.length) blocks.push(makeBlock(''));
+            joined = text;
+            first = 0;
+            last = -1;
+            pxPerChar = estimatePxPerChar();
+            view.classList.add('virtual-editor');
+            view.replaceChildren(topSpacer, bottomSpacer);
+            updateWindow();
+        },
+
+        // The full text, joined once per change rather than serialized from the DOM
+        text() {
+            if (joined === null) {
+                joined = blocks.map(block => block.text).join('');
+            }
+            return joined;
+        },
+
+        /**
+         * Read back an edit. Only rendered blocks can have changed; a block whose
+         * element or spacer the edit removed has been deleted.
+         * @returns {Boolean} Whether the text changed
+         */
+        reconcile() {
+            const rendered = [];
+            let hasTop = false;
+            let hasBottom = false;
+            let changed = false;
+            for (const node of Array.from(view.childNodes)) {
+                if (node === topSpacer) {
+                    hasTop = true;
+                    continue;
+                }
+                if (node === bottomSpacer) {
+                    hasBottom = true;
+                    continue;
+                }
+                const text = node.textContent;
+                let block = node.virtualBlock;
+                if (!block || block.el !== node) {
+                    if (!text) continue;
+                    // Text the browser put outside any block
+                    block = makeBlock(text);
+                    block.el = node;
+                    node.virtualBlock = block;
+                    changed = true;
+                } else if (block.text !== text) {
+                    block.text = text;
+                    block.height = null;
+                    changed = true;
+                }
+                rendered.push(block);
+            }
+
+            const before = hasTop ? blocks.slice(0, first) : [];
+            const after = hasBottom ? blocks.slice(last + 1) : [];
+            const next = [...before, ...rendered, ...after];
+            if (!changed) {
+                changed = next.length !== blocks.length || next.some((block, i) => block !== blocks[i]);
+            }
+            if (!changed) return false;
+
+            // A large paste leaves one huge block: cut it up so most of it can be released again
+            for (let i = before.length; i < next.length - after.length; i++) {
+                const block = next[i];
+                if (block.text.length <= VIRTUAL_BLOCK_SIZE * 4) continue;
+                let caret = caretOffset(block);
+                const parts = split(block.text, block.generated);
+                block.el.replaceWith(...parts.map(renderBlock));
+                next.splice(i, 1, ...parts);
+                i += parts.length - 1;
+                for (const part of parts) {
+                    if (caret >= 0 && caret <= part.text.length) {
+                        window.getSelection().collapse(...positionIn(part, caret));
+                        caret = -1;
+                    } else if (caret >= 0) {
+                        caret -= part.text.length;
+                    }
+                }
+            }
+            if (!next.length) next.push(makeBlock(''));
+
+            // Spacers hold no selection, so they can be put back at the ends
+            if (view.firstChild !== topSpacer) view.prepend(topSpacer);
+            if (view.lastChild !== bottomSpacer) view.append(bottomSpacer);
+
+            blocks = next;
+            first = before.length;
+            last = blocks.length - after.length - 1;
+            for (let i = first; i <= last; i++) {
+                if (blocks[i].el && blocks[i].height === null) {
+                    blocks[i].height = rectOf(blocks[i].el).height;
+                }
+            }
+            joined = null;
+            layoutSpacers();
+            scheduleWindow();
+            return true;
+        },
+
+        // Start a block for streamed text, styled as generated
+        beginGenerated() {
+            const previous = blocks[blocks.length - 1];
+            const block = makeBlock('', true);
+            blocks.push(block);
+            if (last === blocks.length - 2 && previous.el) {
+                previous.el.after(renderBlock(block));
+                last++;
+            }
+            if (!promptStyled) {
+                promptStyled = true;
+                for (let i = first; i <= last; i++) {
+                    if (blocks[i].el && blocks[i].el.nodeType === Node.ELEMENT_NODE) {
+                        blocks[i].el.className = blockClass(blocks[i]);
+                    }
+                }
+            }
+        },
+
+        // Append streamed text, touching only the last block
+        append(text) {
+            let block = blocks[blocks.length - 1];
+            if (block.text.length >= VIRTUAL_BLOCK_SIZE) {
+                const previous = block;
+                block = makeBlock('', previous.generated);
+                blocks.push(block);
+                if (last === blocks.length - 2 && previous.el) {
+                    previous.el.after(renderBlock(block));
+                    last++;
+                }
+            }
+            block.text += text;
+            if (joined !== null) {
+                joined += text;
+            }
+            if (block.el) {
+                const target = block.el.nodeType === Node.TEXT_NODE ? block.el : block.el.lastChild;
+                if (target && target.nodeType === Node.TEXT_NODE) {
+                    target.appendData(text);
+                } else {
+                    block.el.append(text);
+                }
+                block.height = rectOf(block.el).height;
+            } else {
+                block.height = null;
+            }
+            layoutSpacers();
+        },
+
+        // Drop prompt/generated styling after a user edit
+        clearStyling() {
+            if (!promptStyled) return;
+            promptStyled = false;
+            for (const block of blocks) {
+                block.generated = false;
+                if (block.el && block.el.nodeType === Node.ELEMENT_NODE) {
+                    block.el.className = blockClass(block);
+                }
+            }
+        },
+
+        /**
+         * Scroll a text range into the rendered window and return it as a DOM range
+         * @param {Number} offset - Start offset in the text
+         * @param {Number} length - Length of the range
+         * @returns {Range|null}
+         */
+        rangeAt(offset, length) {
+            let start = 0;
+            let y = 0;
+            let index = 0;
+            while (index < blocks.length - 1 && start + blocks[index].text.length < offset) {
+                start += blocks[index].text.length;
+                y += heightOf(blocks[index]);
+                index++;
+            }
+            view.scrollTop = y - view.clientHeight / 4;
+            updateWindow();
+            if (!blocks[index].el) return null;
+
+            const range = document.createRange();
+            range.setStart(...positionIn(blocks[index], offset - start));
+            const end = offset + length;
+            for (let i = index; i <= last; i++) {
+                if (end <= start + blocks[i].text.length || i === last) {
+                    range.setEnd(...positionIn(blocks[i], Math.min(end - start, blocks[i].text.length)));
+                    break;
+                }
+                start += blocks[i].text.length;
+            }
+            return range;
+        },
+
+        destroy() {
+            if (frame !== null) {
+                cancelAnimationFrame(frame);
+            }
+            view.removeEventListener('scroll', scheduleWindow);
+            window.removeEventListener('resize', onResize);
+            view.classList.remove('virtual-editor');
+            view.replaceChildren();
+        }
+    };
+}
+
 /**
  * Save the current document content to the server
  * Now called directly without debounce since debouncing is handled at the input level
@@ -209,17 +782,61 @@ function setEditorContent(text, promptEnd = -1) {
 function saveCurrentDocument() {
     if (!currentDocument || !editor) return;
 
+    const doc = currentDocument;
     const content = getEditorText();
     
+    // Remember what the server has before local state moves ahead of it
+    if (doc.serverContent === undefined) {
+        doc.serverContent = doc.content || '';
+    }
+    
     // Update local state immediately
-    currentDocument.content = content;
-    currentDocument.updated_at = new Date().toISOString();
+    doc.content = content;
+    doc.updated_at = new Date().toISOString();
     
     // Update cache
-    documentContentCache.set(currentDocument.id, currentDocument);
+    documentContentCache.set(doc.id, doc);
     
     // Silent save to server
-    fetch(`/documents/${currentDocument.id}`, {
+    saveChain = saveChain
+        .then(() => sendDocumentContent(doc, content))
+        .catch(error => {
+            console.error('Error saving document:', error);
+        });
+}
+
+/**
+ * Send content to the server as a delta against the last saved version,
+ * falling back to a full upload when the server's version has moved on
+ * @param {Object} doc - Document being saved
+ * @param {String} content - Content to save
+ */
+async function sendDocumentContent(doc, content) {
+    if (doc.serverContent === content) return;
+
+    if (doc.serverContent !== undefined) {
+        const response = await fetch(`/documents/${doc.id}`, {
+            method: 'PATCH',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                base_version: doc.version || 0,
+                ops: [computeTextPatch(doc.serverContent, content)]
+            })
+        });
+        if (response.status !== 409) {
+            const data = await response.json();
+            if (data.success) {
+                doc.version = data.version;
+                doc.serverContent = content;
+                return;
+            }
+        }
+    }
+
+    // No known base, or a version conflict: resync with the full content
+    const response = await fetch(`/documents/${doc.id}`, {
         method: 'PUT',
         headers: {
             'Content-Type': 'application/json',
@@ -227,10 +844,50 @@ function saveCurrentDocument() {
         body: JSON.stringify({
             content: content
         })
-    })
-    .catch(error => {
-        console.error('Error saving document:', error);
     });
+    const data = await response.json();
+    if (data.success) {
+        doc.version = data.document.version;
+        doc.serverContent = content;
+    }
+}
+
+/**
+ * Compute a single splice turning oldText into newText by trimming their
+ * common prefix and suffix. Offsets are in code points, as the server counts them.
+ * @returns {Array} [offset, deleteCount, insertText]
+ */
+function computeTextPatch(oldText, newText) {
+    const isHighSurrogate = code => code >= 0xD800 && code <= 0xDBFF;
+    const isLowSurrogate = code => code >= 0xDC00 && code <= 0xDFFF;
+    const countCodePoints = text => text.length - (text.match(/[\uD800-\uDBFF][\uDC00-\uDFFF]/g) || []).length;
+
+    const minLength = Math.min(oldText.length, newText.length);
+    let start = 0;
+    while (start < minLength && oldText.charCodeAt(start) === newText.charCodeAt(start)) {
+        start++;
+    }
+    // Don't split a surrogate pair
+    if (start > 0 && isHighSurrogate(oldText.charCodeAt(start - 1))) {
+        start--;
+    }
+
+    let oldEnd = oldText.length;
+    let newEnd = newText.length;
+    while (oldEnd > start && newEnd > start && oldText.charCodeAt(oldEnd - 1) === newText.charCodeAt(newEnd - 1)) {
+        oldEnd--;
+        newEnd--;
+    }
+    if (oldEnd < oldText.length && isLowSurrogate(oldText.charCodeAt(oldEnd))) {
+        oldEnd++;
+        newEnd++;
+    }
+
+    return [
+        countCodePoints(oldText.substring(0, start)),
+        countCodePoints(oldText.substring(start, oldEnd)),
+        newText.substring(start, newEnd)
+    ];
 }
 
 // ============================
@@ -302,17 +959,93 @@ function handleTokenSubmit(e) {
 // Document Management
 // ============================
 
+/**
+ * Fetch JSON, failing on HTTP errors
+ */
+async function fetchJSON(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error('Network response was not ok');
+    }
+    return response.json();
+}
+
+/**
+ * Bring the document listing up to date. Only changes since the revision we
+ * have are fetched; the whole list is paged in when there is nothing to update.
+ * The listing is kept in localStorage, so reopening the app costs one small request.
+ * @returns {Object} {success, documents, current_document}
+ */
+async function syncDocumentListing() {
+    if (documentListing === null) {
+        try {
+            const stored = JSON.parse(localStorage.getItem('documentListing'));
+            if (stored) {
+                documentListing = { ...stored, documents: new Map(stored.documents.map(doc => [doc.id, doc])) };
+            }
+        } catch (error) {
+            documentListing = null;
+        }
+    }
+
+    for (let attempt = 0; attempt < 2; attempt++) {
+        let changed = false;
+        if (documentListing === null) {
+            // Page through the whole list; anything that changes meanwhile is in the changes below
+            const documents = new Map();
+            let first = null;
+            let cursor = null;
+            do {
+                const data = await fetchJSON(`/documents?limit=${DOCUMENT_PAGE_SIZE}` +
+                    (cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''));
+                if (!data.success) return data;
+                first = first || data;
+                data.documents.forEach(doc => documents.set(doc.id, doc));
+                cursor = data.next_cursor;
+            } while (cursor);
+            documentListing = { epoch: first.epoch, revision: first.revision, documents };
+            changed = true;
+        }
+
+        const data = await fetchJSON(`/documents/changes?since=${documentListing.revision}` +
+            `&epoch=${encodeURIComponent(documentListing.epoch)}`);
+        if (!data.success) return data;
+        if (data.reset) {
+            documentListing = null;
+            continue;
+        }
+
+        if (data.revision !== documentListing.revision) {
+            data.documents.forEach(doc => documentListing.documents.set(doc.id, doc));
+            data.removed.forEach(id => documentListing.documents.delete(id));
+            documentListing.revision = data.revision;
+            changed = true;
+        }
+        if (changed) {
+            try {
+                localStorage.setItem('documentListing', JSON.stringify({
+                    epoch: documentListing.epoch,
+                    revision: documentListing.revision,
+                    documents: Array.from(documentListing.documents.values())
+                }));
+            } catch (error) {
+                console.warn('Could not store the document list:', error);
+            }
+        }
+        return {
+            success: true,
+            documents: Array.from(documentListing.documents.values()),
+            current_document: data.current_document
+        };
+    }
+    throw new Error('Document list changed while loading');
+}
+
 /**
  * Load the document list from the server
  */
 function loadDocuments() {
-    fetch('/documents')
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Network response was not ok');
-            }
-            return response.json();
-        })
+    syncDocumentListing()
         .then(data => {
             if (!data.success) {
                 console.error('Error loading documents:', data.error);
@@ -351,35 +1084,76 @@ function loadDocuments() {
         });
 }
 
+/**
+ * Fetch several documents in one request. The server streams one JSON line per
+ * document, and each is handed to onDocument as soon as it arrives.
+ * @param {Array} ids - Document IDs
+ * @param {Array} fields - Fields to fetch: any of name, content, version, created_at, updated_at
+ * @param {Function} onDocument - Called with {id, ...fields} or {id, error}
+ */
+async function fetchDocumentsBulk(ids, fields, onDocument) {
+    const response = await fetch('/documents/bulk', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ ids, fields })
+    });
+    if (!response.ok) {
+        throw new Error('Network response was not ok');
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += done ? decoder.decode() : decoder.decode(value, { stream: true });
+        let start = 0;
+        let newline;
+        while ((newline = buffer.indexOf('\n', start)) !== -1) {
+            if (newline > start) {
+                onDocument(JSON.parse(buffer.substring(start, newline)));
+            }
+            start = newline + 1;
+        }
+        buffer = buffer.substring(start);
+        if (done) break;
+    }
+    if (buffer.trim()) {
+        onDocument(JSON.parse(buffer));
+    }
+}
+
+/**
+ * Fetch just the content of a document
+ * @returns {String|null} The content, or null if the document wasn't found
+ */
+async function fetchDocumentContent(docId) {
+    let content = null;
+    await fetchDocumentsBulk([docId], ['content'], doc => {
+        if (!doc.error) content = doc.content || '';
+    });
+    return content;
+}
+
 /**
  * Preload documents into cache for instant switching (async, non-blocking)
  */
 async function preloadDocuments(documents) {
     // Filter out already cached docs
-    const docsToPreload = documents.filter(doc => !documentContentCache.has(doc.id));
-    
-    // Preload in small batches to avoid overwhelming the server
-    const batchSize = 5;
-    for (let i = 0; i < docsToPreload.length; i += batchSize) {
-        const batch = docsToPreload.slice(i, i + batchSize);
-        
-        // Process batch in parallel
-        await Promise.all(batch.map(async (doc) => {
-            try {
-                const response = await fetch(`/documents/${doc.id}`);
-                const data = await response.json();
-                if (data.success) {
-                    documentContentCache.set(doc.id, data.document);
-                }
-            } catch (error) {
-                console.error(`Error preloading document ${doc.id}:`, error);
+    const ids = documents.filter(doc => !documentContentCache.has(doc.id)).map(doc => doc.id);
+    if (ids.length === 0) return;
+
+    try {
+        await fetchDocumentsBulk(ids, ['name', 'content', 'version', 'created_at', 'updated_at'], doc => {
+            // A document opened meanwhile is already cached with newer local state
+            if (!doc.error && !documentContentCache.has(doc.id)) {
+                documentContentCache.set(doc.id, doc);
             }
-        }));
-        
-        // Small delay between batches to be nice to the server
-        if (i + batchSize < docsToPreload.length) {
-            await new Promise(resolve => setTimeout(resolve, 50));
-        }
+        });
+    } catch (error) {
+        console.error('Error preloading documents:', error);
     }
 }
 
@@ -397,7 +1171,21 @@ function searchDocuments(query) {
         lastSearchRequest.abort();
     }
     
-    const cacheKey = query || 'all';
+    // Without a query the sidebar shows the synced listing
+    if (!query) {
+        syncDocumentListing()
+            .then(data => {
+                if (data.success) {
+                    renderDocumentList(data.documents, currentDocument ? currentDocument.id : null);
+                }
+            })
+            .catch(error => {
+                console.error('Error loading documents:', error);
+            });
+        return;
+    }
+
+    const cacheKey = query;
     
     // Check cache first for non-empty queries
     if (query && searchCache.has(cacheKey)) {
@@ -409,7 +1197,7 @@ function searchDocuments(query) {
         return;
     }
     
-    const url = query ? `/documents/search?q=${encodeURIComponent(query)}` : '/documents';
+    const url = `/documents/search?q=${encodeURIComponent(query)}`;
     const controller = new AbortController();
     lastSearchRequest = controller;
     
@@ -502,6 +1290,7 @@ function renderDocumentList(documents, currentDocId, searchInfo = null) {
                 
                 // Update active state
                 existingElement.className = `document-item ${doc.id === currentDocId ? 'active' : ''}`;
+                setPassageData(existingElement, doc);
                 
                 fragment.appendChild(existingElement);
             }
@@ -532,11 +1321,11 @@ function getTimeOrMetric(doc, searchInfo) {
     if (searchInfo && searchInfo.query) {
         // Show search metric based on search type
         if (searchInfo.search_type === 'embeddings' && doc.similarity_score !== undefined) {
-            // Round cosine similarity to 2 decimal places
-            return (doc.similarity_score).toFixed(2);
+            // Round cosine similarity to 2 decimal places (* = scored with an outdated embedding)
+            return (doc.similarity_score).toFixed(2) + (doc.embedding_pending ? '*' : '');
         } else if (searchInfo.search_type === 'keyword' && doc.occurrence_count !== undefined) {
-            // Show integer number of keyword appearances
-            return doc.occurrence_count.toString();
+            // Show integer number of keyword appearances (* = counted before the latest edit was indexed)
+            return doc.occurrence_count.toString() + (doc.keywords_pending ? '*' : '');
         }
     }
     // Show regular timestamp
@@ -551,6 +1340,7 @@ function createDocumentElement(doc, currentDocId, searchInfo) {
     const li = document.createElement('li');
     li.className = `document-item ${doc.id === currentDocId ? 'active' : ''}`;
     li.dataset.id = doc.id;
+    setPassageData(li, doc);
     
     const timeOrMetric = getTimeOrMetric(doc, searchInfo);
     
@@ -581,12 +1371,28 @@ function createDocumentElement(doc, currentDocId, searchInfo) {
         
         // For normal left-click, prevent default and load via AJAX
         e.preventDefault();
-        loadDocument(doc.id);
+        const passage = li.dataset.passageOffset !== undefined
+            ? { offset: parseInt(li.dataset.passageOffset), length: parseInt(li.dataset.passageLength) }
+            : null;
+        loadDocument(doc.id, passage);
     });
     
     return li;
 }
 
+/**
+ * Store (or clear) the best-matching search passage on a document element
+ */
+function setPassageData(li, doc) {
+    if (doc.passage_offset !== undefined) {
+        li.dataset.passageOffset = doc.passage_offset;
+        li.dataset.passageLength = doc.passage_length;
+    } else {
+        delete li.dataset.passageOffset;
+        delete li.dataset.passageLength;
+    }
+}
+
 /**
  * Attach event listeners to document action buttons
  */
@@ -642,10 +1448,12 @@ function attachDocumentEventListeners() {
 /**
  * Load a specific document
  * @param {String} docId - Document ID to load
+ * @param {Object} passage - Optional {offset, length} to scroll to and select
  */
-function loadDocument(docId) {
+function loadDocument(docId, passage = null) {
     // Mark this as the pending load to prevent race conditions
     pendingDocumentLoad = docId;
+    pendingPassageReveal = passage ? { docId, ...passage } : null;
     
     // Get document name from sidebar for immediate feedback
     const docElement = document.querySelector(`.document-item[data-id="${docId}"]`);
@@ -709,6 +1517,11 @@ function applyDocumentToEditor(docId, document) {
         return; // User switched to different document, ignore this
     }
 
+    // Branches belong to the document they were generated for
+    if (!currentDocument || currentDocument.id !== document.id) {
+        hideBranches();
+    }
+
     currentDocument = document;
 
     // Update document name
@@ -728,6 +1541,57 @@ function applyDocumentToEditor(docId, document) {
         lastContent = content;
         suppressInputHandler = false;
     }
+
+    // Jump to the search passage that matched, if any
+    if (pendingPassageReveal && pendingPassageReveal.docId === docId) {
+        revealEditorRange(pendingPassageReveal.offset, pendingPassageReveal.length);
+        pendingPassageReveal = null;
+    }
+}
+
+/**
+ * Scroll the editor to a text range and select it
+ * @param {Number} offset - Start offset in the editor text
+ * @param {Number} length - Length of the range
+ */
+function revealEditorRange(offset, length) {
+    if (!editor || editor.tagName === 'TEXTAREA') return;
+
+    let range;
+    if (virtualEditor) {
+        range = virtualEditor.rangeAt(offset, length);
+        if (!range) return;
+    } else {
+        // Map text offsets to (node, offset) positions across the editor's text nodes
+        const walker = document.createTreeWalker(editor, NodeFilter.SHOW_TEXT);
+        range = document.createRange();
+        const end = offset + length;
+        let position = 0;
+        let startSet = false;
+        let node;
+        while ((node = walker.nextNode())) {
+            const nodeEnd = position + node.length;
+            if (!startSet && offset <= nodeEnd) {
+                range.setStart(node, offset - position);
+                startSet = true;
+            }
+            if (startSet && end <= nodeEnd) {
+                range.setEnd(node, end - position);
+                break;
+            }
+            position = nodeEnd;
+        }
+        if (!startSet) return;
+    }
+
+    const selection = window.getSelection();
+    selection.removeAllRanges();
+    selection.addRange(range);
+
+    // Bring the passage start near the top of the editor
+    const rangeTop = range.getBoundingClientRect().top;
+    const editorTop = editor.getBoundingClientRect().top;
+    editor.scrollTop += rangeTop - editorTop - editor.clientHeight / 4;
 }
 
 /**
@@ -806,11 +1670,9 @@ function renameDocument(docId, newName) {
  * @param {String} docName - Document name for filename
  */
 function downloadDocument(docId, docName) {
-    fetch(`/documents/${docId}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                const content = data.document.content || '';
+    fetchDocumentContent(docId)
+        .then(content => {
+            if (content !== null) {
                 const filename = `${docName}.txt`;
                 
                 // Create a blob with the content
@@ -830,7 +1692,7 @@ function downloadDocument(docId, docName) {
                 document.body.removeChild(a);
                 window.URL.revokeObjectURL(url);
             } else {
-                console.error('Error downloading document:', data.error);
+                console.error('Error downloading document: Document not found');
             }
         })
         .catch(error => {
@@ -844,43 +1706,45 @@ function downloadDocument(docId, docName) {
  * @param {String} docName - Document name
  */
 function duplicateDocumentFromSidebar(docId, docName) {
-    fetch(`/documents/${docId}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                const content = data.document.content || '';
-                const newName = `${docName} (copy)`;
-                
-                fetch('/documents/new', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: new URLSearchParams({
-                        'name': newName,
-                        'content': content
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        loadDocuments();
-                    } else {
-                        console.error('Error creating duplicate:', data.error);
-                    }
-                })
-                .catch(error => {
-                    console.error('Error creating duplicate:', error);
-                });
-            } else {
-                console.error('Error fetching document:', data.error);
+    // Send unsaved edits first when it's the open document
+    if (currentDocument && currentDocument.id === docId) {
+        saveCurrentDocument();
+    }
+    saveChain
+        .then(() => duplicateDocumentOnServer(docId, `${docName} (copy)`))
+        .then(newDoc => {
+            if (newDoc) {
+                loadDocuments();
             }
         })
         .catch(error => {
-            console.error('Error fetching document:', error);
+            console.error('Error creating duplicate:', error);
         });
 }
 
+/**
+ * Duplicate a document on the server, which shares its content and embeddings
+ * with the original instead of copying them
+ * @param {String} docId - Document ID to duplicate
+ * @param {String} name - Name for the copy
+ * @returns {Promise<Object|null>} The copy's metadata (without content), or null
+ */
+async function duplicateDocumentOnServer(docId, name) {
+    const response = await fetch(`/documents/${docId}/duplicate`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ name: name })
+    });
+    const data = await response.json();
+    if (!data.success) {
+        console.error('Error duplicating document:', data.error);
+        return null;
+    }
+    return data.document;
+}
+
 /**
  * Delete a document
  * @param {String} docId - Document ID to delete
@@ -917,42 +1781,24 @@ function deleteDocument(docId) {
 }
 
 /**
- * Delete all empty "Untitled" documents
+ * Delete all empty "Untitled" documents (one request; the server finds them)
  */
 async function deleteEmptyUntitledDocuments() {
     try {
-        const response = await fetch('/documents');
-        const data = await response.json();
-        
-        if (!data.success || !data.documents) return;
-        
-        // Find all "Untitled" docs that are empty
-        const emptyUntitled = data.documents.filter(doc => {
-            const cachedDoc = documentContentCache.get(doc.id);
-            const content = cachedDoc ? cachedDoc.content : doc.content;
-            return doc.name === 'Untitled' && (!content || content.trim() === '');
+        const response = await fetch('/documents/batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ gc_empty_untitled: true })
         });
+        const data = await response.json();
         
-        // Fetch and check uncached documents
-        const uncachedDocs = emptyUntitled.filter(doc => !documentContentCache.has(doc.id));
-        for (const doc of uncachedDocs) {
-            const docResponse = await fetch(`/documents/${doc.id}`);
-            const docData = await docResponse.json();
-            if (docData.success) {
-                const content = docData.document.content || '';
-                if (content.trim() !== '') {
-                    // Not empty, remove from deletion list
-                    const idx = emptyUntitled.findIndex(d => d.id === doc.id);
-                    if (idx >= 0) emptyUntitled.splice(idx, 1);
-                }
-            }
+        if (!data.success) {
+            console.error('Error deleting empty Untitled documents:', data.error);
+            return;
         }
-        
-        // Delete all empty "Untitled" documents
-        await Promise.all(emptyUntitled.map(doc => {
-            documentContentCache.delete(doc.id);
-            return fetch(`/documents/${doc.id}`, { method: 'DELETE' });
-        }));
+        data.deleted.forEach(id => documentContentCache.delete(id));
     } catch (error) {
         console.error('Error deleting empty Untitled documents:', error);
     }
@@ -973,6 +1819,7 @@ function updateSubmitButtonState(provider) {
     // Update submit button
     domElements.submitBtn.disabled = needsToken;
     domElements.seedBtn.disabled = needsToken;
+    domElements.branchBtn.disabled = needsToken;
     
     // Update title attributes for tooltip
     if (needsToken) {
@@ -988,66 +1835,236 @@ function updateSubmitButtonState(provider) {
 // Text Generation
 // ============================
 
+/**
+ * Strip trailing spaces from each line and trailing newlines, as prompts are sent
+ * @param {String} text - Editor text
+ * @returns {String} Prompt text
+ */
+function trimPrompt(text) {
+    return text
+        .split('\n')
+        .map(line => line.trimEnd())
+        .join('\n')
+        .trimEnd(); // Also trim any trailing newlines at the end of the document
+}
+
+/**
+ * Start a generation on the server after flushing pending edits
+ * @param {Object} doc - Document to continue
+ * @param {String} text - Editor text
+ * @param {String} content - Trimmed prompt
+ * @param {Object} extraParams - Additional /submit fields, e.g. n
+ * @returns {Promise<Object>} { data, serverBase } where serverBase is the text the server continues, if synced
+ */
+function requestGeneration(doc, text, content, extraParams = {}) {
+    // Flush pending edits; once the server has this exact text, only its version is sent
+    saveCurrentDocument();
+    return saveChain.then(() => {
+        const synced = doc.serverContent === text;
+        const params = synced
+            ? { 'document_id': doc.id, 'version': doc.version || 0 }
+            : { 'document_id': doc.id, 'prompt': content };
+        Object.assign(params, extraParams);
+        return fetch('/submit', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body: new URLSearchParams(params)
+        }).then(response => response.json().then(data => ({ data, serverBase: synced ? text : null })));
+    });
+}
+
+/**
+ * URL of a generation's event stream, telling the server how fast we render
+ * @param {String} generationId - ID of the generation request
+ */
+function streamUrl(generationId) {
+    const renderMs = Math.round(streamRenderMs * 10) / 10;
+    return renderMs > 0 ? `/stream/${generationId}?render_ms=${renderMs}` : `/stream/${generationId}`;
+}
+
+/**
+ * Stream several completions of the same prompt into the branch panel
+ * @param {String} generationId - ID of the generation request
+ * @param {Number} count - Number of branches requested
+ */
+function startBranchStreaming(generationId, count) {
+    const branches = new Array(count).fill('');
+    const doc = currentDocument;
+
+    // One card per branch; clicking a card continues the document with it
+    domElements.branchList.innerHTML = '';
+    const cards = branches.map((_, index) => {
+        const card = document.createElement('div');
+        card.className = 'branch-card';
+        card.addEventListener('click', () => {
+            if (currentDocument === doc && !card.classList.contains('failed')) {
+                acceptBranch(branches[index]);
+            }
+        });
+        domElements.branchList.appendChild(card);
+        return card;
+    });
+    domElements.branchPanel.style.display = 'block';
+
+    domElements.cancelBtn.style.display = 'block';
+    domElements.submitBtn.style.display = 'none';
+
+    const eventSource = new EventSource(streamUrl(generationId));
+
+    const finish = () => {
+        eventSource.close();
+        if (currentGenerationId === generationId) {
+            currentGenerationId = null;
+        }
+        const currentProvider = window.config?.provider || 'openrouter';
+        updateSubmitButtonState(currentProvider);
+        domElements.submitBtn.style.display = 'block';
+        domElements.cancelBtn.style.display = 'none';
+    };
+
+    eventSource.onmessage = function(event) {
+        const data = JSON.parse(event.data);
+
+        if (data.text && cards[data.index]) {
+            branches[data.index] += data.text;
+            cards[data.index].textContent = branches[data.index];
+        }
+
+        if (data.failed && cards[data.index]) {
+            cards[data.index].classList.add('failed');
+            cards[data.index].textContent = data.failed;
+        }
+
+        if (data.done || data.cancelled) {
+            finish();
+        }
+
+        if (data.error) {
+            console.error('Error in branch generation:', data.error);
+            finish();
+            showError(data.error);
+        }
+    };
+
+    eventSource.onerror = function(error) {
+        console.error('Error in branch generation stream:', error);
+        finish();
+        showError('Connection error occurred. Please try again.');
+    };
+
+    window.currentEventSource = eventSource;
+}
+
+/**
+ * Continue the document with a branch and close the branch panel
+ * @param {String} branchText - Text of the chosen branch
+ */
+function acceptBranch(branchText) {
+    const originalText = getEditorText();
+
+    // Stop the other branches if they're still streaming
+    if (currentGenerationId) {
+        domElements.cancelBtn.click();
+    }
+
+    // Same state as after a completion, so reroll goes back to before the branch
+    lastCheckpoint = trimPrompt(originalText);
+    promptBoundary = originalText.length;
+    suppressInputHandler = true;
+    setEditorContent(originalText + branchText, promptBoundary);
+    lastContent = originalText + branchText;
+    suppressInputHandler = false;
+    saveCurrentDocument();
+
+    domElements.rerollBtn.style.display = 'block';
+    hideBranches();
+}
+
+/**
+ * Switch the current document to the previous or next sibling in its loom,
+ * e.g. back to an earlier reroll. Unsaved edits are sent first; the server
+ * keeps them as a node of their own, so switching away loses nothing.
+ * @param {Number} step - -1 for the previous sibling, 1 for the next
+ */
+async function switchLoomBranch(step) {
+    if (!currentDocument || !editor || currentGenerationId) return;
+    const doc = currentDocument;
+
+    saveCurrentDocument();
+    await saveChain;
+    try {
+        const response = await fetch(`/documents/${doc.id}/loom/switch`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ step: step })
+        });
+        const data = await response.json();
+        if (!data.success || currentDocument !== doc) return;
+
+        doc.content = data.content;
+        doc.serverContent = data.content;
+        doc.version = data.version;
+        documentContentCache.set(doc.id, doc);
+
+        // Show the branch like a fresh completion, so reroll goes back to before it
+        promptBoundary = data.completion_start;
+        suppressInputHandler = true;
+        setEditorContent(data.content, promptBoundary);
+        lastContent = data.content;
+        suppressInputHandler = false;
+        if (promptBoundary >= 0) {
+            lastCheckpoint = data.content.substring(0, promptBoundary);
+            domElements.rerollBtn.style.display = 'block';
+        }
+    } catch (error) {
+        console.error('Error switching branch:', error);
+    }
+}
+
+/**
+ * Hide the branch panel and drop its branches
+ */
+function hideBranches() {
+    domElements.branchPanel.style.display = 'none';
+    domElements.branchList.innerHTML = '';
+}
+
 /**
  * Start streaming text generation
  * @param {String} generationId - ID of the generation request
  */
-function startStreaming(generationId) {
+function startStreaming(generationId, doc = currentDocument, serverBase = null) {
     let generatedText = '';
     const originalText = getEditorText();
 
+    // The server appends the output to the document it started from. When a final
+    // event reports the resulting version, the editor text is already saved.
+    const markSaved = version => {
+        if (version === undefined || serverBase === null || originalText !== serverBase) return;
+        doc.serverContent = originalText + generatedText;
+        doc.version = version;
+    };
+
     // Set prompt boundary for styling
     promptBoundary = originalText.length;
+    const renderer = createStreamRenderer(originalText, doc);
 
     // Show cancel button and hide submit button during generation
     domElements.cancelBtn.style.display = 'block';
     domElements.submitBtn.style.display = 'none';
 
-    const eventSource = new EventSource(`/stream/${generationId}`);
+    const eventSource = new EventSource(streamUrl(generationId));
     
     eventSource.onmessage = function(event) {
         const data = JSON.parse(event.data);
         
         if (data.text) {
-            const currentScroll = editor.scrollTop;
-            const scrollAtBottom = editor.scrollTop >= (editor.scrollHeight - editor.clientHeight - 10);
-
             generatedText += data.text;
-
-            // For large documents, minimize DOM manipulation
-            const fullText = originalText + generatedText;
-            if (fullText.length > 50000) {
-                // Batch updates: only update every 10 chunks or when done
-                if (!window.streamUpdateBatch) {
-                    window.streamUpdateBatch = { count: 0, pendingText: '' };
-                }
-                window.streamUpdateBatch.pendingText += data.text;
-                window.streamUpdateBatch.count++;
-
-                // Update every 10 chunks for large documents
-                if (window.streamUpdateBatch.count >= 10) {
-                    setEditorContent(fullText, promptBoundary);
-                    window.streamUpdateBatch = { count: 0, pendingText: '' };
-
-                    if (scrollAtBottom) {
-                        editor.scrollTop = editor.scrollHeight;
-                    }
-                }
-            } else {
-                // Normal update for smaller documents - use styled content
-                setEditorContent(fullText, promptBoundary);
-
-                // Restore scroll position
-                if (scrollAtBottom) {
-                    editor.scrollTop = editor.scrollHeight;
-                } else {
-                    editor.scrollTop = currentScroll;
-                }
-            }
-
-            // Update lastContent to prevent input handler from triggering
-            // Backend will save immediately after generation completes
-            lastContent = fullText;
+            renderer.append(data.text);
         }
         
         // Handle auto-rename event
@@ -1103,15 +2120,10 @@ function startStreaming(generationId) {
         
         // Handle completion of generation
         if (data.done) {
-            // Flush any pending batched updates for large documents
-            if (window.streamUpdateBatch && window.streamUpdateBatch.count > 0) {
-                const fullText = originalText + generatedText;
-                setEditorContent(fullText, promptBoundary);
-                editor.scrollTop = editor.scrollHeight;
-                window.streamUpdateBatch = null;
-            }
+            renderer.flush();
             
-            // Save final content to backend before backend writes to disk
+            // Only sends anything if the editor differs from what the server accumulated
+            markSaved(data.version);
             saveCurrentDocument();
             
             eventSource.close();
@@ -1132,6 +2144,8 @@ function startStreaming(generationId) {
             console.error('Error in generation:', data.error);
 
             // Save any partial content before closing
+            renderer.flush();
+            markSaved(data.version);
             if (getEditorText() !== lastCheckpoint) {
                 saveCurrentDocument();
             }
@@ -1151,7 +2165,9 @@ function startStreaming(generationId) {
         
         // Handle cancellation
         if (data.cancelled) {
-            // Save partial content before backend writes to disk
+            // Save partial content the server doesn't already have
+            renderer.flush();
+            markSaved(data.version);
             saveCurrentDocument();
             
             eventSource.close();
@@ -1169,6 +2185,7 @@ function startStreaming(generationId) {
         console.error('Error in text generation stream:', error);
 
         // Save any partial content before closing
+        renderer.flush();
         if (getEditorText() !== lastCheckpoint) {
             saveCurrentDocument();
         }
@@ -1526,6 +2543,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     presence_penalty: parseFloat(formData.get('presence_penalty')),
                     repetition_penalty: parseFloat(formData.get('repetition_penalty')),
                     max_tokens: parseInt(formData.get('max_tokens')),
+                    branches: parseInt(formData.get('branches')),
                     dark_mode: formData.get('dark_mode') === 'on',
                     provider: detection.provider,
                     custom_api_key: formData.get('custom_api_key'),
@@ -1707,31 +2725,19 @@ document.addEventListener('DOMContentLoaded', function() {
         autoSaveSettings();
 
         // Get content and strip trailing spaces from each line while preserving newlines
-        const content = getEditorText()
-            .split('\n')
-            .map(line => line.trimEnd())
-            .join('\n')
-            .trimEnd(); // Also trim any trailing newlines at the end of the document
+        const text = getEditorText();
+        const content = trimPrompt(text);
         
         // Save checkpoint before generation
         lastCheckpoint = content;
         
-        // Start generation request
-        fetch('/submit', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/x-www-form-urlencoded',
-            },
-            body: new URLSearchParams({
-                'prompt': content,
-                'document_id': currentDocument.id
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
+        const doc = currentDocument;
+        hideBranches();
+        requestGeneration(doc, text, content)
+        .then(({ data, serverBase }) => {
             if (data.success) {
                 currentGenerationId = data.generation_id;
-                startStreaming(data.generation_id);
+                startStreaming(data.generation_id, doc, serverBase);
             } else {
                 console.error('Error starting generation:', data.error);
                 // Re-enable based on provider state
@@ -1823,10 +2829,9 @@ document.addEventListener('DOMContentLoaded', function() {
         
         try {
             // Get current document content
-            const docResponse = await fetch(`/documents/${docId}`);
-            const docData = await docResponse.json();
+            const content = await fetchDocumentContent(docId);
             
-            if (docData.success && docData.document && docData.document.content) {
+            if (content) {
                 // Generate name from content
                 const response = await fetch('/generate_name', {
                     method: 'POST',
@@ -1834,7 +2839,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         'Content-Type': 'application/json',
                     },
                     body: JSON.stringify({
-                        content: docData.document.content
+                        content: content
                     })
                 });
                 
@@ -1909,6 +2914,48 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Branch button handler: several completions side by side
+    domElements.branchBtn.addEventListener('click', function() {
+        if (!editor || !currentDocument || currentGenerationId) return;
+
+        this.disabled = true;
+        domElements.submitBtn.disabled = true;
+
+        // Generation settings, including the branch count, must be saved first
+        autoSaveSettings();
+
+        const text = getEditorText();
+        const content = trimPrompt(text);
+        const count = Math.min(Math.max(window.config?.branches || 3, 2), 8);
+
+        requestGeneration(currentDocument, text, content, { 'n': count })
+        .then(({ data }) => {
+            if (data.success) {
+                currentGenerationId = data.generation_id;
+                startBranchStreaming(data.generation_id, count);
+            } else {
+                console.error('Error starting branches:', data.error);
+                const currentProvider = window.config?.provider || 'openrouter';
+                updateSubmitButtonState(currentProvider);
+                showError(data.error || 'Failed to start generation');
+            }
+        })
+        .catch(error => {
+            console.error('Error starting branches:', error);
+            const currentProvider = window.config?.provider || 'openrouter';
+            updateSubmitButtonState(currentProvider);
+            showError('Failed to connect to server. Please check your connection and try again.');
+        });
+    });
+
+    // Discard branches without using any
+    domElements.closeBranchesBtn.addEventListener('click', function() {
+        if (currentGenerationId) {
+            domElements.cancelBtn.click();
+        }
+        hideBranches();
+    });
+
     // Add reroll button handler
     domElements.rerollBtn.addEventListener('click', function() {
         if (!lastCheckpoint) return;
@@ -1952,23 +2999,18 @@ document.addEventListener('DOMContentLoaded', function() {
         if (!currentDocument || !editor) return;
 
         const content = getEditorText();
+        const sourceId = currentDocument.id;
         const originalName = currentDocument.name;
         const newName = `${originalName} (copy)`;
         
-        fetch('/documents/new', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/x-www-form-urlencoded',
-            },
-            body: new URLSearchParams({
-                'name': newName,
-                'content': content
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                const newDoc = data.document;
+        // The server copies what it has, so send unsaved edits first
+        saveCurrentDocument();
+        saveChain
+        .then(() => duplicateDocumentOnServer(sourceId, newName))
+        .then(newDoc => {
+            if (newDoc) {
+                newDoc.content = content;
+                newDoc.serverContent = content;
                 
                 // Update current document state immediately (no visual change, just metadata swap)
                 currentDocument = newDoc;
@@ -1988,13 +3030,13 @@ document.addEventListener('DOMContentLoaded', function() {
                 updateCurrentDocumentName(newDoc.name);
                 
                 // Refresh sidebar list in background and highlight new doc
-                fetch('/documents')
-                    .then(response => response.json())
+                syncDocumentListing()
                     .then(listData => {
                         if (listData.success) {
                             renderDocumentList(listData.documents, newDoc.id);
                         }
-                    });
+                    })
+                    .catch(error => console.error('Error refreshing document list:', error));
                 
                 // Set as current on server
                 fetch(`/documents/${newDoc.id}/set-current`, {
@@ -2011,8 +3053,6 @@ document.addEventListener('DOMContentLoaded', function() {
                     delay: 3000
                 });
                 duplicateToast.show();
-            } else {
-                console.error('Error duplicating document:', data.error);
             }
         })
         .catch(error => {